@@ -51,6 +51,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so every log record of the request carries its id
+    "myapp.middleware.RequestIdMiddleware",
+    # Next, so its total time covers the other middleware
+    "myapp.middleware.RequestProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -58,6 +62,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "myapp.middleware.ReadYourWritesMiddleware",
 ]
 
 ROOT_URLCONF = "Accuknox.urls"
@@ -84,14 +89,115 @@ WSGI_APPLICATION = "Accuknox.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# CONN_MAX_AGE and the SQLITE_PRAGMAS applied on connect come from the development/production profile
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "CONN_MAX_AGE": DATABASE_CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": DATABASE_CONN_MAX_AGE != 0,
+    }
+}
+
+# Read replicas: a comma-separated list of SQLite files in DATABASE_REPLICAS, kept up to date
+# locally with "python manage.py sync_sqlite_replicas". Tests read the replicas through the primary.
+
+REPLICA_FILES = [name.strip() for name in os.getenv("DATABASE_REPLICAS", "").split(",")]
+
+for number, replica in enumerate(filter(None, REPLICA_FILES), 1):
+    DATABASES[f"replica{number}"] = {
+        **DATABASES["default"],
+        "NAME": replica,
+        "TEST": {"MIRROR": "default"},
     }
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+
+DATABASE_ROUTERS = ["myapp.routers.PrimaryReplicaRouter"]
+
+# Number of seconds a user's reads stay on the primary after they write, pinned in the shared cache
+
+READ_YOUR_WRITES_WINDOW = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# The friend cache defaults to a per-process LocMem cache; point FRIEND_CACHE_BACKEND and
+# FRIEND_CACHE_LOCATION at a file-based, Redis or Memcached cache to share it between workers.
+# The "shared" cache holds the values every worker must agree on, such as the relationship versions
+# behind the list ETags. It is a table of the database by default, created by the migrations; point
+# SHARED_CACHE_BACKEND and SHARED_CACHE_LOCATION at Redis or Memcached to take that load off the database.
+
+SHARED_CACHE_BACKEND = os.getenv(
+    "SHARED_CACHE_BACKEND", "django.core.cache.backends.db.DatabaseCache"
+)
+
+# Seconds the shared cache keeps each entry of a change feed, such as the users edited since a search
+# index was built: a process that has not read a feed for longer starts over from the database
+
+CHANGE_FEED_TTL = 3600
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "shared": {
+        "BACKEND": SHARED_CACHE_BACKEND,
+        "LOCATION": os.getenv("SHARED_CACHE_LOCATION", "myapp_shared_cache"),
+        "TIMEOUT": None,
+        # The database cache culls past MAX_ENTRIES, 300 by default; the other backends take no such option
+        **(
+            {"OPTIONS": {"MAX_ENTRIES": 100000}}
+            if SHARED_CACHE_BACKEND.endswith(".DatabaseCache")
+            else {}
+        ),
+    },
+    "friends": {
+        "BACKEND": os.getenv(
+            "FRIEND_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.getenv("FRIEND_CACHE_LOCATION", "friends"),
+        "TIMEOUT": 300,
+    },
+    "sessions": {
+        "BACKEND": os.getenv(
+            "SESSION_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.getenv("SESSION_CACHE_LOCATION", "sessions"),
+    },
 }
 
 
+# Sessions
+# SESSION_STORAGE picks the session engine: "db" keeps sessions in the database only, "write_behind"
+# keeps them in the "sessions" cache and writes them to the database in batches every
+# SESSION_WRITE_BEHIND_INTERVAL seconds (SESSION_CACHE_BACKEND must then be a cache shared by all
+# workers, which the myapp.E002 check enforces), and "signed_cookies" keeps them in the client's
+# cookie for stateless workers. "python manage.py purge_sessions" deletes expired sessions
+# SESSION_PURGE_BATCH_SIZE rows at a time.
+
+SESSION_STORAGE = os.getenv("SESSION_STORAGE", "db")
+
+SESSION_ENGINE = {
+    "write_behind": "myapp.sessions",
+    "signed_cookies": "django.contrib.sessions.backends.signed_cookies",
+    "db": "django.contrib.sessions.backends.db",
+}[SESSION_STORAGE]
+
+SESSION_CACHE_ALIAS = "sessions"
+
+SESSION_WRITE_BEHIND_INTERVAL = 5
+
+SESSION_WRITE_BEHIND_MAX_PENDING = 500
+
+SESSION_PURGE_BATCH_SIZE = 1000
+
+FRIEND_CACHE_ALIAS = "friends"
+
+SHARED_CACHE_ALIAS = "shared"
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -139,25 +245,179 @@ AUTH_USER_MODEL = "myapp.MyUser"
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
+        "myapp.authentication.SignedTokenAuthentication",
         "rest_framework.authentication.BasicAuthentication",
+        # The session started by LoginView; unsafe methods need the CSRF token
+        "rest_framework.authentication.SessionAuthentication",
     ],
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
+    "DEFAULT_PAGINATION_CLASS": "myapp.pagination.KeysetPagination",
+    "PAGE_SIZE": 20,
     "DEFAULT_THROTTLE_RATES": {
         "friend_request": "3/minute",
+        # Counted per target user, not per batch
+        "friend_request_batch": "100/minute",
     },
 }
 
 
+# Largest page size a client can request with the page_size query parameter
+
+MAX_PAGE_SIZE = 100
+
+
+# Throttle store
+# Sliding-window throttle counters shared by all worker processes: a SQLite file by default, or
+# myapp.throttling.RedisThrottleStore with a redis:// LOCATION to share them between hosts.
+
+THROTTLE_STORE = {
+    "BACKEND": os.getenv(
+        "THROTTLE_STORE_BACKEND", "myapp.throttling.SQLiteThrottleStore"
+    ),
+    "LOCATION": os.getenv("THROTTLE_STORE_LOCATION", BASE_DIR / "throttle.sqlite3"),
+}
+
+
+# Signed tokens issued by LoginView
+# Lifetime of a token in seconds, and the size and entry lifetime of the in-process LRU of verified tokens
+
+TOKEN_MAX_AGE = 60 * 60 * 24
+
+TOKEN_CACHE_SIZE = 10000
+
+TOKEN_CACHE_TTL = 60
+
+
+# Largest number of target users accepted by a single batched friend request
+
+FRIEND_REQUEST_BATCH_SIZE = 100
+
+
+# Largest number of request ids accepted by a single bulk accept or reject
+
+FRIEND_REQUEST_BULK_SIZE = 1000
+
+
+# Pending friend requests older than FRIEND_REQUEST_TTL_DAYS are deleted by "python manage.py
+# expire_friend_requests", FRIEND_REQUEST_EXPIRY_BATCH_SIZE rows per transaction
+
+FRIEND_REQUEST_TTL_DAYS = 90
+
+FRIEND_REQUEST_EXPIRY_BATCH_SIZE = 1000
+
+
+# Largest number of user ids accepted by a single relationship lookup
+
+RELATIONSHIP_BATCH_SIZE = 100
+
+
+# Friendship change log read by /changes/
+# Most entries returned per call, and how long entries are kept by "python manage.py compact_change_log",
+# which deletes CHANGE_LOG_COMPACT_BATCH_SIZE rows per statement. Readers skip the entries of the last
+# CHANGE_LOG_SETTLE_SECONDS, which must exceed the longest write transaction on databases with concurrent
+# writers (PostgreSQL, MySQL); SQLite commits the entries in order, so 0 is safe there.
+
+CHANGE_LOG_PAGE_SIZE = 1000
+
+CHANGE_LOG_RETENTION_DAYS = 30
+
+CHANGE_LOG_COMPACT_BATCH_SIZE = 5000
+
+CHANGE_LOG_SETTLE_SECONDS = int(os.getenv("CHANGE_LOG_SETTLE_SECONDS", "0"))
+
+
+# User search index
+# Length of the n-grams indexed for user search, and the maximum number of ranked matches returned:
+# an indexed search is cut to its SEARCH_MAX_RESULTS best matches, over all its pages
+
+SEARCH_NGRAM_SIZE = 3
+
+SEARCH_MAX_RESULTS = 1000
+
+# Number of search responses kept by the in-process search result cache, the seconds each is kept,
+# and the seconds between two reads of the shared versions invalidating them
+
+SEARCH_CACHE_SIZE = 1000
+
+SEARCH_CACHE_TTL = 60
+
+SEARCH_CACHE_CHECK_INTERVAL = 1
+
+
+# Friend suggestions
+# Number of suggestions returned, and the most friend-of-friend edges visited per request, which bounds
+# the latency for users with many friends. Changes to the graph are merged into its arrays past the threshold.
+
+SUGGESTIONS_MAX_RESULTS = 20
+
+SUGGESTIONS_SCAN_LIMIT = 100000
+
+FRIEND_GRAPH_COMPACT_THRESHOLD = 10000
+
+
+# Event push
+# Hub fanning out the events streamed by /events/ and /events/poll/: in-process by default, or
+# myapp.events.RedisEventHub with a redis:// LOCATION to share events between worker processes.
+# Streams send a keepalive comment every EVENTS_KEEPALIVE seconds; long polls wait at most
+# EVENTS_LONG_POLL_TIMEOUT seconds.
+
+EVENT_HUB = {
+    "BACKEND": os.getenv("EVENT_HUB_BACKEND", "myapp.events.InProcessEventHub"),
+    "LOCATION": os.getenv("EVENT_HUB_LOCATION"),
+}
+
+EVENTS_KEEPALIVE = 15
+
+EVENTS_LONG_POLL_TIMEOUT = 25
+
+
+# Request profiling
+# Whether responses carry a Server-Timing header with their SQL, view and serializer times, and how
+# many times one SQL statement shape may run in a request before an N+1 warning is logged
+
+SERVER_TIMING_HEADER = os.getenv("SERVER_TIMING_HEADER", "true").lower() == "true"
+
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+
+# Metrics
+# Each worker process writes its metric values to this SQLite file at most every METRICS_FLUSH_INTERVAL
+# seconds, and /metrics/ serves their sum. Set METRICS_TOKEN to require it as a Bearer token there;
+# without a token, only the addresses in METRICS_ALLOWED_IPS may read the metrics.
+
+METRICS_STORE = os.getenv("METRICS_STORE", BASE_DIR / "metrics.sqlite3")
+
+METRICS_FLUSH_INTERVAL = 1
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+METRICS_ALLOWED_IPS = os.getenv("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+
+
+# Logging
+# Records are put on a bounded queue and written as JSON lines, with the request and user ids, by a
+# background thread. The file is rotated past LOG_MAX_BYTES; records that find the queue full are dropped
+# and counted in the myapp_log_records_dropped_total metric.
+
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+
+LOG_BACKUP_COUNT = 5
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'handlers': {
         'file': {
             'level': 'WARNING',
-            'class': 'logging.FileHandler',
+            'class': 'myapp.log.QueueFileHandler',
             'filename': BASE_DIR / 'warning.log',
+            'max_bytes': LOG_MAX_BYTES,
+            'backup_count': LOG_BACKUP_COUNT,
+            'queue_size': LOG_QUEUE_SIZE,
         },
     },
     'loggers': {
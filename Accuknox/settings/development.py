@@ -1,2 +1,14 @@
 from .base import *
-DEBUG=True
\ No newline at end of file
+DEBUG=True
+
+# SQLite performance profile
+# PRAGMAs applied to every new SQLite connection (see myapp.signals), and the lifetime of persistent connections
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -16000,
+}
+
+DATABASE_CONN_MAX_AGE = 0
@@ -1,3 +1,16 @@
 from .base import *
 DEBUG = False
 
+# SQLite performance profile
+# PRAGMAs applied to every new SQLite connection (see myapp.signals), and the lifetime of persistent connections
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -64000,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+}
+
+DATABASE_CONN_MAX_AGE = 600
@@ -0,0 +1,30 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+from .base import *
+
+# Test runs write the throttle counters, metrics and log to files of their own, never to the files
+# of a running server: the tests clear the stores and log on purpose
+
+TEST_STORE_DIR = tempfile.mkdtemp(prefix="accuknox-tests-")
+atexit.register(shutil.rmtree, TEST_STORE_DIR, ignore_errors=True)
+
+THROTTLE_STORE = {
+    **THROTTLE_STORE,
+    "LOCATION": os.path.join(TEST_STORE_DIR, "throttle.sqlite3"),
+}
+
+METRICS_STORE = os.path.join(TEST_STORE_DIR, "metrics.sqlite3")
+
+LOGGING = {
+    **LOGGING,
+    "handlers": {
+        **LOGGING["handlers"],
+        "file": {
+            **LOGGING["handlers"]["file"],
+            "filename": os.path.join(TEST_STORE_DIR, "warning.log"),
+        },
+    },
+}
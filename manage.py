@@ -6,6 +6,9 @@ import sys
 
 def main():
     """Run administrative tasks."""
+    if sys.argv[1:2] == ["test"]:
+        # Keep the tests away from the throttle and metrics files of the server
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Accuknox.settings.test")
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Accuknox.settings")
     try:
         from django.core.management import execute_from_command_line
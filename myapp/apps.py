@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class MyappConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "myapp"
+
+    def ready(self):
+        # Register the signal handlers and the system checks
+        from . import checks, signals  # noqa: F401
+        from .profiling import instrument_serializers
+
+        instrument_serializers()
@@ -0,0 +1,195 @@
+# async_views.py
+
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from rest_framework import exceptions
+from rest_framework.request import Request
+
+from .authentication import aauthenticate_request
+from .events import format_sse, get_event_hub, user_channel
+from .friend_cache import friend_cache
+from .models import Friendship, MyUser
+from .pagination import (
+    FriendshipKeysetPagination,
+    SortedIdPagination,
+    UserKeysetPagination,
+)
+from .routers import areplica_reads
+from .row_serializers import PendingRequestRowSerializer, UserRowSerializer
+from .search import NgramSearchFilter, user_index
+
+
+# Define a base class for native async read-only views
+class AsyncAPIView(View):
+    """
+    Serve GET requests on the event loop of an ASGI server, without the thread-pool hop
+    of the synchronous DRF views: authentication, the ORM and the caches are awaited.
+    Responses match the synchronous endpoints they mirror, errors included: an
+    APIException raised by a handler, such as an invalid cursor, becomes its status code
+    and detail, like DRF's exception handler.
+    """
+
+    pagination_class = None
+
+    async def dispatch(self, request, *args, **kwargs):
+        # Authenticate the request and require an authenticated user, like IsAuthenticated
+        try:
+            user = await aauthenticate_request(request)
+        except exceptions.AuthenticationFailed as e:
+            return self.unauthorized(str(e.detail))
+        if user is None:
+            return self.unauthorized("Authentication credentials were not provided.")
+
+        request.user = user
+        if self.pagination_class is not None:
+            self.paginator = self.pagination_class()
+
+        # Serve the reads from the replicas, unless the user wrote recently
+        try:
+            with await areplica_reads(user):
+                return await super().dispatch(request, *args, **kwargs)
+        except exceptions.APIException as e:
+            return self.error_response(e)
+
+    def unauthorized(self, detail):
+        return JsonResponse(
+            {"detail": detail}, status=401, headers={"WWW-Authenticate": "Bearer"}
+        )
+
+    def error_response(self, exc):
+        detail = exc.detail
+        if not isinstance(detail, (dict, list)):
+            detail = {"detail": detail}
+        return JsonResponse(detail, status=exc.status_code, safe=False)
+
+    def paginated_response(self, data):
+        return JsonResponse({"next": self.paginator.get_next_link(), "results": data})
+
+
+# Define an async view for user search requests
+class AsyncUserSearchView(AsyncAPIView):
+    pagination_class = UserKeysetPagination
+
+    # Define the fields to search for when a term is too short for the search index
+    search_fields = ["=email", "name__icontains"]
+
+    async def get(self, request):
+        request = Request(request)
+
+        # Load the users created, edited or deleted through other processes; the index only
+        # reads the users when the shared version or change feed moved
+        await user_index.arefresh()
+
+        queryset = NgramSearchFilter().filter_queryset(
+            request, MyUser.objects.all(), self
+        )
+        ordering = self.paginator.get_ordering(request, queryset, self)
+        page = await self.paginator.apaginate_queryset(
+            UserRowSerializer.values(queryset, ordering), request, self
+        )
+        return self.paginated_response(UserRowSerializer.serialize(page))
+
+
+# Define an async view for friend list requests
+class AsyncFriendListView(AsyncAPIView):
+    pagination_class = SortedIdPagination
+
+    async def get(self, request):
+        friend_ids = await friend_cache.aget_friend_ids(request.user.id)
+        page = self.paginator.paginate_queryset(friend_ids, Request(request), self)
+        return self.paginated_response([{"to_user": pk} for pk in page])
+
+
+# Define an async view for pending friend request list requests
+class AsyncPendingFriendRequestListView(AsyncAPIView):
+    pagination_class = FriendshipKeysetPagination
+
+    async def get(self, request):
+        queryset = Friendship.objects.filter(to_user=request.user, accepted=False)
+        request = Request(request)
+        ordering = self.paginator.get_ordering(request, queryset, self)
+        page = await self.paginator.apaginate_queryset(
+            PendingRequestRowSerializer.values(queryset, ordering), request, self
+        )
+        return self.paginated_response(PendingRequestRowSerializer.serialize(page))
+
+
+# Define a base class for the views pushing events to the authenticated user
+class AsyncEventView(AsyncAPIView):
+    def get_since(self, request):
+        # The id of the last event the client has seen, to get the newer ones it missed
+        since = request.headers.get("Last-Event-ID") or request.GET.get("since")
+        if since is None:
+            return None
+        try:
+            return int(since)
+        except ValueError:
+            raise exceptions.ValidationError({"since": "A valid integer is required."})
+
+
+# Define an async view streaming the events of the authenticated user as server-sent events
+class EventStreamView(AsyncEventView):
+    """
+    Keep the response open and write each event pushed to the user, such as a new
+    friend request or an accepted one, as it happens. A comment line is sent every
+    EVENTS_KEEPALIVE seconds, so proxies keep the idle connection open.
+
+    An idle stream holds no thread and no database connection, only a small
+    subscription waiting on the event loop, so it needs an ASGI server.
+    """
+
+    async def get(self, request):
+        subscription = get_event_hub().subscribe(
+            user_channel(request.user.id), self.get_since(request)
+        )
+        response = StreamingHttpResponse(
+            self.stream(subscription), content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        # Ask nginx not to buffer the stream
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    async def stream(self, subscription):
+        keepalive = getattr(settings, "EVENTS_KEEPALIVE", 15)
+        try:
+            # Send the headers at once, and the reconnection delay
+            yield "retry: 3000\n\n"
+            while True:
+                events = await subscription.get(timeout=keepalive)
+                if events:
+                    yield "".join(format_sse(event) for event in events)
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            # Reached when the client disconnects and the server cancels the response
+            subscription.close()
+
+
+# Define an async view answering long polls for the events of the authenticated user
+class EventPollView(AsyncEventView):
+    """
+    For clients that cannot use server-sent events: wait up to EVENTS_LONG_POLL_TIMEOUT
+    seconds, or ?timeout= when shorter, for events newer than ?since=, and return them
+    with the id to send as since in the next poll.
+    """
+
+    async def get(self, request):
+        since = self.get_since(request)
+        timeout = getattr(settings, "EVENTS_LONG_POLL_TIMEOUT", 25)
+        try:
+            timeout = min(float(request.GET.get("timeout", timeout)), timeout)
+        except ValueError:
+            raise exceptions.ValidationError({"timeout": "A valid number is required."})
+
+        subscription = get_event_hub().subscribe(user_channel(request.user.id), since)
+        try:
+            events = await subscription.get(timeout=max(timeout, 0))
+        finally:
+            subscription.close()
+        if events:
+            last_id = events[-1]["id"]
+        else:
+            last_id = get_event_hub().current_id() if since is None else since
+        return JsonResponse({"events": events, "last_id": last_id})
@@ -0,0 +1,287 @@
+# authentication.py
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.utils.crypto import constant_time_compare, salted_hmac
+from rest_framework import authentication, exceptions
+
+from .models import RevokedToken
+from .versions import bump_version, shared_cache
+
+TOKEN_SALT = "myapp.authentication.token"
+
+# Marks a token id in the registry as revoked
+REVOKED = object()
+
+
+def password_fingerprint(user):
+    # Return a short HMAC of the password hash, so changing the password invalidates issued tokens
+    return salted_hmac(TOKEN_SALT, user.password, algorithm="sha256").hexdigest()[:16]
+
+
+def get_signer():
+    return signing.TimestampSigner(salt=TOKEN_SALT)
+
+
+def token_epoch_key(user_id):
+    # Shared cache key of the time, in nanoseconds, before which the user's tokens are revoked
+    return f"token-epoch:{user_id}"
+
+
+def issue_token(user):
+    """
+    Return a signed token for the user, valid for TOKEN_MAX_AGE seconds.
+    """
+    payload = {
+        "u": user.pk,
+        "j": secrets.token_urlsafe(12),
+        "p": password_fingerprint(user),
+    }
+    return get_signer().sign_object(payload)
+
+
+# Define an in-process LRU of recently verified token ids
+class TokenRegistry:
+    """
+    Maps token ids to their authenticated user, or to REVOKED, for TOKEN_CACHE_TTL seconds.
+
+    A hit skips loading the user and checking revocations, so it makes no query.
+    Revocations are stored in the RevokedToken table until the token expires, and
+    password changes publish a token epoch per user in the shared cache, so every
+    worker process sees them on a miss: a token revoked through another process is
+    rejected within TOKEN_CACHE_TTL seconds, one revoked through this one at once.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token_id):
+        with self._lock:
+            entry = self._entries.get(token_id)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[token_id]
+                return None
+            self._entries.move_to_end(token_id)
+            return value
+
+    def set(self, token_id, value):
+        with self._lock:
+            self._entries[token_id] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(token_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard_user(self, user_id):
+        # Forget every token verified for the user, so they are checked again on next use
+        with self._lock:
+            for token_id, (value, _) in list(self._entries.items()):
+                if value is not REVOKED and value.pk == user_id:
+                    del self._entries[token_id]
+
+    def revoke_user(self, user_id):
+        """
+        Reject every token issued to the user until now, in every process. The epoch
+        stays valid when a replica still holds the old password hash of the user.
+        """
+        bump_version(token_epoch_key(user_id))
+        self.discard_user(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def revoke(self, token_id, expires_at):
+        """
+        Reject the token with the given id until ``expires_at``, a timestamp, in every
+        process. Revocations of tokens that have expired since are deleted.
+        """
+        now = datetime.now(timezone.utc)
+        RevokedToken.objects.bulk_create(
+            [
+                RevokedToken(
+                    token_id=token_id,
+                    expires_at=datetime.fromtimestamp(expires_at, timezone.utc),
+                )
+            ],
+            ignore_conflicts=True,
+        )
+        RevokedToken.objects.filter(expires_at__lt=now).delete()
+        self.set(token_id, REVOKED)
+
+    def revoked_by_epoch(self, payload, epoch):
+        # Compare whole seconds: the signing timestamp of the token has no finer precision
+        return epoch is not None and payload["iat"] < epoch // 10**9
+
+    def is_revoked(self, payload):
+        """
+        Return whether the token of a verified payload was revoked, by its id or by the
+        token epoch of its user. Called on a miss only.
+        """
+        epoch = shared_cache().get(token_epoch_key(payload["u"]))
+        if self.revoked_by_epoch(payload, epoch):
+            return True
+        # Read from the primary: a revocation must apply before a replica catches up
+        return (
+            RevokedToken.objects.using("default").filter(token_id=payload["j"]).exists()
+        )
+
+    async def ais_revoked(self, payload):
+        epoch = await shared_cache().aget(token_epoch_key(payload["u"]))
+        if self.revoked_by_epoch(payload, epoch):
+            return True
+        return await (
+            RevokedToken.objects.using("default")
+            .filter(token_id=payload["j"])
+            .aexists()
+        )
+
+
+token_registry = TokenRegistry(
+    max_size=getattr(settings, "TOKEN_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "TOKEN_CACHE_TTL", 60),
+)
+
+
+# Define an authentication class for the signed tokens issued by LoginView
+class SignedTokenAuthentication(authentication.BaseAuthentication):
+    """
+    Authenticates "Authorization: Bearer <token>" headers with an HMAC check, without
+    hashing a password, and reads the user from the database only once per token id
+    and TOKEN_CACHE_TTL seconds, together with its revocations. A request whose token
+    id was verified within that time makes no query.
+    """
+
+    keyword = "Bearer"
+
+    def get_token(self, request):
+        # Return the token of the Authorization header, or None if it holds another scheme
+        auth = authentication.get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed("Invalid token header.")
+
+        try:
+            return auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed("Invalid token header.")
+
+    def verify_token(self, token):
+        """
+        Return the payload of a token after checking its signature and age, with the
+        time it was issued at as "iat" and the time it expires at as "exp".
+        """
+        max_age = getattr(settings, "TOKEN_MAX_AGE", 86400)
+        try:
+            payload = get_signer().unsign_object(token, max_age=max_age)
+        except signing.SignatureExpired:
+            raise exceptions.AuthenticationFailed("Token has expired.")
+        except signing.BadSignature:
+            raise exceptions.AuthenticationFailed("Invalid token.")
+        # The token reads "<payload>:<timestamp>:<signature>"
+        payload["iat"] = signing.b62_decode(token.rsplit(":", 2)[1])
+        payload["exp"] = payload["iat"] + max_age
+        return payload
+
+    def authenticate(self, request):
+        token = self.get_token(request)
+        if token is None:
+            return None
+        return self.authenticate_credentials(token)
+
+    async def aauthenticate(self, request):
+        token = self.get_token(request)
+        if token is None:
+            return None
+        return await self.aauthenticate_credentials(token)
+
+    def authenticate_credentials(self, token):
+        payload = self.verify_token(token)
+        user = token_registry.get(payload["j"])
+        if user is None:
+            # Revocations made through other processes are checked once per entry lifetime
+            user = (
+                REVOKED
+                if token_registry.is_revoked(payload)
+                else self.load_user(payload)
+            )
+            token_registry.set(payload["j"], user)
+        if user is REVOKED:
+            raise exceptions.AuthenticationFailed("Token has been revoked.")
+
+        return (user, payload)
+
+    async def aauthenticate_credentials(self, token):
+        payload = self.verify_token(token)
+        user = token_registry.get(payload["j"])
+        if user is None:
+            user = (
+                REVOKED
+                if await token_registry.ais_revoked(payload)
+                else await self.aload_user(payload)
+            )
+            token_registry.set(payload["j"], user)
+        if user is REVOKED:
+            raise exceptions.AuthenticationFailed("Token has been revoked.")
+
+        return (user, payload)
+
+    def check_user(self, user, payload):
+        # Return the user, or REVOKED if the password changed since the token was issued
+        if not constant_time_compare(password_fingerprint(user), payload["p"]):
+            return REVOKED
+        return user
+
+    def load_user(self, payload):
+        # Return the user of the token, or REVOKED if the user is gone or the password changed
+        User = get_user_model()
+        try:
+            user = User.objects.get(pk=payload["u"], is_active=True)
+        except User.DoesNotExist:
+            return REVOKED
+        return self.check_user(user, payload)
+
+    async def aload_user(self, payload):
+        User = get_user_model()
+        try:
+            user = await User.objects.aget(pk=payload["u"], is_active=True)
+        except User.DoesNotExist:
+            return REVOKED
+        return self.check_user(user, payload)
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+async def aauthenticate_request(request):
+    """
+    Authenticate a plain Django request for the async views, trying the same schemes
+    as DEFAULT_AUTHENTICATION_CLASSES: signed token, then Basic, then the session.
+    Return the user, or None when no credentials were provided.
+    """
+    result = await SignedTokenAuthentication().aauthenticate(request)
+    if result is None:
+        # Basic authentication hashes the password, so run it in a worker thread
+        result = await sync_to_async(authentication.BasicAuthentication().authenticate)(
+            request
+        )
+    if result is not None:
+        return result[0]
+
+    user = await request.auser()
+    return user if user.is_authenticated else None
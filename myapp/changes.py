@@ -0,0 +1,99 @@
+# changes.py
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Friendship, FriendshipChange
+
+
+def log_changes(op, rows):
+    """
+    Append the entries of a change to friend requests (from user id, to user id, request
+    id) to the change log, one for each user, with one INSERT. ``op`` is SENT for new
+    requests, which the receivers get as RECEIVED, ACCEPTED or DELETED. Call it in the
+    transaction that changes the friendships, so both commit or roll back together.
+    """
+    peer_op = FriendshipChange.RECEIVED if op == FriendshipChange.SENT else op
+    entries = []
+    for from_id, to_id, request_id in rows:
+        entries.append(
+            FriendshipChange(user_id=from_id, peer=to_id, request=request_id, op=op)
+        )
+        entries.append(
+            FriendshipChange(
+                user_id=to_id, peer=from_id, request=request_id, op=peer_op
+            )
+        )
+    if entries:
+        FriendshipChange.objects.bulk_create(entries)
+
+
+def log_user_deleted(user_id):
+    # The friendships of a deleted user go with it, without a signal; tell the other users
+    FriendshipChange.objects.bulk_create(
+        FriendshipChange(
+            user_id=to_id if from_id == user_id else from_id,
+            peer=user_id,
+            request=request_id,
+            op=FriendshipChange.DELETED,
+        )
+        for request_id, from_id, to_id in Friendship.objects.filter(
+            Q(from_user=user_id) | Q(to_user=user_id)
+        ).values_list("id", "from_user", "to_user")
+    )
+
+
+def change_log_horizon():
+    """
+    Return the sequence number up to which the change log can be read, 0 when empty.
+
+    Sequence numbers are given at insert time, so on a database with concurrent writers
+    an entry can commit after one with a higher number. Readers stop at the newest entry
+    older than CHANGE_LOG_SETTLE_SECONDS, so no entry shows up behind their position.
+    SQLite serializes writers, so entries commit in order and there the delay is 0.
+    """
+    entries = FriendshipChange.objects.order_by("-seq")
+    settle = getattr(settings, "CHANGE_LOG_SETTLE_SECONDS", 0)
+    if settle:
+        entries = entries.filter(
+            changed_at__lte=timezone.now() - timedelta(seconds=settle)
+        )
+    return entries.values_list("seq", flat=True).first() or 0
+
+
+def change_log_start():
+    # Return the oldest sequence number still in the change log, or None when empty
+    return (
+        FriendshipChange.objects.order_by("seq").values_list("seq", flat=True).first()
+    )
+
+
+def compact_change_log(cutoff, batch_size=5000, pause=0):
+    """
+    Delete the entries of the change log older than the cutoff, oldest first, batch_size
+    rows per statement, and return the number deleted. The newest entry is always kept,
+    so readers can tell how far the log was trimmed.
+    """
+    newest = FriendshipChange.objects.order_by("-seq").values_list("seq", flat=True)
+    bound = newest.filter(changed_at__lt=cutoff).first()
+    if bound is None:
+        return 0
+    # Sequence numbers and times grow together, so the log is trimmed up to one entry
+    bound = min(bound, newest.first() - 1)
+    total = 0
+    while True:
+        seqs = list(
+            FriendshipChange.objects.filter(seq__lte=bound)
+            .order_by("seq")
+            .values_list("seq", flat=True)[:batch_size]
+        )
+        if seqs:
+            FriendshipChange.objects.filter(seq__lte=seqs[-1]).delete()
+        total += len(seqs)
+        if len(seqs) < batch_size:
+            return total
+        time.sleep(pause)
@@ -0,0 +1,46 @@
+# checks.py
+
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Cache backends whose entries only the process holding them can see
+PROCESS_LOCAL_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def is_process_local(alias):
+    return settings.CACHES.get(alias, {}).get("BACKEND") in PROCESS_LOCAL_CACHES
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    # The versions behind the ETags and cached searches must be the same in every worker
+    alias = getattr(settings, "SHARED_CACHE_ALIAS", "shared")
+    if is_process_local(alias):
+        return [
+            Error(
+                f"The {alias!r} cache must be shared by all worker processes.",
+                hint="Use the database, Redis or Memcached cache backend.",
+                id="myapp.E001",
+            )
+        ]
+    return []
+
+
+@register(Tags.caches)
+def check_session_cache(app_configs, **kwargs):
+    # Write-behind sessions are only in the cache until flushed, so every worker must see it
+    alias = getattr(settings, "SESSION_CACHE_ALIAS", "default")
+    if settings.SESSION_ENGINE == "myapp.sessions" and is_process_local(alias):
+        return [
+            Error(
+                f"Write-behind sessions need the {alias!r} cache to be shared by all "
+                "worker processes.",
+                hint="Point SESSION_CACHE_BACKEND at Redis or Memcached, or set "
+                "SESSION_STORAGE to 'db' or 'signed_cookies'.",
+                id="myapp.E002",
+            )
+        ]
+    return []
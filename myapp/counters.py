@@ -0,0 +1,77 @@
+# counters.py
+
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Greatest
+
+from .models import Friendship, MyUser
+from .search import publish_counter_changes
+
+
+def adjust_counts(friends=None, pending=None):
+    """
+    Add {user id: delta} to the friend and pending-request counters of users, with one
+    UPDATE per counter and distinct delta, computed by the database from the current
+    value. Call it in the transaction that changes the friendships, so both commit or
+    roll back together. The cached searches showing the users are dropped on commit.
+    """
+    changed = set()
+    for field, deltas in (("friend_count", friends), ("pending_count", pending)):
+        user_ids_by_delta = defaultdict(list)
+        for user_id, delta in (deltas or {}).items():
+            if delta:
+                user_ids_by_delta[delta].append(user_id)
+                changed.add(user_id)
+        for delta, user_ids in user_ids_by_delta.items():
+            value = F(field) + delta
+            if delta < 0:
+                # A counter that drifted stops at zero until reconcile_counters fixes it
+                value = Greatest(value, 0)
+            MyUser.objects.filter(pk__in=user_ids).update(**{field: value})
+    if changed:
+        transaction.on_commit(lambda: publish_counter_changes(sorted(changed)))
+
+
+def forget_user_counts(user_id):
+    """
+    Take the friendships of a user about to be deleted off the counters of the other
+    users: one friend less for each friend, and one pending request less for each user
+    with a pending request from them. The cascade deletes the rows without a signal.
+    """
+    friends, pending = Counter(), Counter()
+    rows = Friendship.objects.filter(
+        Q(from_user=user_id) | Q(to_user=user_id, accepted=True)
+    ).values_list("from_user", "to_user", "accepted")
+    for from_id, to_id, accepted in rows:
+        if accepted:
+            friends[to_id if from_id == user_id else from_id] -= 1
+        else:
+            pending[to_id] -= 1
+    adjust_counts(friends=friends, pending=pending)
+
+
+def count_friendships(user_ids):
+    """
+    Return ({user id: friends}, {user id: pending requests received}) for the users,
+    counted from the Friendship table.
+    """
+    friends, pending = Counter(), Counter()
+    for field in ("from_user", "to_user"):
+        rows = (
+            Friendship.objects.filter(**{f"{field}__in": user_ids}, accepted=True)
+            .values(field)
+            .annotate(count=Count("pk"))
+            .values_list(field, "count")
+        )
+        for user_id, count in rows:
+            friends[user_id] += count
+    rows = (
+        Friendship.objects.filter(to_user__in=user_ids, accepted=False)
+        .values("to_user")
+        .annotate(count=Count("pk"))
+        .values_list("to_user", "count")
+    )
+    pending.update(dict(rows))
+    return friends, pending
@@ -0,0 +1,249 @@
+# events.py
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+# Event types pushed to the users
+FRIEND_REQUEST = "friend_request"
+FRIEND_REQUEST_ACCEPTED = "friend_request_accepted"
+
+
+def user_channel(user_id):
+    return f"user:{user_id}"
+
+
+# Define the subscription of one client to a channel of the event hub
+class Subscription:
+    """
+    Buffers the events of a channel until the client reads them. A worker holds one per
+    open stream, so it is kept small: a bounded deque, and a future only while the
+    client is waiting. When more than ``max_events`` are unread, the oldest are dropped.
+    """
+
+    __slots__ = ("hub", "channel", "loop", "events", "waiter")
+
+    def __init__(self, hub, channel, loop, max_events):
+        self.hub = hub
+        self.channel = channel
+        self.loop = loop
+        self.events = deque(maxlen=max_events)
+        self.waiter = None
+
+    def deliver(self, event):
+        # Runs on the event loop of the subscription
+        self.events.append(event)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self, timeout=None):
+        """
+        Return the events received since the last call, waiting up to ``timeout``
+        seconds for one when there are none; return [] on timeout.
+        """
+        if not self.events:
+            self.waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            except asyncio.TimeoutError:
+                return []
+            finally:
+                self.waiter = None
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+# Define a publish/subscribe hub delivering events to the subscriptions of the process
+class InProcessEventHub:
+    """
+    publish() may be called from any thread, e.g. from the on_commit callbacks of the
+    synchronous views: each event is handed over to the event loop of every subscriber
+    with call_soon_threadsafe, so subscribers never poll.
+
+    The last ``history_size`` events of each channel are kept for ``history_ttl``
+    seconds, so a client reconnecting, or polling again, gets what it missed meanwhile.
+
+    Events only reach the subscribers of the current process. To share them between
+    processes, a subclass sends them to the other processes in publish(), and each
+    process passes the events it receives to deliver(); see RedisEventHub.
+    """
+
+    def __init__(self, history_size=20, history_ttl=60, max_events=100):
+        self.history_size = history_size
+        self.history_ttl = history_ttl
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._subscriptions = {}
+            self._history = {}
+            self._last_id = 0
+            self._next_sweep = time.monotonic() + self.history_ttl
+
+    def next_id(self):
+        # Ids follow the clock, so they keep growing across restarts and between processes
+        with self._lock:
+            self._last_id = max(self._last_id + 1, time.time_ns() // 1000)
+            return self._last_id
+
+    def current_id(self):
+        # An id no later event can have, to poll for the events from now on
+        with self._lock:
+            return max(self._last_id, time.time_ns() // 1000)
+
+    def publish(self, channel, type, data):
+        event = {"id": self.next_id(), "type": type, "data": data}
+        self.deliver(channel, event)
+        return event
+
+    def deliver(self, channel, event):
+        now = time.monotonic()
+        with self._lock:
+            history = self._history.get(channel)
+            if history is None:
+                history = self._history[channel] = deque(maxlen=self.history_size)
+            history.append((now, event))
+            subscriptions = list(self._subscriptions.get(channel, ()))
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError:
+                # The loop of the subscription is closed
+                self.unsubscribe(subscription)
+
+    def _sweep(self, now):
+        # Drop the histories whose newest event has expired
+        expired = now - self.history_ttl
+        for channel in [c for c, h in self._history.items() if h[-1][0] < expired]:
+            del self._history[channel]
+        self._next_sweep = now + self.history_ttl
+
+    def subscribe(self, channel, since=None):
+        """
+        Subscribe the running event loop to a channel. With ``since``, the events of the
+        history newer than that id are ready to be read at once.
+        """
+        subscription = Subscription(
+            self, channel, asyncio.get_running_loop(), self.max_events
+        )
+        expired = time.monotonic() - self.history_ttl
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+            if since is not None:
+                subscription.events.extend(
+                    event
+                    for published, event in self._history.get(channel, ())
+                    if published >= expired and event["id"] > since
+                )
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscriptions.values())
+
+
+# Define an event hub sharing events between processes through Redis pub/sub
+class RedisEventHub(InProcessEventHub):
+    """
+    Publishes every event to one Redis channel. Each process runs a listener thread,
+    started with its first subscription, which delivers the events to the local
+    subscribers and history.
+    """
+
+    redis_channel = "myapp-events"
+
+    def __init__(self, location, **options):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured(
+                "RedisEventHub requires the 'redis' package to be installed."
+            )
+        hub_options = {
+            name: options.pop(name)
+            for name in ("history_size", "history_ttl", "max_events")
+            if name in options
+        }
+        super().__init__(**hub_options)
+        self.client = redis.Redis.from_url(location, **options)
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def publish(self, channel, type, data):
+        event = {"id": self.next_id(), "type": type, "data": data}
+        self.client.publish(self.redis_channel, json.dumps([channel, event]))
+        return event
+
+    def subscribe(self, channel, since=None):
+        self._ensure_listener()
+        return super().subscribe(channel, since)
+
+    def _ensure_listener(self):
+        # Threads do not survive a fork, so every worker starts its own listener
+        if self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.redis_channel)
+            threading.Thread(
+                target=self._listen, args=(pubsub,), name="event-hub", daemon=True
+            ).start()
+            self._listener_pid = os.getpid()
+
+    def _listen(self, pubsub):
+        for message in pubsub.listen():
+            channel, event = json.loads(message["data"])
+            self.deliver(channel, event)
+
+
+_hub = None
+_hub_lock = threading.Lock()
+
+
+def get_event_hub():
+    # Return the hub configured by the EVENT_HUB setting, created on first use
+    global _hub
+    if _hub is None:
+        with _hub_lock:
+            if _hub is None:
+                config = dict(settings.EVENT_HUB)
+                backend = import_string(config.pop("BACKEND"))
+                args = [config.pop("LOCATION")] if config.get("LOCATION") else []
+                _hub = backend(*args, **config.pop("OPTIONS", {}))
+    return _hub
+
+
+def notify_user(user_id, type, data):
+    # Push an event to the streams and long polls of a user; call it once the change is committed
+    get_event_hub().publish(user_channel(user_id), type, data)
+
+
+def format_sse(event):
+    # Return an event in the text/event-stream format
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
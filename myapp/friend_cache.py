@@ -0,0 +1,172 @@
+# friend_cache.py
+
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+
+from .models import Friendship
+
+
+# Define a cache of the sorted friend ids of each user
+class FriendCache:
+    """
+    Stores, per user id, the ascending ids of the user's accepted friends as a packed
+    array of 64-bit integers.
+
+    The storage is the Django cache named by the FRIEND_CACHE_ALIAS setting, so any
+    cache backend can be used: LocMem for a single process, file-based for several
+    processes on one host, or Redis/Memcached for several hosts. Entries are loaded
+    from the database on a miss and then updated in place whenever a friendship is
+    accepted or removed; the cache TIMEOUT bounds how long a lost concurrent update
+    can go unnoticed.
+
+    Each entry is stored with the relationship version it was loaded at, when known.
+    A reader holding the current version, such as a list tagged with it, reloads an
+    entry of another version: with a per-process cache, the entry may predate a change
+    made through another worker.
+    """
+
+    key_prefix = "friends"
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, "FRIEND_CACHE_ALIAS", "default")]
+
+    def make_key(self, user_id):
+        return f"{self.key_prefix}:{user_id}"
+
+    def get_queryset(self, user_id):
+        # Load from the primary, so a lagging replica cannot leave a stale entry in the cache
+        return (
+            Friendship.objects.using("default")
+            .filter(Q(from_user=user_id) | Q(to_user=user_id), accepted=True)
+            .values_list("from_user", "to_user")
+        )
+
+    def to_array(self, user_id, rows):
+        return array(
+            "q",
+            sorted(
+                {to_id if from_id == user_id else from_id for from_id, to_id in rows}
+            ),
+        )
+
+    def unpack(self, packed):
+        friend_ids = array("q")
+        friend_ids.frombytes(packed)
+        return friend_ids
+
+    def load(self, user_id):
+        # Read the friend ids of a user from the database
+        return self.to_array(user_id, self.get_queryset(user_id))
+
+    async def aload(self, user_id):
+        # values_list().aiterator() runs its query synchronously on Django 5.0, so fetch the queryset instead
+        rows = [row async for row in self.get_queryset(user_id)]
+        return self.to_array(user_id, rows)
+
+    def get_friend_ids(self, user_id, version=None):
+        """
+        Return the ascending friend ids of a user, reading the database only on a miss,
+        or when ``version`` is given and the entry was loaded at another one.
+        """
+        entry = self.cache.get(self.make_key(user_id))
+        if entry is not None and version in (None, entry[0]):
+            return self.unpack(entry[1])
+
+        friend_ids = self.load(user_id)
+        self.cache.set(self.make_key(user_id), (version, friend_ids.tobytes()))
+        return friend_ids
+
+    def get_many_friend_ids(self, user_ids):
+        """
+        Return {user id: ascending friend ids} for many users, with one cache round trip
+        and a single query for all the users missing from the cache.
+        """
+        keys = {self.make_key(user_id): user_id for user_id in user_ids}
+        friend_ids = {
+            keys[key]: self.unpack(packed)
+            for key, (_, packed) in self.cache.get_many(list(keys)).items()
+        }
+
+        missing = [user_id for user_id in keys.values() if user_id not in friend_ids]
+        if missing:
+            rows = {user_id: [] for user_id in missing}
+            queryset = (
+                Friendship.objects.using("default")
+                .filter(
+                    Q(from_user__in=missing) | Q(to_user__in=missing), accepted=True
+                )
+                .values_list("from_user", "to_user")
+            )
+            for from_id, to_id in queryset:
+                for user_id in (from_id, to_id):
+                    if user_id in rows:
+                        rows[user_id].append((from_id, to_id))
+            for user_id, user_rows in rows.items():
+                friend_ids[user_id] = self.to_array(user_id, user_rows)
+            self.cache.set_many(
+                {
+                    self.make_key(user_id): (None, friend_ids[user_id].tobytes())
+                    for user_id in missing
+                }
+            )
+        return friend_ids
+
+    async def aget_friend_ids(self, user_id):
+        entry = await self.cache.aget(self.make_key(user_id))
+        if entry is not None:
+            return self.unpack(entry[1])
+
+        friend_ids = await self.aload(user_id)
+        await self.cache.aset(self.make_key(user_id), (None, friend_ids.tobytes()))
+        return friend_ids
+
+    def _update(self, user_id, friend_id, add):
+        # Update a cached entry in place; a user without an entry is loaded on next read
+        key = self.make_key(user_id)
+        entry = self.cache.get(key)
+        if entry is None:
+            return
+        version, packed = entry
+        friend_ids = self.unpack(packed)
+        position = bisect_left(friend_ids, friend_id)
+        present = position < len(friend_ids) and friend_ids[position] == friend_id
+        if add and not present:
+            friend_ids.insert(position, friend_id)
+        elif not add and present:
+            del friend_ids[position]
+        else:
+            return
+        # The version bump that follows the change retags the entry with the new version
+        self.cache.set(key, (version, friend_ids.tobytes()))
+
+    def retag(self, user_id, previous, version):
+        # Mark an entry loaded at the previous version, and since updated in place, as current
+        key = self.make_key(user_id)
+        entry = self.cache.get(key)
+        if entry is not None and previous is not None and entry[0] == previous:
+            self.cache.set(key, (version, entry[1]))
+
+    def add_friendship(self, user_id, friend_id):
+        self._update(user_id, friend_id, add=True)
+        self._update(friend_id, user_id, add=True)
+
+    def add_friendships(self, user_id, friend_ids):
+        # The user's entry is reloaded on next read, instead of rewritten once per new friend
+        self.invalidate(user_id)
+        for friend_id in friend_ids:
+            self._update(friend_id, user_id, add=True)
+
+    def remove_friendship(self, user_id, friend_id):
+        self._update(user_id, friend_id, add=False)
+        self._update(friend_id, user_id, add=False)
+
+    def invalidate(self, *user_ids):
+        self.cache.delete_many([self.make_key(user_id) for user_id in user_ids])
+
+
+friend_cache = FriendCache()
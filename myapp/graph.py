@@ -0,0 +1,244 @@
+# graph.py
+
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+from django.conf import settings
+
+from .models import Friendship, canonical_pair
+from .versions import feed_position, publish_changes, read_changes
+
+# Shared change feed of the [user id, friend id] pairs of accepted or removed friendships
+GRAPH_CHANGES_KEY = "friend-graph-changes"
+
+
+# Define an in-process graph of the accepted friendships, in compressed sparse row form
+class FriendGraph:
+    """
+    Holds the friends of every user as one sorted slice of a packed ``neighbors`` array:
+    the friends of ``node_ids[i]`` are ``neighbors[offsets[i]:offsets[i + 1]]``. That
+    takes 8 bytes per friendship direction and 16 bytes per user, instead of a Python
+    set per user.
+
+    Friendships accepted or removed after the build are kept in small per-user overlays
+    and merged into the arrays once there are more than ``compact_threshold`` of them.
+    Like the search index, the graph is built lazily from the database on first use,
+    kept up to date by the Friendship signal handlers, and lives in the memory of the
+    current process only. The handlers also publish the changed pairs to a shared
+    change feed, which refresh() reads before suggestions are served: the pairs changed
+    through other processes are read again from the database, in one query.
+    """
+
+    def __init__(self, compact_threshold=10000):
+        self.compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        # Drop the graph; it is rebuilt from the database on next use
+        with self._lock:
+            self._set_arrays([])
+            self._built = False
+            self._position = None
+
+    @property
+    def built(self):
+        return self._built
+
+    def ensure_built(self):
+        # Build the graph from the database unless it is already built
+        if self._built:
+            return
+        with self._lock:
+            if self._built:
+                return
+            # The feed position is read before the rows, so a change made meanwhile is read again
+            self._position = feed_position(GRAPH_CHANGES_KEY)
+            # Build from the primary, like the search index
+            rows = (
+                Friendship.objects.using("default")
+                .filter(accepted=True)
+                .values_list("from_user", "to_user")
+            )
+            self._set_arrays(
+                edge
+                for from_id, to_id in rows.iterator(chunk_size=10000)
+                for edge in ((from_id, to_id), (to_id, from_id))
+            )
+            self._built = True
+
+    def refresh(self):
+        # Bring the graph up to date with the friendships changed through every process
+        with self._lock:
+            if not self._built:
+                self.ensure_built()
+                return
+            changed, position = read_changes(GRAPH_CHANGES_KEY, self._position)
+            if changed is None:
+                self.reset()
+                self.ensure_built()
+                return
+            if changed:
+                pairs = {canonical_pair(*pair) for pair in changed}
+                # Read from the primary, as the build does
+                accepted = set(
+                    Friendship.objects.using("default")
+                    .filter(
+                        accepted=True,
+                        user_low__in={low for low, _ in pairs},
+                        user_high__in={high for _, high in pairs},
+                    )
+                    .values_list("user_low", "user_high")
+                )
+                for user_low, user_high in pairs:
+                    self._update(
+                        user_low, user_high, add=(user_low, user_high) in accepted
+                    )
+            self._position = position
+
+    def _set_arrays(self, edges):
+        # Lay out directed (user, friend) edges as sorted rows; duplicates are dropped
+        shift = 64
+        keys = sorted({(user_id << shift) | friend_id for user_id, friend_id in edges})
+        mask = (1 << shift) - 1
+
+        self._node_ids = array("q")
+        self._offsets = array("q", [0])
+        self._neighbors = array("q")
+        for key in keys:
+            user_id, friend_id = key >> shift, key & mask
+            if not self._node_ids or self._node_ids[-1] != user_id:
+                if self._node_ids:
+                    self._offsets.append(len(self._neighbors))
+                self._node_ids.append(user_id)
+            self._neighbors.append(friend_id)
+        if self._node_ids:
+            self._offsets.append(len(self._neighbors))
+
+        self._added = {}
+        self._removed = {}
+        self._changes = 0
+
+    def _base_neighbors(self, user_id):
+        # A memoryview slice, so even the rows of users with many friends are not copied
+        i = bisect_left(self._node_ids, user_id)
+        if i == len(self._node_ids) or self._node_ids[i] != user_id:
+            return memoryview(self._neighbors)[0:0]
+        return memoryview(self._neighbors)[self._offsets[i] : self._offsets[i + 1]]
+
+    def _in_base(self, user_id, friend_id):
+        base = self._base_neighbors(user_id)
+        i = bisect_left(base, friend_id)
+        return i < len(base) and base[i] == friend_id
+
+    def neighbors(self, user_id):
+        # Return the friend ids of a user, with the changes since the last compaction applied
+        base = self._base_neighbors(user_id)
+        removed = self._removed.get(user_id)
+        added = self._added.get(user_id)
+        if not removed and not added:
+            return base
+        friends = [friend_id for friend_id in base if friend_id not in (removed or ())]
+        return friends + sorted(added or ())
+
+    def degree(self, user_id):
+        i = bisect_left(self._node_ids, user_id)
+        if i == len(self._node_ids) or self._node_ids[i] != user_id:
+            return len(self._added.get(user_id, ()))
+        base = self._offsets[i + 1] - self._offsets[i]
+        return (
+            base
+            + len(self._added.get(user_id, ()))
+            - len(self._removed.get(user_id, ()))
+        )
+
+    def _change(self, user_id, friend_id, add):
+        added = self._added.setdefault(user_id, set())
+        removed = self._removed.setdefault(user_id, set())
+        if add:
+            if friend_id in removed:
+                removed.discard(friend_id)
+            elif not self._in_base(user_id, friend_id):
+                added.add(friend_id)
+        else:
+            if friend_id in added:
+                added.discard(friend_id)
+            elif self._in_base(user_id, friend_id):
+                removed.add(friend_id)
+        self._changes += 1
+
+    def _update(self, user_id, friend_id, add):
+        # Apply a change in both directions; ignored until the graph has been built
+        with self._lock:
+            if not self._built:
+                return
+            self._change(user_id, friend_id, add)
+            self._change(friend_id, user_id, add)
+            if self._changes > self.compact_threshold:
+                self.compact()
+
+    def add_friendship(self, user_id, friend_id):
+        self._update(user_id, friend_id, add=True)
+
+    def remove_friendship(self, user_id, friend_id):
+        self._update(user_id, friend_id, add=False)
+
+    def compact(self):
+        # Merge the overlays into the arrays
+        with self._lock:
+            node_ids = set(self._node_ids) | set(self._added)
+            self._set_arrays(
+                (user_id, friend_id)
+                for user_id in node_ids
+                for friend_id in self.neighbors(user_id)
+            )
+
+    def suggest(self, user_id, scan_limit=100000):
+        """
+        Yield (candidate id, mutual friend count) for the friends of the user's friends,
+        most mutual friends first and then by id, skipping the user and their friends.
+
+        At most ``scan_limit`` friend-of-friend edges are visited. Friends are visited
+        from the fewest friends to the most, so the limit cuts off the large hubs, which
+        say the least about who the user knows.
+        """
+        self.refresh()
+        with self._lock:
+            friends = self.neighbors(user_id)
+            excluded = set(friends)
+            excluded.add(user_id)
+
+            counts = {}
+            remaining = scan_limit
+            for friend_id in sorted(friends, key=self.degree):
+                if remaining <= 0:
+                    break
+                friends_of_friend = self.neighbors(friend_id)
+                for candidate in islice(friends_of_friend, remaining):
+                    if candidate not in excluded:
+                        counts[candidate] = counts.get(candidate, 0) + 1
+                remaining -= len(friends_of_friend)
+
+        # Rank lazily: callers usually need only the first few candidates
+        start, window = 0, 64
+        while True:
+            ranked = heapq.nsmallest(
+                window, counts.items(), key=lambda c: (-c[1], c[0])
+            )
+            yield from ranked[start:]
+            if len(ranked) < window:
+                return
+            start, window = window, window * 2
+
+
+def publish_graph_changes(pairs):
+    # Tell the graph of every process to read the friendships of the pairs again
+    publish_changes(GRAPH_CHANGES_KEY, [list(pair) for pair in pairs])
+
+
+friend_graph = FriendGraph(
+    compact_threshold=getattr(settings, "FRIEND_GRAPH_COMPACT_THRESHOLD", 10000)
+)
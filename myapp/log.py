@@ -0,0 +1,240 @@
+# log.py
+
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+
+from django.utils.functional import SimpleLazyObject, empty
+
+# The Django request being served by the current thread or task, set by RequestIdMiddleware
+current_request = ContextVar("current_request", default=None)
+
+# Attributes every LogRecord has; any other attribute was passed in ``extra``
+RECORD_ATTRIBUTES = frozenset(
+    vars(logging.LogRecord("", logging.INFO, "", 0, "", (), None))
+) | {"message", "asctime", "request_id", "user_id"}
+
+# Sentinel telling the writer thread to stop
+STOP = object()
+
+
+def request_ids():
+    """
+    Return (request id, user id) of the request being served, or (None, None).
+
+    The user id is only known once the user has been authenticated: an unresolved lazy
+    user is left alone, so logging never runs a session or token query.
+    """
+    request = current_request.get()
+    if request is None:
+        return None, None
+    user = request.__dict__.get("user")
+    if isinstance(user, SimpleLazyObject):
+        user = None if user._wrapped is empty else user._wrapped
+    user_id = (
+        getattr(user, "pk", None) if getattr(user, "is_authenticated", False) else None
+    )
+    return getattr(request, "request_id", None), user_id
+
+
+# Define a formatter writing each record as one line of JSON
+class JSONFormatter(logging.Formatter):
+    """
+    Write the time, level, logger, message, request id and user id of a record, its
+    traceback if any, and every field passed in ``extra``, as a JSON object.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "user_id": getattr(record, "user_id", None),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+# Define a size-rotated file handler writing a batch of records with a single flush
+class BatchRotatingFileHandler(RotatingFileHandler):
+    def emit_batch(self, records):
+        with self.lock:
+            for record in records:
+                try:
+                    line = self.format(record) + self.terminator
+                    if self.stream is None:
+                        self.stream = self._open()
+                    position = self.stream.tell()
+                    size = len(line.encode(self.encoding or "utf-8"))
+                    if (
+                        self.maxBytes > 0
+                        and position
+                        and position + size > self.maxBytes
+                    ):
+                        self.doRollover()
+                        if self.stream is None:
+                            self.stream = self._open()
+                    self.stream.write(line)
+                except Exception:
+                    self.handleError(record)
+            if self.stream is not None:
+                self.stream.flush()
+
+
+# Define a logging handler that never blocks the thread logging a record
+class QueueFileHandler(logging.Handler):
+    """
+    Put records on a bounded queue, and write them as JSON lines from a background
+    thread, to a file rotated every ``max_bytes`` with ``backup_count`` old files kept.
+
+    The writer takes every record waiting in the queue, up to ``batch_size``, and
+    flushes the file once per batch. When the queue is full the record is dropped and
+    counted, in ``dropped`` and in the myapp_log_records_dropped_total metric, so a
+    slow disk slows down the log file instead of the requests. The logging thread only
+    bumps an in-memory counter; the writer adds it to the metric after each batch.
+
+    The message is formatted and the request and user ids are read on the logging
+    thread, before the record is queued, so the writer sees the values of that moment.
+    """
+
+    def __init__(
+        self,
+        filename,
+        max_bytes=10 * 1024 * 1024,
+        backup_count=5,
+        queue_size=10000,
+        batch_size=500,
+        level=logging.NOTSET,
+    ):
+        super().__init__(level)
+        self.writer = BatchRotatingFileHandler(
+            filename,
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+            delay=True,
+        )
+        self.writer.setFormatter(JSONFormatter())
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.dropped = 0
+        # Records dropped by logger since the writer last added them to the metric
+        self._unpublished_drops = Counter()
+        self._drops_lock = threading.Lock()
+        self.queue = queue.Queue(queue_size)
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        # The writer thread formats the lines
+        self.writer.setFormatter(fmt)
+
+    def _ensure_writer(self):
+        # Threads do not survive a fork, so a forked worker starts its own writer
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                self.queue = queue.Queue(self.queue_size)
+            self._thread = threading.Thread(
+                target=self._run, args=(self.queue,), name="log-writer", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, records):
+        while True:
+            batch = [records.get()]
+            while batch[-1] is not STOP and len(batch) < self.batch_size:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is STOP
+            self.writer.emit_batch([record for record in batch if record is not STOP])
+            # A record was dropped only while the queue was full, so a batch always follows
+            self.publish_drops()
+            for _ in batch:
+                records.task_done()
+            if stop:
+                return
+
+    def publish_drops(self):
+        with self._drops_lock:
+            drops, self._unpublished_drops = self._unpublished_drops, Counter()
+        if not drops:
+            return
+        # Imported here, as logging is configured before the apps are loaded
+        from .metrics import log_records_dropped_total
+
+        for name, count in drops.items():
+            try:
+                log_records_dropped_total.inc(count, logger=name)
+            except Exception:
+                # Keep the count for the next batch
+                with self._drops_lock:
+                    self._unpublished_drops[name] += count
+
+    def prepare(self, record):
+        # Render the message and traceback now, as the arguments may change or go away
+        request_id, user_id = request_ids()
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.writer.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        record.request_id = request_id
+        record.user_id = user_id
+        return record
+
+    def emit(self, record):
+        try:
+            self._ensure_writer()
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            try:
+                with self._drops_lock:
+                    self.dropped += 1
+                    self._unpublished_drops[record.name] += 1
+            except Exception:
+                self.handleError(record)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        # Wait until the writer has written every queued record
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.put(STOP)
+            self._thread.join(timeout=5)
+        self._pid = None
+        self.writer.close()
+        super().close()
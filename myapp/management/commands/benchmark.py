@@ -0,0 +1,355 @@
+import json
+import random
+import statistics
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from myapp.authentication import issue_token
+from myapp.models import Friendship
+from myapp.urls import urlpatterns
+
+User = get_user_model()
+
+BENCH_EMAIL = "bench-user-{}@example.com"
+BENCH_PASSWORD = "bench-password"
+NAMES = ["Alice", "Bob", "Carol", "Dave", "Erin", "Frank", "Grace", "Heidi", "Ivan"]
+
+
+# Define a command seeding a synthetic social graph and load-testing every endpoint
+class Command(BaseCommand):
+    help = (
+        "Seed a synthetic social graph with bulk inserts, then call every route of "
+        "myapp.urls concurrently and report throughput, latency percentiles and query "
+        "counts per endpoint as JSON. Writes to the configured database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10000)
+        parser.add_argument(
+            "--alpha",
+            type=float,
+            default=1.5,
+            help="Pareto shape of the friend-count distribution (lower is more skewed).",
+        )
+        parser.add_argument("--max-degree", type=int, default=5000)
+        parser.add_argument(
+            "--pending-ratio",
+            type=float,
+            default=0.2,
+            help="Share of the seeded friendships left pending.",
+        )
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--skip-seed",
+            action="store_true",
+            help="Reuse the users and friendships seeded by a previous run.",
+        )
+        parser.add_argument("--output", help="Write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options["seed"])
+        if not options["skip_seed"]:
+            self.seed_users(options)
+            self.seed_friendships(options)
+
+        context = self.build_context()
+        report = {"config": {**options, "seeded_users": len(context["users"])}}
+        report["endpoints"] = self.run(context, options)
+
+        output = json.dumps(report, indent=2, sort_keys=True, default=str)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    # Seeding
+
+    def seed_users(self, options):
+        # Hash the shared password once instead of once per user
+        password = make_password(BENCH_PASSWORD)
+        start = User.objects.filter(email__startswith="bench-user-").count()
+        batch = []
+        for i in range(start, options["users"]):
+            email = BENCH_EMAIL.format(i)
+            batch.append(
+                User(
+                    email=email,
+                    username=email,
+                    password=password,
+                    name=f"{self.random.choice(NAMES)} {i}",
+                )
+            )
+            if len(batch) >= options["batch_size"]:
+                User.objects.bulk_create(batch)
+                batch = []
+        User.objects.bulk_create(batch)
+
+    def seed_friendships(self, options):
+        user_ids = list(
+            User.objects.filter(email__startswith="bench-user-")
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        count = len(user_ids)
+        if count < 2:
+            return
+
+        batch, pairs = [], set()
+        for user_id in user_ids:
+            # Power-law friend counts, with targets skewed towards a few popular users
+            degree = min(
+                int(self.random.paretovariate(options["alpha"])), options["max_degree"]
+            )
+            for _ in range(degree):
+                friend_id = user_ids[int(count * self.random.random() ** 3)]
+                pair = (min(user_id, friend_id), max(user_id, friend_id))
+                if friend_id == user_id or pair in pairs:
+                    continue
+                pairs.add(pair)
+                batch.append(
+                    Friendship(
+                        from_user_id=user_id,
+                        to_user_id=friend_id,
+                        accepted=self.random.random() >= options["pending_ratio"],
+                    )
+                )
+            if len(batch) >= options["batch_size"]:
+                Friendship.objects.bulk_create(batch, ignore_conflicts=True)
+                batch, pairs = [], set()
+        Friendship.objects.bulk_create(batch, ignore_conflicts=True)
+
+    # Load generation
+
+    def build_context(self):
+        users = list(User.objects.filter(email__startswith="bench-user-"))
+        pending = list(
+            Friendship.objects.filter(
+                accepted=False, from_user__email__startswith="bench-user-"
+            ).values_list("id", "from_user", "to_user")
+        )
+        self.random.shuffle(pending)
+        return {
+            "users": users,
+            "users_by_id": {user.id: user for user in users},
+            "tokens": {user.id: issue_token(user) for user in users[:1000]},
+            "accept": pending[: len(pending) // 2],
+            "reject": pending[len(pending) // 2 :],
+        }
+
+    def request_builders(self):
+        """
+        Map each url name to a function returning (method, path, data, user) for the
+        n-th request of that endpoint; user is None for anonymous requests.
+        """
+
+        def any_user(context):
+            return self.random.choice(context["users"][:1000])
+
+        def search(name):
+            return lambda context, n: (
+                "get",
+                reverse(name),
+                {"search": self.random.choice(NAMES).lower()[:3]},
+                any_user(context),
+            )
+
+        def list_view(name):
+            return lambda context, n: ("get", reverse(name), {}, any_user(context))
+
+        def accept(context, n):
+            if n >= len(context["accept"]):
+                return None
+            request_id, _, to_user = context["accept"][n]
+            url = reverse("accept-friend-request", args=[request_id])
+            return "post", url, {}, context["users_by_id"].get(to_user)
+
+        def reject(context, n):
+            if n >= len(context["reject"]):
+                return None
+            _, from_user, to_user = context["reject"][n]
+            url = reverse("reject-request", args=[to_user])
+            return "delete", url, {}, context["users_by_id"].get(from_user)
+
+        def bulk(name, requests, user_index):
+            # Take the requests from the end of the list, away from the single accepts and rejects
+            def build(context, n):
+                if n >= len(context[requests]):
+                    return None
+                row = context[requests][-n - 1]
+                user = context["users_by_id"].get(row[user_index])
+                return "post", reverse(name), {"ids": [row[0]]}, user
+
+            return build
+
+        return {
+            "signup": lambda context, n: (
+                "post",
+                reverse("signup"),
+                {
+                    "email": f"bench-signup-{uuid.uuid4().hex}@example.com",
+                    "password": BENCH_PASSWORD,
+                },
+                None,
+            ),
+            "login": lambda context, n: (
+                "post",
+                reverse("login"),
+                {"email": any_user(context).email, "password": BENCH_PASSWORD},
+                None,
+            ),
+            "logout": lambda context, n: (
+                "post",
+                reverse("logout"),
+                {},
+                any_user(context),
+            ),
+            "search": search("search"),
+            "async-search": search("async-search"),
+            "friend-request": lambda context, n: (
+                "post",
+                reverse("friend-request"),
+                {"to_user": any_user(context).id},
+                any_user(context),
+            ),
+            "friend-request-batch": lambda context, n: (
+                "post",
+                reverse("friend-request-batch"),
+                {"to_users": [any_user(context).id for _ in range(10)]},
+                any_user(context),
+            ),
+            "friends": list_view("friends"),
+            "async-friends": list_view("async-friends"),
+            "relationships": lambda context, n: (
+                "get",
+                reverse("relationships"),
+                {"ids": ",".join(str(any_user(context).id) for _ in range(20))},
+                any_user(context),
+            ),
+            "suggestions": list_view("suggestions"),
+            "pending-requests": list_view("pending-requests"),
+            "async-pending-requests": list_view("async-pending-requests"),
+            "changes": lambda context, n: (
+                "get",
+                reverse("changes"),
+                {"since": 0},
+                any_user(context),
+            ),
+            "accept-friend-request": accept,
+            "reject-request": reject,
+            "accept-friend-requests": bulk("accept-friend-requests", "accept", 2),
+            "reject-requests": bulk("reject-requests", "reject", 2),
+            "metrics": lambda context, n: ("get", reverse("metrics"), {}, None),
+            # A stream never ends, so only its long-poll fallback is measured
+            "events": lambda context, n: None,
+            "events-poll": lambda context, n: (
+                "get",
+                reverse("events-poll"),
+                {"timeout": 0},
+                any_user(context),
+            ),
+        }
+
+    def call(self, client, context, request):
+        method, path, data, user = request
+        if user is not None:
+            # Logging out revokes the token, so it gets a fresh one
+            token = (
+                issue_token(user)
+                if path == reverse("logout")
+                else context["tokens"].get(user.id) or issue_token(user)
+            )
+            client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+        else:
+            client.credentials()
+
+        captures = [CaptureQueriesContext(connections[alias]) for alias in connections]
+        for capture in captures:
+            capture.__enter__()
+        started = time.perf_counter()
+        try:
+            response = getattr(client, method)(path, data, format="json")
+        finally:
+            elapsed = time.perf_counter() - started
+            for capture in captures:
+                capture.__exit__(None, None, None)
+        return elapsed, sum(len(capture) for capture in captures), response.status_code
+
+    def run_endpoint(self, name, builder, context, options):
+        requests = [builder(context, n) for n in range(options["requests"])]
+        requests = [request for request in requests if request is not None]
+
+        def worker(chunk):
+            client = APIClient(HTTP_HOST="localhost")
+            try:
+                return [self.call(client, context, request) for request in chunk]
+            finally:
+                connections.close_all()
+
+        concurrency = max(1, min(options["concurrency"], len(requests)))
+        chunks = [requests[i::concurrency] for i in range(concurrency)]
+        started = time.perf_counter()
+        if concurrency == 1:
+            # Stay on the current thread, and its database connection
+            client = APIClient(HTTP_HOST="localhost")
+            results = [self.call(client, context, request) for request in requests]
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = [row for rows in executor.map(worker, chunks) for row in rows]
+        wall_time = time.perf_counter() - started
+        return results, wall_time
+
+    def summarize(self, results, wall_time):
+        if not results:
+            return {"requests": 0}
+        latencies = sorted(elapsed * 1000 for elapsed, _, _ in results)
+        queries = [count for _, count, _ in results]
+        if len(latencies) > 1:
+            percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        else:
+            percentiles = latencies * 99
+        return {
+            "requests": len(results),
+            "throughput_rps": round(len(results) / wall_time, 2),
+            "latency_ms": {
+                "mean": round(statistics.fmean(latencies), 3),
+                "p50": round(percentiles[49], 3),
+                "p95": round(percentiles[94], 3),
+                "p99": round(percentiles[98], 3),
+                "max": round(latencies[-1], 3),
+            },
+            "queries": {
+                "mean": round(statistics.fmean(queries), 2),
+                "max": max(queries),
+                "total": sum(queries),
+            },
+            "status": dict(Counter(str(code) for _, _, code in results)),
+        }
+
+    def run(self, context, options):
+        builders = self.request_builders()
+        report = defaultdict(dict)
+        for pattern in urlpatterns:
+            name = pattern.name
+            builder = builders.get(name)
+            if builder is None:
+                # Make new routes without a request builder visible in the report
+                report[name] = {"skipped": "no request builder"}
+                continue
+            results, wall_time = self.run_endpoint(name, builder, context, options)
+            report[name] = self.summarize(results, wall_time)
+            self.stderr.write(f"{name}: {report[name].get('throughput_rps')} req/s")
+        return dict(report)
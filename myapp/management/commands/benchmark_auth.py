@@ -0,0 +1,65 @@
+import base64
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from myapp.authentication import issue_token
+
+User = get_user_model()
+
+
+# Define a command comparing the throughput of Basic and signed token authentication
+class Command(BaseCommand):
+    help = (
+        "Compare requests/sec of Basic authentication and signed token authentication."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=50,
+            help="Number of requests sent with each authentication scheme.",
+        )
+        parser.add_argument(
+            "--url-name",
+            default="friends",
+            help="Name of the authenticated GET endpoint to call.",
+        )
+
+    def handle(self, *args, **options):
+        email, password = "benchmark-auth@example.com", "benchmark-password"
+        user = User.objects.create_user(email=email, password=password)
+        try:
+            credentials = base64.b64encode(f"{email}:{password}".encode()).decode()
+            schemes = {
+                "basic": f"Basic {credentials}",
+                "token": f"Bearer {issue_token(user)}",
+            }
+            url = reverse(options["url_name"])
+
+            results = {}
+            for scheme, header in schemes.items():
+                client = APIClient(HTTP_HOST="localhost")
+                client.credentials(HTTP_AUTHORIZATION=header)
+
+                # Warm up caches before timing
+                client.get(url)
+                started = time.perf_counter()
+                for _ in range(options["requests"]):
+                    response = client.get(url)
+                    if response.status_code != 200:
+                        self.stderr.write(
+                            f"{scheme}: unexpected status {response.status_code}"
+                        )
+                        return
+                elapsed = time.perf_counter() - started
+                results[scheme] = options["requests"] / elapsed
+                self.stdout.write(f"{scheme:>6}: {results[scheme]:10.1f} requests/sec")
+
+            self.stdout.write(f"speedup: {results['token'] / results['basic']:.1f}x")
+        finally:
+            user.delete()
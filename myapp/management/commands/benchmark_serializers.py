@@ -0,0 +1,123 @@
+import time
+import tracemalloc
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myapp.models import Friendship
+from myapp.row_serializers import PendingRequestRowSerializer, UserRowSerializer
+from myapp.serializers import FriendshipSerializer1, UserCreateSerializer
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    pass
+
+
+# Define a command comparing the model serializers with the values_list() read path
+class Command(BaseCommand):
+    help = (
+        "Compare rows/sec and memory allocations per row of the ModelSerializer read "
+        "path and the values_list() row serializers used by the list views. The rows "
+        "are created in a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=5000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.seed(options["rows"])
+                self.compare(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, count):
+        password = make_password("benchmark-password")
+        users = User.objects.bulk_create(
+            User(
+                email=f"bench-serializer-{i}@example.com",
+                username=f"bench-serializer-{i}@example.com",
+                password=password,
+                name=f"User {i}",
+                Gender="Other",
+                phonenumber=i,
+            )
+            for i in range(count + 1)
+        )
+        self.receiver = users[0]
+        Friendship.objects.bulk_create(
+            Friendship(from_user=user, to_user=self.receiver) for user in users[1:]
+        )
+
+    def compare(self, options):
+        users = User.objects.filter(email__startswith="bench-serializer-").order_by(
+            "id"
+        )
+        pending = Friendship.objects.filter(
+            to_user=self.receiver, accepted=False
+        ).order_by("created_at", "id")
+        cases = {
+            "users": (
+                lambda: UserCreateSerializer(users.all(), many=True).data,
+                lambda: UserRowSerializer.serialize(
+                    UserRowSerializer.values(users.all())
+                ),
+            ),
+            "pending requests": (
+                lambda: FriendshipSerializer1(pending.all(), many=True).data,
+                lambda: PendingRequestRowSerializer.serialize(
+                    PendingRequestRowSerializer.values(pending.all())
+                ),
+            ),
+        }
+
+        for name, (model_path, row_path) in cases.items():
+            # Both paths must produce the same output
+            expected, actual = model_path(), row_path()
+            if [dict(row) for row in expected] != actual:
+                self.stderr.write(f"{name}: the row serializer output differs")
+                return
+
+            results = {}
+            for label, path in (("model", model_path), ("rows", row_path)):
+                rows_per_sec, peak, blocks = self.measure(path, options["repeat"])
+                results[label] = rows_per_sec
+                self.stdout.write(
+                    f"{name:>16} {label:>5}: {rows_per_sec:10.0f} rows/sec "
+                    f"{peak:8.0f} peak bytes/row {blocks:6.1f} blocks held/row"
+                )
+            self.stdout.write(
+                f"{name:>16} speedup: {results['rows'] / results['model']:.1f}x"
+            )
+
+    def measure(self, path, repeat):
+        """
+        Return the rows/sec of the best of several runs, timing the query plus the
+        serialization, and the peak memory and the memory blocks still held by the
+        output of one run, per row.
+        """
+        best, count = None, 0
+        for _ in range(repeat):
+            started = time.perf_counter()
+            count = len(path())
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        data = path()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+        del data
+
+        count = max(count, 1)
+        return count / best, peak / count, blocks / count
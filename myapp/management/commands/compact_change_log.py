@@ -0,0 +1,43 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from myapp.changes import compact_change_log
+
+
+# Define a command trimming the old entries of the friendship change log
+class Command(BaseCommand):
+    help = (
+        "Delete the entries of the friendship change log older than --retention-days, "
+        "--batch-size rows per statement. Clients that last synced before the oldest "
+        "entry left get 410 Gone from /changes/ and download their lists again. Meant "
+        "to be run on a schedule, e.g. daily from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention-days",
+            type=float,
+            default=getattr(settings, "CHANGE_LOG_RETENTION_DAYS", 30),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=getattr(settings, "CHANGE_LOG_COMPACT_BATCH_SIZE", 5000),
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0.0,
+            help="Seconds to sleep between batches, to leave room for other writers.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        cutoff = timezone.now() - timedelta(days=options["retention_days"])
+        deleted = compact_change_log(cutoff, options["batch_size"], options["pause"])
+        self.stdout.write(f"Deleted {deleted} change log entries.")
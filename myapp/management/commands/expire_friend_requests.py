@@ -0,0 +1,52 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from myapp.services import FriendRequestService
+
+
+# Define a command deleting the pending friend requests nobody answered in time
+class Command(BaseCommand):
+    help = (
+        "Delete the pending friend requests older than --ttl-days, in transactions of "
+        "--batch-size rows, so no write lock is held for long. Meant to be run on a "
+        "schedule, e.g. daily from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ttl-days",
+            type=float,
+            default=getattr(settings, "FRIEND_REQUEST_TTL_DAYS", 90),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=getattr(settings, "FRIEND_REQUEST_EXPIRY_BATCH_SIZE", 1000),
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0.0,
+            help="Seconds to sleep between batches, to leave room for other writers.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        # A fixed cutoff, so requests turning stale during the run are left to the next one
+        cutoff = timezone.now() - timedelta(days=options["ttl_days"])
+        total = 0
+        while True:
+            deleted = FriendRequestService.expire_friend_requests(
+                cutoff, options["batch_size"]
+            )
+            total += deleted
+            if deleted < options["batch_size"]:
+                break
+            time.sleep(options["pause"])
+        self.stdout.write(f"Expired {total} pending friend request(s).")
@@ -0,0 +1,241 @@
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+
+from myapp.search import bump_directory_version, bump_index_version, user_index
+
+User = get_user_model()
+
+# Columns read from each record; other columns are ignored
+FIELDS = ("email", "password", "name", "Gender", "phonenumber")
+
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        yield from csv.DictReader(f)
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield record if isinstance(record, dict) else None
+
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl}
+
+
+# Define a command importing users from a CSV or JSONL file in bulk
+class Command(BaseCommand):
+    help = (
+        "Import users from a CSV or JSONL file with email, password, name, Gender and "
+        "phonenumber fields. Records are streamed in chunks: passwords are hashed in a "
+        "process pool and users written with bulk_create. A checkpoint is saved after "
+        "every chunk, so an interrupted import resumes where it stopped, and duplicate "
+        "or invalid records are listed in a JSONL report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--format",
+            choices=sorted(READERS),
+            help="Input format; guessed from the file extension by default.",
+        )
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Password hashing processes; 0 hashes in the current process.",
+        )
+        parser.add_argument(
+            "--checkpoint", help="Checkpoint file; defaults to <path>.checkpoint."
+        )
+        parser.add_argument(
+            "--report", help="Report file; defaults to <path>.report.jsonl."
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore an existing checkpoint and start from the first record.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.isfile(path):
+            raise CommandError(f"No such file: {path}")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        file_format = options["format"] or os.path.splitext(path)[1].lstrip(".").lower()
+        if file_format not in READERS:
+            raise CommandError("Cannot guess the input format, pass --format.")
+
+        checkpoint_path = options["checkpoint"] or f"{path}.checkpoint"
+        report_path = options["report"] or f"{path}.report.jsonl"
+        totals = {"records": 0, "created": 0, "duplicates": 0, "rejected": 0}
+        if not options["restart"] and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                totals = json.load(f)
+            self.stderr.write(f"Resuming after record {totals['records']}.")
+        elif os.path.exists(report_path):
+            os.remove(report_path)
+
+        records = islice(READERS[file_format](path), totals["records"], None)
+        executor = None
+        if options["workers"] > 0:
+            # Forked workers are already set up; spawned ones load the settings first
+            executor = ProcessPoolExecutor(
+                max_workers=options["workers"], initializer=django.setup
+            )
+        try:
+            with open(report_path, "a") as report:
+                while True:
+                    chunk = list(islice(records, options["chunk_size"]))
+                    if not chunk:
+                        break
+                    entries = self.import_chunk(
+                        chunk, totals["records"], executor, options
+                    )
+                    # The chunk is committed: record its outcome, then move past it
+                    for entry in entries:
+                        totals[entry.pop("outcome")] += 1
+                        if "reason" in entry:
+                            report.write(json.dumps(entry) + "\n")
+                    totals["records"] += len(chunk)
+                    report.flush()
+                    self.save_checkpoint(checkpoint_path, totals)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write(
+            f"Imported {totals['created']} users from {totals['records']} records: "
+            f"{totals['duplicates']} duplicates, {totals['rejected']} rejected "
+            f"(see {report_path})."
+        )
+
+    def save_checkpoint(self, checkpoint_path, totals):
+        # Replace the checkpoint atomically, so a crash never leaves it half written
+        with open(f"{checkpoint_path}.tmp", "w") as f:
+            json.dump(totals, f)
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+    def clean_record(self, record):
+        """
+        Return the model field values of a record, with the email normalized the same
+        way as MyUserManager.create_user. Raise ValidationError if a field is invalid.
+        """
+        if record is None:
+            raise ValidationError({"record": ["Invalid JSON object."]})
+
+        values, errors = {}, {}
+        for name in FIELDS:
+            value = record.get(name)
+            values[name] = None if value in ("", None) else value
+        if values["email"] is None:
+            errors["email"] = ["This field is required."]
+        else:
+            values["email"] = User.objects.normalize_user_email(str(values["email"]))
+
+        for name in ("email", "name", "Gender", "phonenumber"):
+            if name in errors:
+                continue
+            try:
+                values[name] = User._meta.get_field(name).clean(values[name], None)
+            except ValidationError as e:
+                errors[name] = e.messages
+        if errors:
+            raise ValidationError(errors)
+        return values
+
+    def import_chunk(self, chunk, offset, executor, options):
+        """
+        Import a chunk of records in one transaction. Return one entry per record, in
+        input order: its number, its outcome (created, duplicates or rejected) and, for
+        skipped records, the details written to the report.
+        """
+        entries = []
+
+        def skip(number, email, reason, errors=None):
+            entry = {"record": number, "email": email, "reason": reason}
+            if errors:
+                entry["errors"] = errors
+            entry["outcome"] = "duplicates" if reason == "duplicate" else "rejected"
+            entries.append(entry)
+
+        rows = {}
+        for number, record in enumerate(chunk, start=offset + 1):
+            try:
+                values = self.clean_record(record)
+            except ValidationError as e:
+                email = record.get("email") if record else None
+                skip(number, email, "invalid", e.message_dict)
+                continue
+            if values["email"] in rows:
+                skip(number, values["email"], "duplicate")
+                continue
+            rows[values["email"]] = (number, values)
+
+        # Hash the passwords of the valid rows only, spread over the worker processes
+        passwords = [values["password"] for _, values in rows.values()]
+        if executor is not None:
+            chunksize = max(1, len(passwords) // (4 * options["workers"]))
+            hashes = list(executor.map(make_password, passwords, chunksize=chunksize))
+        else:
+            hashes = [make_password(password) for password in passwords]
+
+        users = {}
+        for (number, values), password in zip(rows.values(), hashes):
+            fields = {name: values[name] for name in FIELDS if name != "password"}
+            users[values["email"]] = User(
+                username=values["email"], password=password, **fields
+            )
+
+        for attempt in range(3):
+            # Users created by earlier chunks or other processes are reported, not overwritten
+            existing = User.objects.filter(email__in=list(users)).values_list(
+                "email", flat=True
+            )
+            for email in existing:
+                del users[email]
+                skip(rows[email][0], email, "duplicate")
+            try:
+                with transaction.atomic():
+                    User.objects.bulk_create(list(users.values()))
+                break
+            except IntegrityError:
+                # A concurrent signup took one of the emails; look them up again
+                if attempt == 2:
+                    raise
+
+        entries.extend(
+            {"record": rows[email][0], "outcome": "created"} for email in users
+        )
+        entries.sort(key=lambda entry: entry["record"])
+        if users:
+            # Cached search results and the indexes of other processes do not include the new users
+            bump_directory_version()
+            bump_index_version()
+        if user_index.built:
+            # bulk_create sends no post_save signal, so index the new users here
+            for user in users.values():
+                user_index.update(user.pk, user.name, user.email)
+        return entries
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.sessions import purge_expired_sessions, write_buffer
+
+
+# Define a command deleting expired sessions in small batches
+class Command(BaseCommand):
+    help = (
+        "Delete the expired rows of the session table in batches of --batch-size, "
+        "instead of the single large DELETE of clearsessions. Meant to be run on a "
+        "schedule, e.g. hourly from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=getattr(settings, "SESSION_PURGE_BATCH_SIZE", 1000),
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0.0,
+            help="Seconds to sleep between batches, to leave room for other writers.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        # Write the sessions still pending in this process first, in case they expired
+        write_buffer.flush()
+        total = purge_expired_sessions(options["batch_size"], options["pause"])
+        self.stdout.write(f"Purged {total} expired session(s).")
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from myapp.counters import count_friendships
+from myapp.models import MyUser
+from myapp.search import publish_counter_changes
+
+
+# Define a command recomputing the denormalized friend and pending-request counters
+class Command(BaseCommand):
+    help = (
+        "Recompute the friend_count and pending_count of every user from the Friendship "
+        "table, --chunk-size users per transaction, and report and fix the counters that "
+        "drifted. With --dry-run, only report them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        checked = drifted = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                # Lock the chunk, so no counter update lands between the count and the fix
+                users = list(
+                    MyUser.objects.select_for_update()
+                    .filter(pk__gt=last_id)
+                    .order_by("pk")
+                    .only("pk", "friend_count", "pending_count")[
+                        : options["chunk_size"]
+                    ]
+                )
+                if not users:
+                    break
+                last_id = users[-1].pk
+
+                friends, pending = count_friendships([user.pk for user in users])
+                fixed = []
+                for user in users:
+                    counts = (friends[user.pk], pending[user.pk])
+                    if counts == (user.friend_count, user.pending_count):
+                        continue
+                    self.stdout.write(
+                        f"User {user.pk}: friend_count {user.friend_count} -> "
+                        f"{counts[0]}, pending_count {user.pending_count} -> {counts[1]}"
+                    )
+                    user.friend_count, user.pending_count = counts
+                    fixed.append(user)
+
+                checked += len(users)
+                drifted += len(fixed)
+                if fixed and not options["dry_run"]:
+                    MyUser.objects.bulk_update(fixed, ["friend_count", "pending_count"])
+                    user_ids = [user.pk for user in fixed]
+                    transaction.on_commit(lambda: publish_counter_changes(user_ids))
+
+        action = "found" if options["dry_run"] else "fixed"
+        self.stdout.write(f"Checked {checked} user(s), {action} {drifted} drifted.")
@@ -0,0 +1,29 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+# Define a command refreshing file-copy SQLite replicas from the primary database
+class Command(BaseCommand):
+    help = "Copy the primary SQLite database over every replica in DATABASE_REPLICAS."
+
+    def handle(self, *args, **options):
+        primary = connections["default"]
+        if primary.vendor != "sqlite":
+            raise CommandError("sync_sqlite_replicas only supports SQLite databases.")
+
+        for alias in settings.DATABASE_REPLICAS:
+            replica = connections[alias]
+            replica.close()
+
+            # The backup API takes a consistent snapshot, even while the primary is written to
+            source = sqlite3.connect(str(primary.settings_dict["NAME"]))
+            target = sqlite3.connect(str(replica.settings_dict["NAME"]))
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+            self.stdout.write(f"Copied the primary database to {alias}.")
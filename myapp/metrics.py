@@ -0,0 +1,302 @@
+# metrics.py
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+from rest_framework import permissions, renderers
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Process id of the rows holding the totals of the worker processes that have exited
+EXITED_PROCESS = "exited"
+
+
+def format_labels(labels):
+    return ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"),
+        )
+        for name, value in labels
+    )
+
+
+def format_sample(name, labels, value):
+    # Return one line of the exposition format, e.g. 'requests_total{view="search"} 3'
+    value = str(int(value)) if float(value).is_integer() else repr(float(value))
+    if not labels:
+        return f"{name} {value}"
+    return f"{name}{{{format_labels(labels)}}} {value}"
+
+
+# Define a counter of the metrics registry
+class Counter:
+    type = "counter"
+
+    def __init__(self, registry, name, documentation):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+
+    def inc(self, amount=1, **labels):
+        self.registry.add(self.name, labels, "", amount)
+
+    def render(self, samples):
+        for labels, values in samples:
+            yield format_sample(self.name, labels, values[""])
+
+
+# Define a histogram of the metrics registry, with fixed buckets
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, registry, name, documentation, buckets=LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        # Count the observation in its own bucket only; buckets are summed up when rendered
+        index = bisect_left(self.buckets, value)
+        bucket = str(self.buckets[index]) if index < len(self.buckets) else "+Inf"
+        self.registry.add(self.name, labels, bucket, 1)
+        self.registry.add(self.name, labels, "sum", value)
+
+    def render(self, samples):
+        for labels, values in samples:
+            total = 0
+            for bound in [*map(str, self.buckets), "+Inf"]:
+                total += values.get(bound, 0)
+                yield format_sample(
+                    f"{self.name}_bucket", [*labels, ("le", bound)], total
+                )
+            yield format_sample(f"{self.name}_sum", labels, values.get("sum", 0))
+            yield format_sample(f"{self.name}_count", labels, total)
+
+
+# Define a registry of metrics aggregated over all the worker processes of a host
+class MetricsRegistry:
+    """
+    Keeps the metric values of the current process in memory, and writes the ones that
+    changed to a SQLite file at most every METRICS_FLUSH_INTERVAL seconds, one row per
+    process and sample. Rendering sums the rows of all processes, so every worker serves
+    the totals of the host, including the counts of workers that have since exited.
+
+    A process adds its rows to the EXITED_PROCESS rows when it exits, and rendering does
+    the same for the processes that died without doing so, so the table keeps one set of
+    rows per live worker however often workers are restarted.
+    """
+
+    def __init__(self, location, flush_interval=1):
+        self.location = str(location)
+        self.flush_interval = flush_interval
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        atexit.register(self.retire)
+
+    def _check_process(self):
+        # A forked worker starts from zero under its own id; its parent flushes its own values
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._process_id = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+            self._values = {}
+            self._dirty = set()
+            self._last_flush = time.monotonic()
+            self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.location, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS metric_sample ("
+                "process TEXT NOT NULL, name TEXT NOT NULL, labels TEXT NOT NULL, "
+                "sample TEXT NOT NULL, value REAL NOT NULL, "
+                "PRIMARY KEY (process, name, labels, sample)) WITHOUT ROWID"
+            )
+        return self._connection
+
+    def counter(self, name, documentation):
+        return self.metrics.setdefault(name, Counter(self, name, documentation))
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        return self.metrics.setdefault(
+            name, Histogram(self, name, documentation, buckets)
+        )
+
+    def add(self, name, labels, sample, amount):
+        key = (name, json.dumps(sorted(labels.items())), sample)
+        with self._lock:
+            self._check_process()
+            self._values[key] = self._values.get(key, 0) + amount
+            self._dirty.add(key)
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        # Write the values changed since the last flush, as totals of this process
+        with self._lock:
+            self._check_process()
+            self._last_flush = time.monotonic()
+            if not self._dirty:
+                return
+            rows = [(self._process_id, *key, self._values[key]) for key in self._dirty]
+            self._dirty = set()
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(
+                    "INSERT INTO metric_sample (process, name, labels, sample, value) "
+                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT (process, name, labels, sample) "
+                    "DO UPDATE SET value = excluded.value",
+                    rows,
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _fold(self, connection, process_ids):
+        # Add the rows of the processes to the EXITED_PROCESS rows, and delete them
+        for process_id in process_ids:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT INTO metric_sample (process, name, labels, sample, value) "
+                    "SELECT ?, name, labels, sample, value FROM metric_sample "
+                    "WHERE process = ? ON CONFLICT (process, name, labels, sample) "
+                    "DO UPDATE SET value = value + excluded.value",
+                    (EXITED_PROCESS, process_id),
+                )
+                connection.execute(
+                    "DELETE FROM metric_sample WHERE process = ?", (process_id,)
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def retire(self):
+        # Called at exit: hand the totals of this process over to the EXITED_PROCESS rows
+        self.flush()
+        with self._lock:
+            if self._connection is None:
+                return
+            self._fold(self._connection, [self._process_id])
+            # Values added from now on are counted again from zero
+            self._values.clear()
+
+    def _fold_dead_processes(self, connection):
+        dead = []
+        for (process_id,) in connection.execute(
+            "SELECT DISTINCT process FROM metric_sample WHERE process != ?",
+            (EXITED_PROCESS,),
+        ):
+            try:
+                os.kill(int(process_id.split("-")[0]), 0)
+            except ProcessLookupError:
+                dead.append(process_id)
+            except (PermissionError, ValueError):
+                # Alive under another user, or not a process id
+                pass
+        self._fold(connection, dead)
+
+    def collect(self):
+        """
+        Return {metric name: [(labels, {sample: value})]} summed over all processes.
+        """
+        self.flush()
+        with self._lock:
+            self._fold_dead_processes(self._connect())
+            rows = self._connect().execute(
+                "SELECT name, labels, sample, SUM(value) FROM metric_sample "
+                "GROUP BY name, labels, sample ORDER BY name, labels"
+            )
+            series = {}
+            for name, labels, sample, value in rows:
+                samples = series.setdefault(name, {}).setdefault(labels, {})
+                samples[sample] = value
+        return {
+            name: [(json.loads(labels), values) for labels, values in items.items()]
+            for name, items in series.items()
+        }
+
+    def render(self):
+        # Return all metrics in the Prometheus text exposition format
+        collected = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            lines.extend(metric.render(collected.get(name, [])))
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._check_process()
+            self._values.clear()
+            self._dirty.clear()
+            self._connect().execute("DELETE FROM metric_sample")
+
+
+metrics = MetricsRegistry(
+    getattr(settings, "METRICS_STORE", settings.BASE_DIR / "metrics.sqlite3"),
+    flush_interval=getattr(settings, "METRICS_FLUSH_INTERVAL", 1),
+)
+
+requests_total = metrics.counter(
+    "myapp_requests_total", "Requests served, by URL name, method and status."
+)
+request_duration = metrics.histogram(
+    "myapp_request_duration_seconds", "Request latency in seconds, by URL name."
+)
+db_queries_total = metrics.counter(
+    "myapp_db_queries_total", "SQL queries run while serving requests, by URL name."
+)
+throttled_requests_total = metrics.counter(
+    "myapp_throttled_requests_total", "Requests rejected by a throttle, by scope."
+)
+log_records_dropped_total = metrics.counter(
+    "myapp_log_records_dropped_total",
+    "Log records dropped because the log queue was full, by logger.",
+)
+
+
+# Define a renderer for the Prometheus text exposition format
+class PrometheusRenderer(renderers.BaseRenderer):
+    media_type = "text/plain"
+    format = "prometheus"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Errors, e.g. a failed token check, are rendered as a plain message
+        if isinstance(data, dict):
+            data = f"{data.get('detail', data)}\n"
+        return data.encode(self.charset)
+
+
+# Define a permission checking the token of the metrics scraper, or its address when no token is configured
+class HasMetricsToken(permissions.BasePermission):
+    def has_permission(self, request, view):
+        token = getattr(settings, "METRICS_TOKEN", None)
+        if not token:
+            allowed = getattr(settings, "METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"])
+            return request.META.get("REMOTE_ADDR") in allowed
+        return constant_time_compare(
+            request.headers.get("Authorization", ""), f"Bearer {token}"
+        )
@@ -0,0 +1,204 @@
+# middleware.py
+
+import logging
+import re
+import time
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+from .log import current_request
+from .metrics import db_queries_total, request_duration, requests_total
+from .profiling import RequestProfile, current_profile
+from .routers import pin_to_primary
+
+logger = logging.getLogger("myapp.profiling")
+
+
+# Define a middleware giving every request an id, for the logs and the client
+class RequestIdMiddleware:
+    """
+    Take the request id from a well-formed X-Request-ID header, set by a proxy or the
+    client, or generate one. It is set on the request, added to every log record of the
+    request and sent back in the X-Request-ID response header.
+
+    Put it first in MIDDLEWARE, so the records of the other middleware carry the id.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    valid_id = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def get_request_id(self, request):
+        request_id = request.headers.get("X-Request-ID", "")
+        if self.valid_id.fullmatch(request_id):
+            return request_id
+        return uuid.uuid4().hex
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request.request_id = self.get_request_id(request)
+        token = current_request.set(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        response["X-Request-ID"] = request.request_id
+        return response
+
+    async def __acall__(self, request):
+        request.request_id = self.get_request_id(request)
+        token = current_request.set(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        response["X-Request-ID"] = request.request_id
+        return response
+
+
+# Define a middleware pinning users to the primary database after they write
+class ReadYourWritesMiddleware:
+    """
+    After a successful unsafe request (POST, PUT, PATCH, DELETE) by an authenticated
+    user, send that user's reads to the primary for READ_YOUR_WRITES_WINDOW seconds,
+    so replica lag cannot hide their own writes.
+    """
+
+    safe_methods = ("GET", "HEAD", "OPTIONS", "TRACE")
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        self.pin_writer(request, response)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if request.method not in self.safe_methods:
+            # Resolving a lazy user may read the session, so do it off the event loop
+            await sync_to_async(self.pin_writer)(request, response)
+        return response
+
+    def pin_writer(self, request, response):
+        # DRF sets the authenticated user back on the Django request
+        user = getattr(request, "user", None)
+        if (
+            request.method not in self.safe_methods
+            and response.status_code < 400
+            and user is not None
+            and user.is_authenticated
+        ):
+            pin_to_primary(user.pk)
+
+
+# Define a middleware reporting the queries and timings of each request
+class RequestProfilingMiddleware:
+    """
+    Measure the number and total time of SQL queries, the view time and the serializer
+    time of each request. Send them in a Server-Timing header when SERVER_TIMING_HEADER
+    is on, and as a structured record of the "myapp.profiling" logger. A warning is
+    logged when one statement shape runs more than N_PLUS_ONE_THRESHOLD times.
+
+    Put it right after RequestIdMiddleware, so the total time covers the other middleware.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = current_profile.set(RequestProfile())
+        try:
+            response = self.get_response(request)
+            self.report(request, response, current_profile.get())
+        finally:
+            current_profile.reset(token)
+        return response
+
+    async def __acall__(self, request):
+        token = current_profile.set(RequestProfile())
+        try:
+            response = await self.get_response(request)
+            self.report(request, response, current_profile.get())
+        finally:
+            current_profile.reset(token)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.view_started = time.perf_counter()
+
+    def report(self, request, response, profile):
+        now = time.perf_counter()
+        metrics = {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "queries": profile.queries,
+            "sql_ms": round(profile.sql_time * 1000, 3),
+            "view_ms": round((now - (profile.view_started or now)) * 1000, 3),
+            "serializer_ms": round(profile.timings["serializer"] * 1000, 3),
+            "total_ms": round((now - profile.started) * 1000, 3),
+        }
+
+        if getattr(settings, "SERVER_TIMING_HEADER", True):
+            response["Server-Timing"] = ", ".join(
+                [
+                    f'db;dur={metrics["sql_ms"]};desc="{profile.queries} queries"',
+                    f'view;dur={metrics["view_ms"]}',
+                    f'serializer;dur={metrics["serializer_ms"]}',
+                    f'total;dur={metrics["total_ms"]}',
+                ]
+            )
+
+        logger.info(
+            "%(method)s %(path)s %(status)s: %(queries)s queries in %(sql_ms)sms, "
+            "%(total_ms)sms total",
+            metrics,
+            extra={"profile": metrics},
+        )
+
+        # Record the request in the metrics served by /metrics/
+        match = request.resolver_match
+        view = match.url_name if match is not None and match.url_name else "unmatched"
+        requests_total.inc(
+            view=view, method=request.method, status=response.status_code
+        )
+        request_duration.observe(now - profile.started, view=view)
+        db_queries_total.inc(profile.queries, view=view)
+
+        threshold = getattr(settings, "N_PLUS_ONE_THRESHOLD", 10)
+        for shape, count in profile.repeated_queries(threshold).items():
+            logger.warning(
+                "Possible N+1 query in %s %s: ran %s times: %s",
+                request.method,
+                request.path,
+                count,
+                shape,
+                extra={"profile": {**metrics, "sql": shape, "repeats": count}},
+            )
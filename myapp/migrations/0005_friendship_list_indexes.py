@@ -0,0 +1,27 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0004_alter_myuser_gender_alter_myuser_name_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="friendship",
+            index=models.Index(
+                fields=["from_user", "accepted", "created_at", "id"],
+                name="myapp_frien_from_us_477d7e_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="friendship",
+            index=models.Index(
+                fields=["to_user", "accepted", "created_at", "id"],
+                name="myapp_frien_to_user_6b4040_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 5.0.4 on 2026-10-18 17:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_canonical_pairs(apps, schema_editor):
+    # Fill user_low/user_high and keep a single row per pair of users before the
+    # unique constraint is added: accepted rows win, then the oldest request
+    Friendship = apps.get_model("myapp", "Friendship")
+    kept, duplicates, batch = set(), [], []
+    rows = Friendship.objects.exclude(from_user=None).exclude(to_user=None)
+    for friendship in rows.order_by("-accepted", "created_at", "id").iterator(
+        chunk_size=2000
+    ):
+        pair = (
+            min(friendship.from_user_id, friendship.to_user_id),
+            max(friendship.from_user_id, friendship.to_user_id),
+        )
+        if pair[0] == pair[1] or pair in kept:
+            duplicates.append(friendship.id)
+            continue
+        kept.add(pair)
+        friendship.user_low_id, friendship.user_high_id = pair
+        batch.append(friendship)
+        if len(batch) >= 2000:
+            Friendship.objects.bulk_update(batch, ["user_low", "user_high"])
+            batch = []
+    Friendship.objects.bulk_update(batch, ["user_low", "user_high"])
+    for start in range(0, len(duplicates), 500):
+        Friendship.objects.filter(id__in=duplicates[start : start + 500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0005_friendship_list_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="friendship",
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name="friendship",
+            name="user_high",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddField(
+            model_name="friendship",
+            name="user_low",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.RunPython(backfill_canonical_pairs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="friendship",
+            constraint=models.UniqueConstraint(
+                fields=("user_low", "user_high"), name="unique_friendship_pair"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="friendship",
+            constraint=models.CheckConstraint(
+                check=models.Q(("user_low__lt", models.F("user_high"))),
+                name="friendship_pair_ordered",
+            ),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0006_friendship_canonical_pair"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="friendship",
+            index=models.Index(
+                fields=["accepted", "created_at", "id"],
+                name="myapp_frien_accepte_bbb06c_idx",
+            ),
+        ),
+    ]
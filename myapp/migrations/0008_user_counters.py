@@ -0,0 +1,47 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:10
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    # Count the friendships and pending requests of every user with one UPDATE
+    MyUser = apps.get_model("myapp", "MyUser")
+    Friendship = apps.get_model("myapp", "Friendship")
+
+    def count(field, accepted):
+        rows = (
+            Friendship.objects.filter(**{field: OuterRef("pk")}, accepted=accepted)
+            .order_by()
+            .values(field)
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        return Coalesce(Subquery(rows), 0)
+
+    MyUser.objects.update(
+        friend_count=count("from_user", True) + count("to_user", True),
+        pending_count=count("to_user", False),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0007_friendship_expiry_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="myuser",
+            name="friend_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="myuser",
+            name="pending_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
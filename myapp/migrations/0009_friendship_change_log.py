@@ -0,0 +1,52 @@
+# Generated by Django 5.0.4 on 2026-10-18 18:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("myapp", "0008_user_counters"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FriendshipChange",
+            fields=[
+                ("seq", models.BigAutoField(primary_key=True, serialize=False)),
+                ("peer", models.BigIntegerField()),
+                ("request", models.BigIntegerField()),
+                (
+                    "op",
+                    models.CharField(
+                        choices=[
+                            ("sent", "Request sent"),
+                            ("received", "Request received"),
+                            ("accepted", "Request accepted"),
+                            ("deleted", "Request or friendship deleted"),
+                        ],
+                        max_length=8,
+                    ),
+                ),
+                ("changed_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "seq"], name="myapp_frien_user_id_ef2dd9_idx"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -1,14 +1,19 @@
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db import models
+from django.db import models, router
 from django.conf import settings
 
 
 class MyUserManager(BaseUserManager):
+    @classmethod
+    def normalize_user_email(cls, email):
+        # Emails are stored lowercased, so they compare case-insensitively
+        return cls.normalize_email(email).lower()
+
     def create_user(self, email, password=None, **extra_fields):
         if not email:
             raise ValueError("Users must have an email address")
 
-        email = self.normalize_email(email).lower()
+        email = self.normalize_user_email(email)
         user = self.model(email=email, **extra_fields)
         user.set_password(password)
         user.save(using=self._db)
@@ -35,6 +40,10 @@ class MyUser(AbstractUser):
         max_length=100, choices=genderchoice, null=True, blank=True
     )
     phonenumber = models.IntegerField(null=True, blank=True)
+    # Denormalized counts of accepted friendships and of pending requests received, kept
+    # up to date by myapp.counters and checked by the reconcile_counters command
+    friend_count = models.PositiveIntegerField(default=0, editable=False)
+    pending_count = models.PositiveIntegerField(default=0, editable=False)
 
     objects = MyUserManager()
 
@@ -49,6 +58,44 @@ class MyUser(AbstractUser):
         return f"{self.email}{self.id}"
 
 
+def canonical_pair(user_id, other_user_id):
+    # Return the ids of two users as (lowest id, highest id), whichever way the request went
+    return min(user_id, other_user_id), max(user_id, other_user_id)
+
+
+class FriendshipQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create skips Model.save(), so fill in the canonical pair here
+        objs = list(objs)
+        for obj in objs:
+            obj.set_canonical_pair()
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def between(self, user_id, other_user_id):
+        # Return the relationship between two users, in either direction, with one unique index probe
+        user_low, user_high = canonical_pair(user_id, other_user_id)
+        return self.filter(user_low=user_low, user_high=user_high)
+
+    def between_many(self, user_id, other_ids):
+        # Return the relationships between a user and any of the others, in either direction,
+        # with two range scans of the unique index on the canonical pair
+        other_ids = list(other_ids)
+        return self.filter(
+            models.Q(user_low=user_id, user_high__in=other_ids)
+            | models.Q(user_low__in=other_ids, user_high=user_id)
+        )
+
+    def delete_pending(self):
+        """
+        Delete the pending requests of the queryset with one DELETE, without fetching
+        them, and return their number. Requests accepted meanwhile are kept.
+
+        delete() fetches every row first to send post_delete for each of them, so the
+        caller must do what the Friendship signal receivers would have done.
+        """
+        return self.filter(accepted=False)._raw_delete(router.db_for_write(self.model))
+
+
 class Friendship(models.Model):
     from_user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -64,8 +111,92 @@ class Friendship(models.Model):
         null=True,
         blank=True,
     )
+    # The two users of the relationship ordered by id, so each pair of users has a single row;
+    # from_user/to_user keep the direction of the request and accepted its state
+    user_low = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="+",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        editable=False,
+    )
+    user_high = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="+",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        editable=False,
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     accepted = models.BooleanField(default=False)
 
+    objects = FriendshipQuerySet.as_manager()
+
     class Meta:
-        unique_together = ("from_user", "to_user")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user_low", "user_high"], name="unique_friendship_pair"
+            ),
+            models.CheckConstraint(
+                check=models.Q(user_low__lt=models.F("user_high")),
+                name="friendship_pair_ordered",
+            ),
+        ]
+        # Cover the friend and pending-request lists, paginated by (created_at, id)
+        indexes = [
+            models.Index(fields=["from_user", "accepted", "created_at", "id"]),
+            models.Index(fields=["to_user", "accepted", "created_at", "id"]),
+            # Find the stale pending requests to expire, oldest first
+            models.Index(fields=["accepted", "created_at", "id"]),
+        ]
+
+    def set_canonical_pair(self):
+        if self.from_user_id is not None and self.to_user_id is not None:
+            self.user_low_id, self.user_high_id = canonical_pair(
+                self.from_user_id, self.to_user_id
+            )
+
+    def save(self, *args, **kwargs):
+        self.set_canonical_pair()
+        super(Friendship, self).save(*args, **kwargs)
+
+
+class FriendshipChange(models.Model):
+    # One entry of the append-only friendship change log, written in the transaction that
+    # changes the Friendship row: what became of the relationship of user with peer
+    SENT = "sent"
+    RECEIVED = "received"
+    ACCEPTED = "accepted"
+    DELETED = "deleted"
+    OPS = (
+        (SENT, "Request sent"),
+        (RECEIVED, "Request received"),
+        (ACCEPTED, "Request accepted"),
+        (DELETED, "Request or friendship deleted"),
+    )
+
+    seq = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="+",
+        on_delete=models.CASCADE,
+        db_index=False,
+    )
+    # Plain ids, so the entry outlives the peer and the friend request it is about
+    peer = models.BigIntegerField()
+    request = models.BigIntegerField()
+    op = models.CharField(max_length=8, choices=OPS)
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Read the changes of a user after a sequence number with one index range scan
+        indexes = [models.Index(fields=["user", "seq"])]
+
+
+class RevokedToken(models.Model):
+    # A signed token revoked before the end of its lifetime, e.g. on logout; kept until
+    # expires_at, when the signature check rejects the token by itself
+    token_id = models.CharField(max_length=32, primary_key=True)
+    expires_at = models.DateTimeField(db_index=True)
@@ -0,0 +1,203 @@
+# pagination.py
+
+import base64
+import binascii
+import datetime
+import json
+from bisect import bisect_right
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+# Define a keyset (cursor) pagination class for list endpoints
+class KeysetPagination(BasePagination):
+    """
+    Paginate by seeking past the ordering key of the last row of the previous page,
+    instead of using OFFSET, so every page costs the same index range scan.
+
+    The cursor is an opaque url-safe token holding that key. Only forward
+    navigation is supported.
+    """
+
+    # The ordering key; it must be unique, so the last field is always the primary key
+    ordering = ("id",)
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_page_size(self, request):
+        page_size = getattr(settings, "REST_FRAMEWORK", {}).get("PAGE_SIZE") or 20
+        max_page_size = getattr(settings, "MAX_PAGE_SIZE", 100)
+        try:
+            requested = int(request.query_params[self.page_size_query_param])
+            if requested > 0:
+                page_size = requested
+        except (KeyError, ValueError):
+            pass
+        return min(page_size, max_page_size)
+
+    def get_ordering(self, request, queryset, view):
+        return self.ordering
+
+    def encode_cursor(self, values):
+        values = [
+            value.isoformat() if isinstance(value, datetime.datetime) else value
+            for value in values
+        ]
+        payload = json.dumps(values, separators=(",", ":")).encode()
+        return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+    def get_cursor_field(self, queryset, name):
+        # Return the model field, or the output field of the annotation, ordered by name
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+        return queryset.model._meta.get_field(name)
+
+    def decode_cursor(self, cursor, ordering, queryset=None):
+        """
+        Return the ordering key held by a cursor. With a queryset, each value is also
+        converted to the Python type of its field, so a tampered cursor is reported as
+        a 404 instead of failing in the database query.
+        """
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        except (binascii.Error, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        if queryset is None:
+            return values
+        try:
+            values = [
+                self.get_cursor_field(queryset, field.lstrip("-")).to_python(value)
+                for field, value in zip(ordering, values)
+            ]
+        except (ValidationError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if any(value is None for value in values):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def seek_filter(self, ordering, values):
+        # Build "(a, b, c) > (x, y, z)" as (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        condition = Q()
+        for i, field in enumerate(ordering):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            term = Q(**{f"{name}__{lookup}": values[i]})
+            for previous, value in zip(ordering[:i], values):
+                term &= Q(**{previous.lstrip("-"): value})
+            condition |= term
+        return condition
+
+    def get_page_queryset(self, queryset, request, view=None):
+        # Return the queryset of the requested page, plus one extra row to know whether there is a next page
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.page_ordering = self.get_ordering(request, queryset, view)
+
+        queryset = queryset.order_by(*self.page_ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            values = self.decode_cursor(cursor, self.page_ordering, queryset)
+            queryset = queryset.filter(self.seek_filter(self.page_ordering, values))
+        return queryset[: self.page_size + 1]
+
+    def get_page(self, results):
+        self.has_next = len(results) > self.page_size
+        results = results[: self.page_size]
+        self.next_values = None
+        if self.has_next:
+            last = results[-1]
+            self.next_values = [
+                getattr(last, field.lstrip("-")) for field in self.page_ordering
+            ]
+        return results
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.get_page_queryset(queryset, request, view)
+        return self.get_page(list(queryset))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        queryset = self.get_page_queryset(queryset, request, view)
+        # values_list().aiterator() runs its query synchronously on Django 5.0, so fetch the queryset instead
+        return self.get_page([row async for row in queryset])
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.next_values)
+        )
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict([("next", self.get_next_link()), ("results", data)])
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+# Define a keyset pagination class for user lists
+class UserKeysetPagination(KeysetPagination):
+    """
+    Users are paginated by id, or by search rank then id for ranked search results.
+    """
+
+    ordering = ("id",)
+
+    def get_ordering(self, request, queryset, view):
+        if "search_rank" in queryset.query.annotations:
+            return ("search_rank", "id")
+        return self.ordering
+
+
+# Define a keyset pagination class for friendship lists
+class FriendshipKeysetPagination(KeysetPagination):
+    ordering = ("created_at", "id")
+
+
+# Define a keyset pagination class for in-memory sorted id sequences
+class SortedIdPagination(KeysetPagination):
+    """
+    Paginates an ascending sequence of ids (such as cached friend ids), seeking to
+    the cursor with a binary search instead of a database query.
+    """
+
+    ordering = ("id",)
+
+    def paginate_queryset(self, ids, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        start = 0
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            (last_id,) = self.decode_cursor(cursor, self.ordering)
+            if not isinstance(last_id, int):
+                raise NotFound(self.invalid_cursor_message)
+            start = bisect_right(ids, last_id)
+
+        results = list(ids[start : start + self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        results = results[: self.page_size]
+        self.next_values = [results[-1]] if self.has_next else None
+        return results
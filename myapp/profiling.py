@@ -0,0 +1,101 @@
+# profiling.py
+
+import functools
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from rest_framework import serializers
+
+# Profile of the request being served, or None outside of a request
+current_profile = ContextVar("current_profile", default=None)
+
+# Placeholder lists of any length, e.g. the "IN (%s, %s, %s)" of an id__in lookup
+PLACEHOLDER_LIST = re.compile(r"\((?:%s|\?)(?:,\s*(?:%s|\?))*\)")
+
+
+def sql_shape(sql):
+    # Return the SQL with its placeholder lists collapsed, so repeats of one statement compare equal
+    return PLACEHOLDER_LIST.sub("(...)", sql)
+
+
+# Define the measurements collected while serving one request
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.view_started = None
+        self.queries = 0
+        self.sql_time = 0.0
+        self.shapes = Counter()
+        self.timings = Counter()
+        self._active = set()
+
+    def record_query(self, sql, duration):
+        self.queries += 1
+        self.sql_time += duration
+        self.shapes[sql_shape(sql)] += 1
+
+    def repeated_queries(self, threshold):
+        # Return the statement shapes run more than threshold times, the mark of an N+1 pattern
+        return {
+            shape: count for shape, count in self.shapes.items() if count > threshold
+        }
+
+    @contextmanager
+    def timed(self, name):
+        # Nested blocks of the same name (e.g. a list serializer and its children) count once
+        if name in self._active:
+            yield
+            return
+        self._active.add(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - started
+            self._active.discard(name)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper installed on every connection by the connection_created
+    signal handler. Queries run outside of a profiled request are not measured.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.record_query(sql, time.perf_counter() - started)
+
+
+def timed_serializer(method):
+    # Add the time spent in a serializer method to the "serializer" timing of the request
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        profile = current_profile.get()
+        if profile is None:
+            return method(*args, **kwargs)
+        with profile.timed("serializer"):
+            return method(*args, **kwargs)
+
+    return wrapper
+
+
+def instrument_serializers():
+    """
+    Time validation and representation of every DRF serializer, so views need no change
+    to report their serializer time.
+    """
+    for cls in (serializers.BaseSerializer, serializers.ListSerializer):
+        if not hasattr(cls.is_valid, "__wrapped__"):
+            cls.is_valid = timed_serializer(cls.is_valid)
+    for cls in (serializers.Serializer, serializers.ListSerializer):
+        data = cls.__dict__["data"]
+        if not hasattr(data.fget, "__wrapped__"):
+            cls.data = property(timed_serializer(data.fget))
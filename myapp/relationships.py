@@ -0,0 +1,140 @@
+# relationships.py
+
+import hashlib
+from bisect import bisect_left
+
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from .friend_cache import friend_cache
+from .models import Friendship
+from .routers import pin_to_primary
+from .versions import bump_version, get_version
+
+# Relationship of the requesting user with another user
+SELF = "self"
+FRIENDS = "friends"
+REQUEST_SENT = "request_sent"
+REQUEST_RECEIVED = "request_received"
+NONE = "none"
+
+
+def intersection_size(a, b):
+    """
+    Return the number of ids two ascending id arrays have in common.
+
+    When one array is much smaller, its ids are looked up in the other by bisection;
+    otherwise both are walked once side by side.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        return 0
+
+    if len(a) * 16 < len(b):
+        count, low = 0, 0
+        for value in a:
+            low = bisect_left(b, value, low)
+            if low == len(b):
+                break
+            if b[low] == value:
+                count += 1
+        return count
+
+    count, i, j = 0, 0, 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            count += 1
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+    return count
+
+
+def get_relationships(user_id, other_ids):
+    """
+    Return {other id: {"status": ..., "mutual_friends": n}} for a user and a list of
+    other users, with at most two queries whatever the number of ids: one for the
+    requests between the user and the others, and one for the friend lists missing from
+    the friend cache.
+    """
+    other_ids = list(dict.fromkeys(other_ids))
+    statuses = {}
+    rows = Friendship.objects.between_many(user_id, other_ids).values_list(
+        "from_user", "to_user", "accepted"
+    )
+    for from_id, to_id, accepted in rows:
+        if accepted:
+            statuses[to_id if from_id == user_id else from_id] = FRIENDS
+        elif from_id == user_id:
+            statuses[to_id] = REQUEST_SENT
+        else:
+            statuses[from_id] = REQUEST_RECEIVED
+
+    friend_ids = friend_cache.get_many_friend_ids([user_id, *other_ids])
+    relationships = {}
+    for other_id in other_ids:
+        relationships[other_id] = {
+            "status": SELF if other_id == user_id else statuses.get(other_id, NONE),
+            "mutual_friends": (
+                0
+                if other_id == user_id
+                else intersection_size(friend_ids[user_id], friend_ids[other_id])
+            ),
+        }
+    return relationships
+
+
+def relationship_version_key(user_id):
+    return f"relationship-version:{user_id}"
+
+
+def relationship_version(user_id):
+    # Return the relationship version of a user, which grows every time a friend request
+    # of the user is sent, accepted or rejected
+    return get_version(relationship_version_key(user_id))
+
+
+def bump_relationship_versions(*user_ids):
+    """
+    Bump the relationship version of the users, and send their reads to the primary
+    for a while, so a lagging replica cannot serve old lists under the new version.
+    """
+    for user_id in set(user_ids):
+        previous, version = bump_version(relationship_version_key(user_id))
+        # This process updated its friend cache entry with the change: it holds the new version
+        friend_cache.retag(user_id, previous, version)
+        pin_to_primary(user_id)
+
+
+# Define a view mixin answering conditional GET requests from the relationship version
+class RelationshipETagMixin:
+    """
+    Tag list responses with the relationship version of the authenticated user and the
+    requested URL, and answer a matching If-None-Match with 304 Not Modified before
+    the list is read.
+    """
+
+    def get_etag(self, request):
+        # The version is read before the list, so a concurrent change gets a newer tag; the
+        # list reads it from relationship_version to load data at least as new
+        version = relationship_version(request.user.id)
+        self.relationship_version = version
+        url = hashlib.md5(
+            request.get_full_path().encode(), usedforsecurity=False
+        ).hexdigest()[:12]
+        return quote_etag(f"{request.user.id}-{version}-{url}")
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response["ETag"] = etag
+        return response
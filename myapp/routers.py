@@ -0,0 +1,120 @@
+# routers.py
+
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+from .versions import shared_cache
+
+# Whether the reads of the current request may be served by a read replica
+replica_reads_enabled = ContextVar("replica_reads_enabled", default=False)
+
+
+def primary_pin_key(user_id):
+    return f"primary-pin:{user_id}"
+
+
+def pin_to_primary(user_id):
+    """
+    Send the user's reads to the primary for READ_YOUR_WRITES_WINDOW seconds after a
+    write. The pin is kept in the shared cache, so it holds whichever worker process
+    serves the next request. Without replicas every read is on the primary already.
+    """
+    if getattr(settings, "DATABASE_REPLICAS", []):
+        shared_cache().set(
+            primary_pin_key(user_id), True, settings.READ_YOUR_WRITES_WINDOW
+        )
+
+
+def is_pinned_to_primary(user_id):
+    return shared_cache().get(primary_pin_key(user_id), False)
+
+
+async def ais_pinned_to_primary(user_id):
+    return await shared_cache().aget(primary_pin_key(user_id), False)
+
+
+@contextmanager
+def reads_from(replicas):
+    # Send the reads made inside the block to the replicas, or to the primary
+    token = replica_reads_enabled.set(replicas)
+    try:
+        yield
+    finally:
+        replica_reads_enabled.reset(token)
+
+
+def replica_reads(user=None):
+    """
+    Let the reads made inside the block go to a read replica, unless the user wrote
+    recently and must read their own writes from the primary.
+    """
+    pinned = (
+        getattr(settings, "DATABASE_REPLICAS", [])
+        and user is not None
+        and user.is_authenticated
+        and is_pinned_to_primary(user.pk)
+    )
+    return reads_from(not pinned)
+
+
+async def areplica_reads(user=None):
+    # Return the replica_reads() block of the user, checking the pin without blocking the event loop
+    pinned = (
+        getattr(settings, "DATABASE_REPLICAS", [])
+        and user is not None
+        and user.is_authenticated
+        and await ais_pinned_to_primary(user.pk)
+    )
+    return reads_from(not pinned)
+
+
+def primary_reads():
+    # Send the reads made inside the block to the primary, even within replica_reads()
+    return reads_from(False)
+
+
+# Define a database router sending opted-in reads to the read replicas
+class PrimaryReplicaRouter:
+    """
+    Writes, and reads outside of a replica_reads() block, go to the primary "default"
+    database. Reads inside the block are spread over the DATABASE_REPLICAS aliases.
+    """
+
+    def db_for_read(self, model, **hints):
+        # The database cache holds shared versions, which must not be read behind the primary
+        if model._meta.app_label == "django_cache":
+            return "default"
+        replicas = getattr(settings, "DATABASE_REPLICAS", [])
+        if replicas and replica_reads_enabled.get():
+            return random.choice(replicas)
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold copies of the primary, so objects from any of them can be related
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema with the data, by copying the primary
+        return db == "default"
+
+
+# Define a view mixin serving the reads of list and search views from the replicas
+class ReplicaReadMixin:
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # Authentication has run, so the primary pin of the user can be checked
+        self._replica_reads = replica_reads(request.user)
+        self._replica_reads.__enter__()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        replica_context = getattr(self, "_replica_reads", None)
+        if replica_context is not None:
+            replica_context.__exit__(None, None, None)
+            self._replica_reads = None
+        return super().finalize_response(request, response, *args, **kwargs)
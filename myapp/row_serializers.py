@@ -0,0 +1,97 @@
+# row_serializers.py
+
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import fields, relations
+
+from .profiling import timed_serializer
+from .serializers import FriendshipSerializer1, UserCreateSerializer
+
+# DRF fields whose to_representation() returns database values of the right type unchanged
+PASSTHROUGH_FIELDS = (
+    fields.BooleanField,
+    fields.CharField,
+    fields.ChoiceField,
+    fields.IntegerField,
+    relations.PrimaryKeyRelatedField,
+)
+
+
+# Define a read-only serializer working on values_list() rows instead of model instances
+class RowSerializer:
+    """
+    Produces the same output as the readable fields of ``serializer_class``, without
+    instantiating models or running the DRF field machinery for every row.
+
+    The fields are resolved once per class into a mapper turning a row tuple into a
+    dict. Fields that need a conversion keep their DRF to_representation(); the others
+    are copied as they come from the database. Rows may carry extra trailing columns,
+    such as the pagination ordering key, which the mapper ignores.
+    """
+
+    serializer_class = None
+
+    _compiled = None
+
+    @classmethod
+    def compile(cls):
+        # Resolve the output names, the model columns and the mapper of the class, once
+        if cls.__dict__.get("_compiled") is not None:
+            return cls._compiled
+
+        names, sources, converters = [], [], []
+        for name, field in cls.serializer_class().fields.items():
+            if field.write_only:
+                continue
+            if "." in field.source or field.source == "*":
+                raise ImproperlyConfigured(
+                    f"{cls.__name__} cannot read the nested source of field {name!r}."
+                )
+            names.append(name)
+            sources.append(field.source)
+            if not isinstance(field, PASSTHROUGH_FIELDS):
+                converters.append((len(names) - 1, field.to_representation))
+
+        names = tuple(names)
+        if not converters:
+
+            def mapper(row):
+                return dict(zip(names, row))
+
+        else:
+
+            def mapper(row):
+                data = dict(zip(names, row))
+                for index, to_representation in converters:
+                    value = row[index]
+                    if value is not None:
+                        data[names[index]] = to_representation(value)
+                return data
+
+        cls._compiled = (names, tuple(sources), mapper)
+        return cls._compiled
+
+    @classmethod
+    def values(cls, queryset, extra=()):
+        """
+        Return the queryset as named rows of the serialized columns, followed by the
+        ``extra`` columns not already among them, e.g. the ordering key of a paginator.
+        """
+        _, sources, _ = cls.compile()
+        extra = [name.lstrip("-") for name in extra if name.lstrip("-") not in sources]
+        return queryset.values_list(*sources, *extra, named=True)
+
+    @classmethod
+    @timed_serializer
+    def serialize(cls, rows):
+        _, _, mapper = cls.compile()
+        return [mapper(row) for row in rows]
+
+
+# Define the read path of user lists, matching UserCreateSerializer
+class UserRowSerializer(RowSerializer):
+    serializer_class = UserCreateSerializer
+
+
+# Define the read path of pending friend request lists, matching FriendshipSerializer1
+class PendingRequestRowSerializer(RowSerializer):
+    serializer_class = FriendshipSerializer1
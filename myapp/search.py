@@ -0,0 +1,391 @@
+# search.py
+
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Case, IntegerField, Q, Value, When
+from rest_framework import filters
+
+from .models import MyUser
+from .versions import (
+    bump_version,
+    feed_position,
+    get_version,
+    publish_changes,
+    read_changes,
+)
+
+# Score given to a candidate, depending on how the term matched its fields
+EXACT_EMAIL_SCORE = 8
+EXACT_NAME_SCORE = 4
+PREFIX_SCORE = 2
+SUBSTRING_SCORE = 1
+
+# Fields of MyUser shown in search results: saves touching only other columns keep cached results
+DIRECTORY_FIELDS = {
+    "email",
+    "name",
+    "Gender",
+    "phonenumber",
+}
+
+# Fields of MyUser shown in search results that change with each friend request: rather than
+# the whole directory, a change drops the cached results showing the user
+COUNTER_FIELDS = ("friend_count", "pending_count")
+
+DIRECTORY_VERSION_KEY = "user-directory-version"
+
+# Shared change feed of the ids of users whose COUNTER_FIELDS changed
+COUNTER_CHANGES_KEY = "user-counter-changes"
+
+# Shared version of the search index, which changes with every created user, and change feed
+# of the ids of edited or deleted users
+INDEX_VERSION_KEY = "user-index-version"
+INDEX_CHANGES_KEY = "user-index-changes"
+
+
+def ngrams(text, n):
+    # Return the set of all n-character substrings of the given text
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+# Define an in-process inverted index over the name and email of every user
+class NgramIndex:
+    """
+    Maps every n-gram of a user's lowercased name and email to the set of user ids
+    containing it, so a search only visits the users sharing all n-grams of the term.
+
+    The index is built lazily from the database on the first search and then kept up
+    to date by the MyUser post_save/post_delete signal handlers. It lives in the
+    memory of the current process, so the handlers also bump a shared version when
+    users are created, and publish the ids of edited or deleted users to a shared
+    change feed. refresh() reads both before a search, and loads the users above the
+    highest id read from the database together with the published ones, in one query.
+    The index is only rebuilt when it missed some of the published ids.
+    """
+
+    def __init__(self, n=3):
+        self.n = n
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        # Drop all indexed data; the index is rebuilt from the database on next use
+        with self._lock:
+            self._postings = defaultdict(set)
+            self._docs = {}
+            self._built = False
+            self._version = None
+            self._position = None
+            # Highest id loaded from the database: users indexed by this process alone,
+            # as they were saved, may have higher ids than users created elsewhere
+            self._max_id = 0
+
+    @property
+    def built(self):
+        return self._built
+
+    def ensure_built(self):
+        # Build the index from the database unless it is already built
+        if not self._built:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the changes made by every process. The version
+        and the change feed are read before the rows, so a change made meanwhile is
+        applied again on the next refresh.
+        """
+        with self._lock:
+            if not self._built:
+                self._build()
+                return
+            version = get_version(INDEX_VERSION_KEY)
+            changed, position = read_changes(INDEX_CHANGES_KEY, self._position)
+            if changed is None:
+                self._build()
+                return
+            if version == self._version and not changed:
+                return
+
+            # Read from the primary: rows missing from a lagging replica would never be indexed
+            rows = MyUser.objects.using("default").values_list("id", "name", "email")
+            for pk in changed:
+                # Deleted users are not read back
+                self._remove(pk)
+            for pk, name, email in rows.filter(
+                Q(pk__gt=self._max_id) | Q(pk__in=changed)
+            ).iterator(chunk_size=10000):
+                self._remove(pk)
+                self._add(pk, name, email)
+                self._max_id = max(self._max_id, pk)
+            self._version, self._position = version, position
+
+    async def arefresh(self):
+        await sync_to_async(self.refresh)()
+
+    def _build(self):
+        # Index every user from scratch
+        position = feed_position(INDEX_CHANGES_KEY)
+        version = get_version(INDEX_VERSION_KEY)
+        self._postings = defaultdict(set)
+        self._docs = {}
+        self._max_id = 0
+        rows = MyUser.objects.using("default").values_list("id", "name", "email")
+        for pk, name, email in rows.iterator(chunk_size=10000):
+            self._add(pk, name, email)
+            self._max_id = max(self._max_id, pk)
+        self._version, self._position = version, position
+        self._built = True
+
+    def _add(self, pk, name, email):
+        doc = ((name or "").lower(), (email or "").lower())
+        self._docs[pk] = doc
+        for gram in ngrams(doc[0], self.n) | ngrams(doc[1], self.n):
+            self._postings[gram].add(pk)
+
+    def _remove(self, pk):
+        doc = self._docs.pop(pk, None)
+        if doc is None:
+            return
+        for gram in ngrams(doc[0], self.n) | ngrams(doc[1], self.n):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(pk)
+                if not postings:
+                    del self._postings[gram]
+
+    def update(self, pk, name, email):
+        # Re-index a single user; ignored until the index has been built
+        with self._lock:
+            if not self._built:
+                return
+            self._remove(pk)
+            self._add(pk, name, email)
+
+    def remove(self, pk):
+        with self._lock:
+            if self._built:
+                self._remove(pk)
+
+    def _score(self, term, name, email):
+        if email == term:
+            return EXACT_EMAIL_SCORE
+        if name == term:
+            return EXACT_NAME_SCORE
+        if name.startswith(term) or email.startswith(term):
+            return PREFIX_SCORE
+        if term in name or term in email:
+            return SUBSTRING_SCORE
+        return 0
+
+    def search(self, terms, limit=None):
+        """
+        Return the ids of the users matching every term, best match first.
+
+        Each term must be at least ``n`` characters long and already lowercased.
+        """
+        self.ensure_built()
+        scores = None
+        with self._lock:
+            for term in terms:
+                postings = [self._postings.get(gram) for gram in ngrams(term, self.n)]
+                if not postings or not all(postings):
+                    return []
+                postings.sort(key=len)
+                candidates = postings[0].intersection(*postings[1:])
+
+                # The n-grams only narrow down the candidates, so confirm the actual match
+                term_scores = {}
+                for pk in candidates:
+                    if scores is not None and pk not in scores:
+                        continue
+                    score = self._score(term, *self._docs[pk])
+                    if score:
+                        term_scores[pk] = score + (scores[pk] if scores else 0)
+                scores = term_scores
+                if not scores:
+                    return []
+
+        ranked = sorted(scores, key=lambda pk: (-scores[pk], pk))
+        return ranked[:limit] if limit else ranked
+
+
+user_index = NgramIndex(n=getattr(settings, "SEARCH_NGRAM_SIZE", 3))
+
+
+# Define a search filter backend that answers searches from the n-gram index
+class NgramSearchFilter(filters.SearchFilter):
+    """
+    Terms shorter than the n-gram size cannot be looked up in the index, so those
+    searches fall back to the view's regular ``search_fields``.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        terms = [term.lower() for term in self.get_search_terms(request)]
+        if not terms or any(len(term) < user_index.n for term in terms):
+            return super().filter_queryset(request, queryset, view)
+
+        ranked = user_index.search(
+            terms, limit=getattr(settings, "SEARCH_MAX_RESULTS", 1000)
+        )
+        if not ranked:
+            return queryset.none()
+
+        # Keep the ranking of the index in the SQL ordering
+        rank = Case(
+            *[When(pk=pk, then=Value(position)) for position, pk in enumerate(ranked)],
+            output_field=IntegerField(),
+        )
+        return (
+            queryset.filter(pk__in=ranked)
+            .annotate(search_rank=rank)
+            .order_by("search_rank", "pk")
+        )
+
+
+def directory_version():
+    # Return the version of the user directory, which grows whenever a user is created,
+    # deleted or has one of the DIRECTORY_FIELDS changed
+    return get_version(DIRECTORY_VERSION_KEY)
+
+
+def bump_directory_version():
+    bump_version(DIRECTORY_VERSION_KEY)
+    # This process reads the new version on its next search, the others within an interval
+    search_cache.expire_version()
+
+
+def bump_index_version():
+    # Tell the search index of every process to load the users created since
+    bump_version(INDEX_VERSION_KEY)
+
+
+def publish_index_changes(user_ids):
+    # Tell the search index of every process to read the edited or deleted users again
+    publish_changes(INDEX_CHANGES_KEY, user_ids)
+
+
+def publish_counter_changes(user_ids):
+    # Drop the cached results showing the users, in this process now and in the others
+    # on their next version check
+    search_cache.forget_users(user_ids)
+    publish_changes(COUNTER_CHANGES_KEY, user_ids)
+
+
+# Define an in-process LRU of search responses
+class SearchResultCache:
+    """
+    Maps a search, made of the directory version, the normalized search terms and the
+    requested page, to its response data and the ids of the users in it. Changing the
+    directory bumps the version, so older entries are never read again and age out of
+    the LRU. The counters of the users are not part of the directory: the entries
+    showing a user whose counters changed are dropped instead.
+
+    The version and the changed counters are kept in the shared cache, so a change made
+    through any worker invalidates the entries of every process. They are read at most
+    once per ``check_interval`` seconds, so a hit makes no query, and a change made
+    through another worker is served within that time. Entries also expire after
+    ``ttl`` seconds, which bounds how long a missed bump, e.g. a row changed outside
+    the ORM, is served. Entries are filled from the primary database, so a lagging
+    replica cannot store old rows under the new version.
+    """
+
+    def __init__(self, max_size=1000, ttl=60, check_interval=1):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.clear()
+
+    def expire_version(self):
+        # Read the shared version again on the next search
+        self._checked_at = None
+
+    def current_version(self):
+        """
+        Return the directory version, read from the shared cache at most once per
+        check_interval seconds, together with the users whose counters changed since.
+        """
+        now = time.monotonic()
+        if (
+            self._checked_at is not None
+            and now - self._checked_at < self.check_interval
+        ):
+            return self._version
+
+        version = directory_version()
+        if self._position is None:
+            changed, position = [], feed_position(COUNTER_CHANGES_KEY)
+        else:
+            changed, position = read_changes(COUNTER_CHANGES_KEY, self._position)
+        if changed is None:
+            with self._lock:
+                self._entries.clear()
+        else:
+            self.forget_users(changed)
+        self._version, self._position, self._checked_at = version, position, now
+        return version
+
+    def make_key(self, request, terms):
+        # The version is read before the search runs, so a concurrent change gets a newer key
+        params = request.query_params
+        return (
+            self.current_version(),
+            request.get_host(),
+            tuple(sorted({term.lower() for term in terms})),
+            params.get("cursor"),
+            params.get("page_size"),
+            params.get("ordering"),
+        )
+
+    def get(self, key):
+        # Return the response data, or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            data, _, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def set(self, key, data, user_ids):
+        with self._lock:
+            self._entries[key] = (
+                data,
+                frozenset(user_ids),
+                time.monotonic() + self.ttl,
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def forget_users(self, user_ids):
+        # Drop the entries showing any of the users
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        with self._lock:
+            for key, (_, entry_user_ids, _) in list(self._entries.items()):
+                if not user_ids.isdisjoint(entry_user_ids):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self.expire_version()
+        self._position = None
+
+
+search_cache = SearchResultCache(
+    max_size=getattr(settings, "SEARCH_CACHE_SIZE", 1000),
+    ttl=getattr(settings, "SEARCH_CACHE_TTL", 60),
+    check_interval=getattr(settings, "SEARCH_CACHE_CHECK_INTERVAL", 1),
+)
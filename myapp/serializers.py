@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from .models import Friendship
@@ -10,7 +11,15 @@ User = get_user_model()
 class UserCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ("email", "password", "name", "Gender", "phonenumber")
+        fields = (
+            "email",
+            "password",
+            "name",
+            "Gender",
+            "phonenumber",
+            "friend_count",
+            "pending_count",
+        )
         extra_kwargs = {"password": {"write_only": True}}
     
     
@@ -43,3 +52,61 @@ class FriendRequestAcceptSerializer(serializers.ModelSerializer):
     class Meta:
         model = Friendship
         fields = ["accepted"]
+
+
+# Serializer for sending friend requests to many users at once
+class FriendRequestBatchSerializer(serializers.Serializer):
+    to_users = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False,
+        max_length=getattr(settings, "FRIEND_REQUEST_BATCH_SIZE", 100),
+    )
+
+
+# Serializer for accepting or rejecting many pending friend requests at once
+class FriendRequestBulkSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False,
+        required=False,
+        max_length=getattr(settings, "FRIEND_REQUEST_BULK_SIZE", 1000),
+    )
+    all = serializers.BooleanField(default=False)
+    created_before = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        if ("ids" in attrs) == attrs["all"]:
+            raise serializers.ValidationError(
+                "Provide either the request ids or all=true."
+            )
+        return attrs
+
+
+# Serializer for the user ids of a relationship lookup
+class RelationshipLookupSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False,
+        max_length=getattr(settings, "RELATIONSHIP_BATCH_SIZE", 100),
+    )
+
+
+# Serializer for the query parameters of the friendship change log
+class ChangeLogQuerySerializer(serializers.Serializer):
+    since = serializers.IntegerField(min_value=0, required=False)
+
+
+# Serializer for friend suggestions, with the number of friends in common
+class FriendSuggestionSerializer(serializers.ModelSerializer):
+    mutual_friends = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = User
+        fields = (
+            "id",
+            "email",
+            "name",
+            "friend_count",
+            "pending_count",
+            "mutual_friends",
+        )
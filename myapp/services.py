@@ -1,16 +1,52 @@
 # services.py
 
-from .models import Friendship
+from .changes import log_changes
+from .counters import adjust_counts
+from .events import FRIEND_REQUEST, FRIEND_REQUEST_ACCEPTED, notify_user
+from .friend_cache import friend_cache
+from .graph import friend_graph, publish_graph_changes
+from .models import Friendship, FriendshipChange
+from .relationships import bump_relationship_versions
 from .serializers import FriendshipSerializer
+from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 from rest_framework import status
 import logging
-from django.db import IntegrityError
+from collections import Counter
+from django.db import IntegrityError, transaction
 
 
 logger = logging.getLogger(__name__)
 
 
+def friend_requests_accepted(user_id, rows):
+    # update() sends no post_save signal, so do what the Friendship receivers would have done
+    friend_ids = [from_id for _, from_id in rows]
+    friend_cache.add_friendships(user_id, friend_ids)
+    for friend_id in friend_ids:
+        friend_graph.add_friendship(user_id, friend_id)
+    publish_graph_changes([(user_id, friend_id) for friend_id in friend_ids])
+    bump_relationship_versions(user_id, *friend_ids)
+    for request_id, from_id in rows:
+        notify_accepted(request_id, from_id, user_id)
+
+
+def notify_friend_request(friend_request):
+    # Push a new request to the receiver's open streams
+    notify_user(
+        friend_request.to_user_id,
+        FRIEND_REQUEST,
+        {"id": friend_request.id, "from_user": friend_request.from_user_id},
+    )
+
+
+def notify_accepted(request_id, from_user_id, to_user_id):
+    # Tell the sender of a request that it was accepted
+    notify_user(
+        from_user_id, FRIEND_REQUEST_ACCEPTED, {"id": request_id, "by_user": to_user_id}
+    )
+
+
 # Define a service class for handling friend requests
 class FriendRequestService:
     """
@@ -25,24 +61,49 @@ class FriendRequestService:
                 logger.error("Attempt to send a friend request to oneself")
                 raise ValidationError("You cannot send a friend request to yourself.")
 
+            # Look up an existing request between the two users, in either direction, with one index probe
+            existing_sender = (
+                Friendship.objects.between(from_user.id, to_user.id)
+                .values_list("from_user", flat=True)
+                .first()
+            )
+
             # Check if a friend request has already been sent from the sender to the receiver
-            if Friendship.objects.filter(from_user=from_user, to_user=to_user).exists():
+            if existing_sender == from_user.id:
                 logger.warning("Friend request already sent to this user.")
                 raise ValidationError(
                     "You've already sent a friend request to this user."
                 )
 
             # Check if a friend request has already been received from the sender by the receiver
-            if Friendship.objects.filter(from_user=to_user, to_user=from_user).exists():
+            if existing_sender is not None:
                 logger.warning("Friend request already received from this user.")
                 raise ValidationError(
                     "Do not send a friend request to the same user again."
                 )
 
-            # Create a new Friendship object representing the friend request
-            friend_request = Friendship.objects.create(
-                from_user=from_user, to_user=to_user
-            )
+            # Create a new Friendship object representing the friend request; the unique pair
+            # constraint rejects a request created concurrently in either direction
+            try:
+                with transaction.atomic():
+                    friend_request = Friendship.objects.create(
+                        from_user=from_user, to_user=to_user
+                    )
+                    adjust_counts(pending={to_user.id: 1})
+                    log_changes(
+                        FriendshipChange.SENT,
+                        [(from_user.id, to_user.id, friend_request.id)],
+                    )
+                    transaction.on_commit(
+                        lambda: notify_friend_request(friend_request)
+                    )
+            except IntegrityError:
+                if not Friendship.objects.between(from_user.id, to_user.id).exists():
+                    raise
+                logger.warning("Concurrent friend request between the same users.")
+                raise ValidationError(
+                    "A friend request between these users already exists."
+                )
 
             # Serialize the newly created Friendship object
             serializer = FriendshipSerializer(friend_request)
@@ -55,12 +116,202 @@ class FriendRequestService:
 
         # Catch IntegrityError exceptions, typically raised for database integrity constraints violations
         except IntegrityError as e:
-            logger.error(f"Failed to create friendship record: {e}")
+            logger.error("Failed to create friendship record: %s", e)
             return {
                 "error": "An unexpected error occurred."
             }, status.HTTP_500_INTERNAL_SERVER_ERROR
 
         # Catch ValidationError exceptions, raised for validation errors
         except ValidationError as e:
-            logger.warning(f"Friend request validation error: {e}")
+            logger.warning("Friend request validation error: %s", e)
             return {"error": str(e)}, status.HTTP_400_BAD_REQUEST
+
+    # Static method for sending friend requests to many users at once
+    @staticmethod
+    def send_friend_requests(from_user, to_user_ids):
+        # Keep the first occurrence of every target id, in the order given
+        to_user_ids = list(dict.fromkeys(to_user_ids))
+
+        # Resolve all the target users in one query
+        existing_users = set(
+            get_user_model()
+            .objects.filter(pk__in=to_user_ids)
+            .values_list("pk", flat=True)
+        )
+
+        # A request created concurrently for one of the targets fails the insert: the targets
+        # are then resolved again, and that one reported like any existing request
+        for attempt in range(3):
+            results, new_requests = FriendRequestService.resolve_friend_requests(
+                from_user, to_user_ids, existing_users
+            )
+            try:
+                # Insert all the new friend requests in a single transaction
+                with transaction.atomic():
+                    Friendship.objects.bulk_create(new_requests)
+                    adjust_counts(pending={row.to_user_id: 1 for row in new_requests})
+                    log_changes(
+                        FriendshipChange.SENT,
+                        [
+                            (from_user.id, row.to_user_id, row.id)
+                            for row in new_requests
+                        ],
+                    )
+                    for row in new_requests:
+                        transaction.on_commit(
+                            lambda row=row: notify_friend_request(row)
+                        )
+
+                    # bulk_create sends no post_save signal, so bump the relationship versions here
+                    user_ids = [from_user.id] + [row.to_user_id for row in new_requests]
+                    transaction.on_commit(lambda: bump_relationship_versions(*user_ids))
+                break
+            except IntegrityError as e:
+                if attempt == 2:
+                    logger.error("Failed to create friendship records: %s", e)
+                    return {
+                        "error": "An unexpected error occurred."
+                    }, status.HTTP_500_INTERNAL_SERVER_ERROR
+                logger.warning("Concurrent friend request between the same users.")
+
+        return {
+            "message": f"{len(new_requests)} friend request(s) sent.",
+            "results": results,
+        }, status.HTTP_200_OK
+
+    # Static method building the result of every target of a batch and the friend requests to create
+    @staticmethod
+    def resolve_friend_requests(from_user, to_user_ids, existing_users):
+        # Find the requests already sent to, or received from, any of the targets in one query
+        # over the canonical pairs (lowest user id, highest user id)
+        sent, received = set(), set()
+        for sender_id, receiver_id in Friendship.objects.between_many(
+            from_user.id, to_user_ids
+        ).values_list("from_user", "to_user"):
+            if sender_id == from_user.id:
+                sent.add(receiver_id)
+            else:
+                received.add(sender_id)
+
+        results, new_requests = [], []
+        for to_user_id in to_user_ids:
+            if to_user_id == from_user.id:
+                error = "You cannot send a friend request to yourself."
+            elif to_user_id not in existing_users:
+                error = "Invalid to_user id."
+            elif to_user_id in sent:
+                error = "You've already sent a friend request to this user."
+            elif to_user_id in received:
+                error = "Do not send a friend request to the same user again."
+            else:
+                error = None
+                new_requests.append(
+                    Friendship(from_user=from_user, to_user_id=to_user_id)
+                )
+
+            if error:
+                results.append({"to_user": to_user_id, "error": error})
+            else:
+                results.append({"to_user": to_user_id, "status": "sent"})
+        return results, new_requests
+
+    # Static method for accepting many pending friend requests at once
+    @staticmethod
+    def accept_friend_requests(user, ids=None, created_before=None):
+        """
+        Accept the pending requests received by the user with the given request ids, or
+        all of them when ids is None, with one SELECT and one UPDATE.
+        """
+        with transaction.atomic():
+            pending = FriendRequestService.pending_requests(user, ids, created_before)
+            rows = list(
+                pending.select_for_update().order_by("id").values_list("id", "from_user")
+            )
+            if rows:
+                # Leave alone the requests received since the rows were read
+                pending.filter(id__lte=rows[-1][0]).update(accepted=True)
+                friend_ids = [from_id for _, from_id in rows]
+                adjust_counts(
+                    friends={user.id: len(rows), **dict.fromkeys(friend_ids, 1)},
+                    pending={user.id: -len(rows)},
+                )
+                log_changes(
+                    FriendshipChange.ACCEPTED,
+                    [(from_id, user.id, request_id) for request_id, from_id in rows],
+                )
+                transaction.on_commit(lambda: friend_requests_accepted(user.id, rows))
+
+        logger.info("User %s accepted %s friend request(s)", user.id, len(rows))
+        return {
+            "message": f"{len(rows)} friend request(s) accepted.",
+            "ids": [request_id for request_id, _ in rows],
+        }, status.HTTP_200_OK
+
+    # Static method for rejecting many pending friend requests at once
+    @staticmethod
+    def reject_friend_requests(user, ids=None, created_before=None):
+        """
+        Delete the pending requests received by the user with the given request ids, or
+        all of them when ids is None, with one SELECT and one DELETE.
+        """
+        with transaction.atomic():
+            pending = FriendRequestService.pending_requests(user, ids, created_before)
+            rows = list(
+                pending.select_for_update().order_by("id").values_list("id", "from_user")
+            )
+            if rows:
+                # Leave alone the requests received since the rows were read
+                pending.filter(id__lte=rows[-1][0]).delete_pending()
+                adjust_counts(pending={user.id: -len(rows)})
+                log_changes(
+                    FriendshipChange.DELETED,
+                    [(from_id, user.id, request_id) for request_id, from_id in rows],
+                )
+                user_ids = [user.id] + [from_id for _, from_id in rows]
+                transaction.on_commit(lambda: bump_relationship_versions(*user_ids))
+
+        logger.info("User %s rejected %s friend request(s)", user.id, len(rows))
+        return {
+            "message": f"{len(rows)} friend request(s) rejected.",
+            "ids": [request_id for request_id, _ in rows],
+        }, status.HTTP_200_OK
+
+    @staticmethod
+    def pending_requests(user, ids=None, created_before=None):
+        # Return the pending requests received by the user, optionally narrowed down
+        pending = Friendship.objects.filter(to_user=user, accepted=False)
+        if ids is not None:
+            pending = pending.filter(id__in=ids)
+        if created_before is not None:
+            pending = pending.filter(created_at__lt=created_before)
+        return pending
+
+    # Static method for deleting one batch of the pending requests older than a cutoff
+    @staticmethod
+    def expire_friend_requests(cutoff, batch_size):
+        """
+        Delete up to batch_size of the oldest pending requests created before the cutoff,
+        in a transaction of its own, and return the number deleted.
+        """
+        with transaction.atomic():
+            rows = list(
+                Friendship.objects.filter(accepted=False, created_at__lt=cutoff)
+                .select_for_update()
+                .order_by("created_at", "id")
+                .values_list("id", "from_user", "to_user")[:batch_size]
+            )
+            if rows:
+                Friendship.objects.filter(
+                    id__in=[request_id for request_id, _, _ in rows]
+                ).delete_pending()
+                received = Counter(to_id for _, _, to_id in rows)
+                adjust_counts(
+                    pending={to_id: -count for to_id, count in received.items()}
+                )
+                log_changes(
+                    FriendshipChange.DELETED,
+                    [(from_id, to_id, request_id) for request_id, from_id, to_id in rows],
+                )
+                user_ids = [user_id for _, *pair in rows for user_id in pair]
+                transaction.on_commit(lambda: bump_relationship_versions(*user_ids))
+        return len(rows)
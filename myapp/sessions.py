@@ -0,0 +1,213 @@
+# sessions.py
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends import cached_db
+from django.contrib.sessions.backends.base import VALID_KEY_CHARS, CreateError
+from django.contrib.sessions.models import Session
+from django.db import DatabaseError, connections, router, transaction
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+logger = logging.getLogger(__name__)
+
+
+# Define a buffer of the session writes of the process not yet in the database
+class SessionWriteBuffer:
+    """
+    Keeps the latest state of every session saved or deleted by the process: a Session
+    instance to upsert, or None to delete. The pending writes go to the database in one
+    transaction, with one upsert and one DELETE, from a background thread every
+    ``interval`` seconds, and at exit.
+
+    A write that finds ``max_pending`` sessions pending flushes them on its own thread,
+    unless another thread is already flushing, so the buffer stays bounded under load.
+    """
+
+    def __init__(self, interval=5, max_pending=500):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _ensure_timer(self):
+        # Threads do not survive a fork, so a forked worker starts its own timer
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(
+                target=self._run, name="session-writer", daemon=True
+            ).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            due_in = self._last_flush + self.interval - time.monotonic()
+            if due_in > 0:
+                time.sleep(due_in)
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush the session writes")
+            finally:
+                # Do not hold a database connection between flushes
+                connections.close_all()
+
+    def get(self, session_key):
+        # Return (True, Session or None) for a pending write, or (False, None)
+        with self._lock:
+            if session_key in self._pending:
+                return True, self._pending[session_key]
+        return False, None
+
+    def add(self, session_key, session):
+        self._ensure_timer()
+        with self._lock:
+            self._pending[session_key] = session
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush(blocking=False)
+
+    def flush(self, blocking=True):
+        # Flushes run one at a time, so an older state never overwrites a newer one
+        if not self._flush_lock.acquire(blocking=blocking):
+            return
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._last_flush = time.monotonic()
+            if pending:
+                self.write(pending)
+        finally:
+            self._flush_lock.release()
+
+    def write(self, pending):
+        saves = [session for session in pending.values() if session is not None]
+        deletes = [key for key, session in pending.items() if session is None]
+        using = router.db_for_write(Session)
+        try:
+            with transaction.atomic(using=using):
+                if saves:
+                    Session.objects.using(using).bulk_create(
+                        saves,
+                        update_conflicts=True,
+                        unique_fields=["session_key"],
+                        update_fields=["session_data", "expire_date"],
+                    )
+                if deletes:
+                    Session.objects.using(using).filter(
+                        session_key__in=deletes
+                    ).delete()
+        except DatabaseError:
+            logger.exception("Failed to write %s session(s)", len(pending))
+            # Retry with the next flush, unless the sessions changed since
+            with self._lock:
+                for key, session in pending.items():
+                    self._pending.setdefault(key, session)
+
+    def clear(self):
+        # Forget the pending writes, without writing them
+        with self._lock:
+            self._pending.clear()
+
+
+write_buffer = SessionWriteBuffer(
+    interval=getattr(settings, "SESSION_WRITE_BEHIND_INTERVAL", 5),
+    max_pending=getattr(settings, "SESSION_WRITE_BEHIND_MAX_PENDING", 500),
+)
+
+
+# Define a session store writing to the cache at once and to the database later
+class SessionStore(cached_db.SessionStore):
+    """
+    Reads sessions from the SESSION_CACHE_ALIAS cache, falling back to the pending
+    writes of the process and then to the database, and saves them to the cache only,
+    queueing the database write in ``write_buffer``. Logging in and serving a session
+    request then touch the cache alone, while the database keeps a copy for when the
+    cache entry is evicted or the cache restarts.
+
+    Sessions written in the last SESSION_WRITE_BEHIND_INTERVAL seconds are in the cache
+    and in the memory of the process that wrote them only, so workers must share the
+    cache, e.g. Redis or Memcached; the myapp.E002 system check enforces it.
+    """
+
+    def create(self):
+        # A new key has 32 random characters: instead of a database lookup, uniqueness is
+        # checked with an atomic cache add, and enforced by the primary key on flush
+        while True:
+            self._session_key = get_random_string(32, VALID_KEY_CHARS)
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue
+            self.modified = True
+            return
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        if must_create:
+            if not self._cache.add(self.cache_key, data, self.get_expiry_age()):
+                raise CreateError
+        else:
+            self._cache.set(self.cache_key, data, self.get_expiry_age())
+        write_buffer.add(self.session_key, self.create_model_instance(data))
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        self._cache.delete(self.cache_key_prefix + session_key)
+        write_buffer.add(session_key, None)
+
+    def _get_session_from_db(self):
+        # On a cache miss, a write of this process not yet flushed is newer than the database
+        found, session = write_buffer.get(self.session_key)
+        if not found:
+            return super()._get_session_from_db()
+        if session is None or session.expire_date <= timezone.now():
+            self._session_key = None
+            return None
+        return session
+
+    @classmethod
+    def clear_expired(cls):
+        # Used by the clearsessions command
+        purge_expired_sessions(getattr(settings, "SESSION_PURGE_BATCH_SIZE", 1000))
+
+
+def purge_expired_sessions(batch_size=1000, pause=0):
+    """
+    Delete the expired rows of the session table, oldest first, batch_size rows per
+    statement over the expire_date index, so no write lock is held for long. Return the
+    number of rows deleted.
+    """
+    now = timezone.now()
+    total = 0
+    while True:
+        keys = list(
+            Session.objects.filter(expire_date__lt=now)
+            .order_by("expire_date")
+            .values_list("session_key", flat=True)[:batch_size]
+        )
+        if keys:
+            Session.objects.filter(session_key__in=keys, expire_date__lt=now).delete()
+        total += len(keys)
+        if len(keys) < batch_size:
+            return total
+        time.sleep(pause)
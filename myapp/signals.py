@@ -0,0 +1,157 @@
+# signals.py
+
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .authentication import token_registry
+from .changes import log_user_deleted
+from .counters import forget_user_counts
+from .friend_cache import friend_cache
+from .graph import friend_graph, publish_graph_changes
+from .models import Friendship, MyUser
+from .profiling import record_query
+from .relationships import bump_relationship_versions
+from .search import (
+    DIRECTORY_FIELDS,
+    bump_directory_version,
+    bump_index_version,
+    publish_index_changes,
+    user_index,
+)
+
+
+# Keep the search index in sync with the name and email of saved users
+@receiver(post_save, sender=MyUser)
+def index_saved_user(sender, instance, created, update_fields=None, **kwargs):
+    # Saves that only touch other columns (e.g. last_login on login) need no re-indexing
+    if update_fields is not None and not {"name", "email"} & set(update_fields):
+        return
+    pk, name, email = instance.pk, instance.name, instance.email
+
+    def reindex():
+        user_index.update(pk, name, email)
+        # The indexes of the other processes load new users, and read edited ones again
+        if created:
+            bump_index_version()
+        else:
+            publish_index_changes([pk])
+
+    transaction.on_commit(reindex)
+
+
+# Revoke the tokens of a user whose password changed, in every worker process
+@receiver(post_save, sender=MyUser)
+def revoke_tokens_on_password_change(sender, instance, created, **kwargs):
+    # set_password() keeps the raw password on the instance until save() completes
+    if not created and getattr(instance, "_password", None) is not None:
+        pk = instance.pk
+        transaction.on_commit(lambda: token_registry.revoke_user(pk))
+
+
+# Remove deleted users from the search index
+@receiver(post_delete, sender=MyUser)
+def unindex_deleted_user(sender, instance, **kwargs):
+    pk = instance.pk
+
+    def unindex():
+        user_index.remove(pk)
+        publish_index_changes([pk])
+
+    transaction.on_commit(unindex)
+
+
+# Invalidate the cached search results when a user shown in them is created, changed or deleted
+@receiver(post_save, sender=MyUser)
+def bump_directory_on_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not DIRECTORY_FIELDS & set(update_fields):
+        return
+    # On commit and after the index update, so no search can cache old rows under the new version
+    transaction.on_commit(bump_directory_version)
+
+
+@receiver(post_delete, sender=MyUser)
+def bump_directory_on_delete(sender, instance, **kwargs):
+    transaction.on_commit(bump_directory_version)
+
+
+# Log the friendships of a deleted user as deleted, before the cascade removes them
+@receiver(pre_delete, sender=MyUser)
+def log_deleted_user_friendships(sender, instance, **kwargs):
+    log_user_deleted(instance.pk)
+
+
+# Update the counters of the friends of a deleted user, before the cascade removes them
+@receiver(pre_delete, sender=MyUser)
+def uncount_deleted_user_friendships(sender, instance, **kwargs):
+    forget_user_counts(instance.pk)
+
+
+# Write accepted friendships through to the friend cache of both users
+@receiver(post_save, sender=Friendship)
+def cache_saved_friendship(sender, instance, **kwargs):
+    if instance.accepted:
+        from_id, to_id = instance.from_user_id, instance.to_user_id
+        transaction.on_commit(lambda: friend_cache.add_friendship(from_id, to_id))
+
+
+# Remove deleted friendships from the friend cache of both users
+@receiver(post_delete, sender=Friendship)
+def uncache_deleted_friendship(sender, instance, **kwargs):
+    if instance.accepted:
+        from_id, to_id = instance.from_user_id, instance.to_user_id
+        transaction.on_commit(lambda: friend_cache.remove_friendship(from_id, to_id))
+
+
+# Keep the friend suggestion graph in sync with accepted friendships, in every process
+@receiver(post_save, sender=Friendship)
+def graph_saved_friendship(sender, instance, **kwargs):
+    if instance.accepted:
+        from_id, to_id = instance.from_user_id, instance.to_user_id
+
+        def graph():
+            friend_graph.add_friendship(from_id, to_id)
+            publish_graph_changes([(from_id, to_id)])
+
+        transaction.on_commit(graph)
+
+
+# Remove deleted friendships from the friend suggestion graph, in every process
+@receiver(post_delete, sender=Friendship)
+def ungraph_deleted_friendship(sender, instance, **kwargs):
+    if instance.accepted:
+        from_id, to_id = instance.from_user_id, instance.to_user_id
+
+        def ungraph():
+            friend_graph.remove_friendship(from_id, to_id)
+            publish_graph_changes([(from_id, to_id)])
+
+        transaction.on_commit(ungraph)
+
+
+# Bump the relationship version of both users whenever a request is sent, accepted or rejected
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def bump_friendship_versions(sender, instance, **kwargs):
+    from_id, to_id = instance.from_user_id, instance.to_user_id
+    transaction.on_commit(lambda: bump_relationship_versions(from_id, to_id))
+
+
+# Apply the SQLite performance profile to every new database connection
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in getattr(settings, "SQLITE_PRAGMAS", {}).items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+
+# Measure the queries of profiled requests on every new database connection
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # The wrapper list outlives reconnections of the same connection object
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
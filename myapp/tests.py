@@ -1,11 +1,67 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
-from .models import Friendship
+from .models import Friendship, FriendshipChange, RevokedToken
 from rest_framework.test import APITestCase
 from rest_framework import status
+from .metrics import MetricsRegistry, log_records_dropped_total, metrics
 from .models import MyUser
+from .pagination import KeysetPagination
+from .profiling import RequestProfile
+from .relationships import intersection_size
+from .row_serializers import PendingRequestRowSerializer, UserRowSerializer
+from .authentication import issue_token, token_registry
+from .checks import check_session_cache
+from .friend_cache import friend_cache
+from .events import InProcessEventHub, get_event_hub
+from .graph import friend_graph
+from .log import QueueFileHandler
+from .routers import (
+    PrimaryReplicaRouter,
+    areplica_reads,
+    is_pinned_to_primary,
+    pin_to_primary,
+    primary_reads,
+    replica_reads,
+)
+from .search import (
+    INDEX_CHANGES_KEY,
+    SearchResultCache,
+    directory_version,
+    publish_counter_changes,
+    publish_index_changes,
+    search_cache,
+    user_index,
+)
+from .sessions import write_buffer
+from .serializers import FriendshipSerializer1, UserCreateSerializer
+from .throttling import SQLiteThrottleStore, get_throttle_store
+from .urls import urlpatterns
+from .versions import feed_position, shared_cache
+from .services import FriendRequestService
+from .views import FriendRequestBatchThrottle
 from django.urls import reverse
 
 
@@ -42,6 +98,7 @@ class TestURLs(APITestCase):
 
 class TestFriendRequest(APITestCase):
     def setUp(self):
+        get_throttle_store().clear()
         self.user1 = MyUser.objects.create_user(
             email="user1@example.com", password="password"
         )
@@ -78,3 +135,1998 @@ class TestFriendRequest(APITestCase):
             Friendship.objects.filter(from_user=self.user1, to_user=self.user2).count(),
             1,
         )
+
+
+##############################################################################################################
+
+
+class TestUserSearchIndex(APITestCase):
+    def setUp(self):
+        user_index.reset()
+        search_cache.clear()
+        self.user1 = MyUser.objects.create_user(
+            email="alice@example.com", password="password", name="Alice Walker"
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="malice@example.com", password="password", name="Bob Malice"
+        )
+        self.client.force_authenticate(user=self.user1)
+
+    def search(self, term):
+        response = self.client.get(reverse("search"), {"search": term})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [user["email"] for user in response.data["results"]]
+
+    def test_search_ranks_prefix_before_substring(self):
+        self.assertEqual(
+            self.search("alice"), ["alice@example.com", "malice@example.com"]
+        )
+
+    def test_search_requires_every_term(self):
+        self.assertEqual(self.search("alice walker"), ["alice@example.com"])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.search("alice")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user2.name = "Carol"
+            self.user2.email = "carol@example.com"
+            self.user2.save()
+        self.assertEqual(self.search("alice"), ["alice@example.com"])
+        self.assertEqual(self.search("carol"), ["carol@example.com"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user2.delete()
+        self.assertEqual(self.search("carol"), [])
+
+    def test_index_follows_changes_made_by_other_processes(self):
+        self.search("alice")
+        # Another process applies the changes to its own index only
+        with patch.object(user_index, "update"), patch.object(user_index, "remove"):
+            with self.captureOnCommitCallbacks(execute=True):
+                MyUser.objects.create_user(
+                    email="alicia@example.com", password="password", name="Alicia"
+                )
+            self.assertEqual(
+                self.search("alic"),
+                ["alice@example.com", "alicia@example.com", "malice@example.com"],
+            )
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user2.email = "bob@example.com"
+                self.user2.name = "Bob"
+                self.user2.save()
+            self.assertEqual(
+                self.search("alic"), ["alice@example.com", "alicia@example.com"]
+            )
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user1.delete()
+            self.assertEqual(self.search("alic"), ["alicia@example.com"])
+
+    def test_changes_are_applied_without_a_rebuild(self):
+        self.search("alice")
+        with patch.object(user_index, "update"), patch.object(user_index, "remove"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user2.name = "Carol"
+                self.user2.email = "carol@example.com"
+                self.user2.save()
+        # A user created and indexed by this process alone has the highest id, and
+        # must not hide the edits made elsewhere
+        with self.captureOnCommitCallbacks(execute=True):
+            MyUser.objects.create_user(
+                email="carola@example.com", password="password", name="Carola"
+            )
+
+        with patch.object(user_index, "_build") as build:
+            # The version and the change feed, then the created and edited users
+            with self.assertNumQueries(3):
+                user_index.refresh()
+            build.assert_not_called()
+        self.assertEqual(
+            user_index.search(["carol"]),
+            [self.user2.id, MyUser.objects.get(email="carola@example.com").id],
+        )
+
+    def test_lost_changes_rebuild_the_index(self):
+        self.search("alice")
+        publish_index_changes([self.user2.id])
+        # The entry expires before this process reads it
+        shared_cache().delete(f"{INDEX_CHANGES_KEY}:{feed_position(INDEX_CHANGES_KEY)}")
+        with patch.object(user_index, "_build") as build:
+            user_index.refresh()
+        build.assert_called_once()
+
+
+##############################################################################################################
+
+
+class TestKeysetPagination(APITestCase):
+    def setUp(self):
+        self.user = MyUser.objects.create_user(
+            email="owner@example.com", password="password"
+        )
+        for i in range(5):
+            friend = MyUser.objects.create_user(
+                email=f"friend{i}@example.com", password="password"
+            )
+            Friendship.objects.create(from_user=friend, to_user=self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def collect_pages(self, url, page_size):
+        ids, pages = [], 0
+        response = self.client.get(url, {"page_size": page_size})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data["results"]), page_size)
+            ids.extend(row["from_user"] for row in response.data["results"])
+            pages += 1
+            if not response.data["next"]:
+                return ids, pages
+            response = self.client.get(response.data["next"])
+
+    def test_pending_requests_are_paginated_without_gaps(self):
+        ids, pages = self.collect_pages(reverse("pending-requests"), page_size=2)
+        self.assertEqual(pages, 3)
+        self.assertEqual(
+            ids,
+            list(
+                Friendship.objects.order_by("created_at", "id").values_list(
+                    "from_user", flat=True
+                )
+            ),
+        )
+
+    @override_settings(MAX_PAGE_SIZE=3)
+    def test_page_size_is_capped(self):
+        response = self.client.get(reverse("search"), {"page_size": 50})
+        self.assertEqual(len(response.data["results"]), 3)
+        self.assertIsNotNone(response.data["next"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("search"), {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_values_of_the_wrong_type(self):
+        encode = KeysetPagination().encode_cursor
+        for url, params in [
+            (reverse("search"), {"cursor": encode(["x"])}),
+            (reverse("search"), {"cursor": encode([None])}),
+            (reverse("search"), {"search": "friend", "cursor": encode([{}, 1])}),
+            (reverse("pending-requests"), {"cursor": encode(["yesterday", 1])}),
+            (reverse("pending-requests"), {"cursor": encode([[], "1"])}),
+        ]:
+            with self.subTest(url=url, params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+                self.assertEqual(response.data["detail"], "Invalid cursor")
+
+
+##############################################################################################################
+
+
+class TestFriendCache(APITestCase):
+    def setUp(self):
+        friend_cache.cache.clear()
+        self.user1 = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="user2@example.com", password="password"
+        )
+        self.user3 = MyUser.objects.create_user(
+            email="user3@example.com", password="password"
+        )
+        Friendship.objects.create(
+            from_user=self.user3, to_user=self.user1, accepted=True
+        )
+        self.client.force_authenticate(user=self.user1)
+
+    def friend_ids(self):
+        response = self.client.get(reverse("friends"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [row["to_user"] for row in response.data["results"]]
+
+    def test_repeated_reads_skip_the_database(self):
+        self.assertEqual(self.friend_ids(), [self.user3.id])
+        # Only the relationship version of the list ETag is read, from the shared cache
+        with self.assertNumQueries(1):
+            self.assertEqual(self.friend_ids(), [self.user3.id])
+
+    def test_accept_and_reject_update_the_cache(self):
+        self.assertEqual(self.friend_ids(), [self.user3.id])
+        friend_request = Friendship.objects.create(
+            from_user=self.user2, to_user=self.user1
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("accept-friend-request", args=[friend_request.id])
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.friend_ids(), [self.user2.id, self.user3.id])
+
+        self.client.force_authenticate(user=self.user3)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(
+                reverse("reject-request", args=[self.user1.id])
+            )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.client.force_authenticate(user=self.user1)
+        self.assertEqual(self.friend_ids(), [self.user2.id])
+
+
+##############################################################################################################
+
+
+class TestFriendRequestBatch(APITestCase):
+    def setUp(self):
+        get_throttle_store().clear()
+        self.user1 = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="user2@example.com", password="password"
+        )
+        self.user3 = MyUser.objects.create_user(
+            email="user3@example.com", password="password"
+        )
+        self.user4 = MyUser.objects.create_user(
+            email="user4@example.com", password="password"
+        )
+        self.client.force_authenticate(user=self.user1)
+
+    def test_send_friend_requests(self):
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2)
+        Friendship.objects.create(from_user=self.user3, to_user=self.user1)
+        targets = [self.user2.id, self.user3.id, self.user4.id, self.user1.id, 0]
+
+        # Resolve the users, look up existing requests, then insert, count and log the
+        # new pending requests inside a savepoint
+        with self.assertNumQueries(7):
+            response = self.client.post(
+                reverse("friend-request-batch"), {"to_users": targets}, format="json"
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data["results"]
+        self.assertEqual([result["to_user"] for result in results], targets)
+        self.assertEqual(
+            [result.get("status") for result in results],
+            [None, None, "sent", None, None],
+        )
+        self.assertTrue(
+            Friendship.objects.filter(from_user=self.user1, to_user=self.user4).exists()
+        )
+
+    def test_batch_is_throttled_by_number_of_targets(self):
+        with patch.object(
+            FriendRequestBatchThrottle,
+            "THROTTLE_RATES",
+            {"friend_request_batch": "3/minute"},
+        ):
+            url = reverse("friend-request-batch")
+            response = self.client.post(
+                url, {"to_users": [self.user2.id, self.user3.id]}, format="json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.post(
+                url, {"to_users": [self.user4.id, 0]}, format="json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_oversized_batch_counts_as_one_request(self):
+        with patch.object(
+            FriendRequestBatchThrottle,
+            "THROTTLE_RATES",
+            {"friend_request_batch": "3/minute"},
+        ):
+            url = reverse("friend-request-batch")
+            to_users = list(range(1, settings.FRIEND_REQUEST_BATCH_SIZE + 2))
+            response = self.client.post(url, {"to_users": to_users}, format="json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.client.post(
+                url, {"to_users": [self.user2.id, self.user3.id]}, format="json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_concurrent_requests_are_reported_per_target(self):
+        resolve = FriendRequestService.resolve_friend_requests
+
+        def resolve_then_race(from_user, to_user_ids, existing_users):
+            result = resolve(from_user, to_user_ids, existing_users)
+            if not Friendship.objects.filter(from_user=self.user3).exists():
+                # Another worker sends a request between the same users meanwhile
+                Friendship.objects.create(from_user=self.user3, to_user=self.user1)
+            return result
+
+        with patch.object(
+            FriendRequestService,
+            "resolve_friend_requests",
+            side_effect=resolve_then_race,
+        ):
+            response = self.client.post(
+                reverse("friend-request-batch"),
+                {"to_users": [self.user2.id, self.user3.id]},
+                format="json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result.get("status") for result in response.data["results"]],
+            ["sent", None],
+        )
+        self.assertTrue(
+            Friendship.objects.filter(from_user=self.user1, to_user=self.user2).exists()
+        )
+
+
+##############################################################################################################
+
+
+class TestCanonicalFriendshipPair(APITestCase):
+    def setUp(self):
+        get_throttle_store().clear()
+        self.user1 = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="user2@example.com", password="password"
+        )
+        self.client.force_authenticate(user=self.user2)
+
+    def test_pair_is_stored_in_id_order(self):
+        friendship = Friendship.objects.create(from_user=self.user2, to_user=self.user1)
+        self.assertEqual(friendship.user_low_id, self.user1.id)
+        self.assertEqual(friendship.user_high_id, self.user2.id)
+
+    def test_reverse_row_is_rejected_by_the_database(self):
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Friendship.objects.create(from_user=self.user2, to_user=self.user1)
+
+    def test_reverse_request(self):
+        Friendship.objects.create(from_user=self.user1, to_user=self.user2)
+        response = self.client.post(
+            reverse("friend-request"), {"to_user": self.user1.id}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Friendship.objects.count(), 1)
+
+
+##############################################################################################################
+
+
+class TestSignedTokenAuthentication(APITestCase):
+    def setUp(self):
+        token_registry.clear()
+        friend_cache.cache.clear()
+        self.user = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+
+    def login(self):
+        self.client.credentials()
+        response = self.client.post(
+            reverse("login"), {"email": "user1@example.com", "password": "password"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['token']}")
+
+    def test_token_authenticates_without_loading_the_user(self):
+        self.login()
+        self.assertEqual(self.client.get(reverse("friends")).status_code, 200)
+        # Only the relationship version of the list ETag, read from the shared cache
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(reverse("friends")).status_code, 200)
+
+    def test_invalid_and_expired_tokens_are_rejected(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer not-a-token")
+        self.assertEqual(self.client.get(reverse("friends")).status_code, 401)
+
+        self.login()
+        with override_settings(TOKEN_MAX_AGE=-1):
+            self.assertEqual(self.client.get(reverse("friends")).status_code, 401)
+
+    def test_logout_revokes_the_token(self):
+        self.login()
+        self.assertEqual(self.client.post(reverse("logout")).status_code, 200)
+        self.assertEqual(self.client.get(reverse("friends")).status_code, 401)
+
+    def expire_registry(self):
+        # Move past the lifetime of the entries this process holds
+        later = time.monotonic() + settings.TOKEN_CACHE_TTL + 1
+        return patch("myapp.authentication.time.monotonic", return_value=later)
+
+    def test_revocations_from_other_workers_apply(self):
+        self.login()
+        self.assertEqual(self.client.get(reverse("friends")).status_code, 200)
+        # Another worker revokes the token while this one holds its user
+        token_id = list(token_registry._entries)[0]
+        RevokedToken.objects.create(
+            token_id=token_id, expires_at=timezone.now() + timedelta(days=1)
+        )
+        self.assertEqual(self.client.get(reverse("friends")).status_code, 200)
+        with self.expire_registry():
+            self.assertEqual(self.client.get(reverse("friends")).status_code, 401)
+
+    def test_expired_revocations_are_pruned(self):
+        RevokedToken.objects.create(
+            token_id="old", expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        self.login()
+        self.assertEqual(self.client.post(reverse("logout")).status_code, 200)
+        self.assertEqual(
+            list(RevokedToken.objects.values_list("token_id", flat=True)),
+            list(token_registry._entries),
+        )
+
+    def test_password_change_revokes_the_token(self):
+        self.login()
+        self.assertEqual(self.client.get(reverse("friends")).status_code, 200)
+        self.user.set_password("new-password")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.client.get(reverse("friends")).status_code, 401)
+
+    def test_password_changes_from_other_workers_apply(self):
+        # Issue the token a second before the change: timestamps are in whole seconds
+        with patch("django.core.signing.time.time", return_value=time.time() - 1):
+            self.login()
+        self.assertEqual(self.client.get(reverse("friends")).status_code, 200)
+        # Another worker publishes the token epoch; a replica may still hold the old
+        # password hash, so the token is rejected without it
+        with patch.object(token_registry, "discard_user"):
+            token_registry.revoke_user(self.user.pk)
+        self.assertEqual(self.client.get(reverse("friends")).status_code, 200)
+        with self.expire_registry():
+            self.assertEqual(self.client.get(reverse("friends")).status_code, 401)
+
+        # Tokens issued after the change are accepted
+        self.login()
+        with self.expire_registry():
+            self.assertEqual(self.client.get(reverse("friends")).status_code, 200)
+
+
+##############################################################################################################
+
+
+class TestSharedThrottleStore(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.location = os.path.join(directory.name, "throttle.sqlite3")
+        self.store = SQLiteThrottleStore(self.location)
+
+    def test_tests_use_their_own_stores(self):
+        for location in (
+            settings.METRICS_STORE,
+            settings.THROTTLE_STORE["LOCATION"],
+            settings.LOGGING["handlers"]["file"]["filename"],
+        ):
+            self.assertTrue(str(location).startswith(settings.TEST_STORE_DIR))
+
+    def test_limit_is_shared_between_stores(self):
+        other_worker = SQLiteThrottleStore(self.location)
+        self.assertTrue(self.store.hit("user-1", 120.0, 60, 3, cost=2))
+        self.assertTrue(other_worker.hit("user-1", 121.0, 60, 3))
+        self.assertFalse(other_worker.hit("user-1", 122.0, 60, 3))
+        self.assertFalse(self.store.hit("user-1", 122.0, 60, 3))
+        self.assertTrue(self.store.hit("user-2", 122.0, 60, 3))
+
+    def test_previous_window_slides_out(self):
+        for now in (150.0, 151.0, 152.0):
+            self.assertTrue(self.store.hit("user-1", now, 60, 3))
+        # 30s into the next window, half of the previous window still counts
+        self.assertFalse(self.store.hit("user-1", 210.0, 60, 3, cost=2))
+        self.assertTrue(self.store.hit("user-1", 210.0, 60, 3))
+        self.assertTrue(self.store.hit("user-1", 300.0, 60, 3, cost=2))
+
+
+##############################################################################################################
+
+
+class TestAsyncViews(APITestCase):
+    def setUp(self):
+        user_index.reset()
+        search_cache.clear()
+        friend_cache.cache.clear()
+        self.user1 = MyUser.objects.create_user(
+            email="alice@example.com", password="password", name="Alice"
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="bob@example.com", password="password", name="Bob"
+        )
+        self.user3 = MyUser.objects.create_user(
+            email="carol@example.com", password="password", name="Carol"
+        )
+        Friendship.objects.create(
+            from_user=self.user2, to_user=self.user1, accepted=True
+        )
+        Friendship.objects.create(from_user=self.user3, to_user=self.user1)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {issue_token(self.user1)}")
+
+    def test_async_views_match_sync_views(self):
+        for sync_name, async_name, params in [
+            ("search", "async-search", {"search": "alice"}),
+            ("search", "async-search", {"search": "al"}),
+            ("friends", "async-friends", {}),
+            ("pending-requests", "async-pending-requests", {}),
+        ]:
+            sync_response = self.client.get(reverse(sync_name), params)
+            async_response = self.client.get(reverse(async_name), params)
+            self.assertEqual(async_response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                async_response.json()["results"], sync_response.json()["results"]
+            )
+
+    def test_async_views_require_authentication(self):
+        self.client.credentials()
+        response = self.client.get(reverse("async-friends"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer not-a-token")
+        response = self.client.get(reverse("async-friends"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_async_views_return_api_errors(self):
+        for name in ["async-search", "async-friends", "async-pending-requests"]:
+            sync_response = self.client.get(
+                reverse(name.removeprefix("async-")), {"cursor": "not-a-cursor"}
+            )
+            async_response = self.client.get(reverse(name), {"cursor": "not-a-cursor"})
+            self.assertEqual(async_response.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertEqual(async_response.json(), sync_response.json())
+
+
+##############################################################################################################
+
+
+class TestSQLiteProfile(SimpleTestCase):
+    databases = ["default"]
+
+    def test_pragmas_are_applied_on_connect(self):
+        with connection.cursor() as cursor:
+            for pragma in ("busy_timeout", "cache_size", "synchronous"):
+                cursor.execute(f"PRAGMA {pragma}")
+                value = cursor.fetchone()[0]
+                expected = settings.SQLITE_PRAGMAS[pragma]
+                if pragma == "synchronous":
+                    expected = 1  # NORMAL
+                self.assertEqual(value, expected)
+
+
+##############################################################################################################
+
+
+@override_settings(DATABASE_REPLICAS=["replica1"], READ_YOUR_WRITES_WINDOW=5)
+class TestPrimaryReplicaRouter(APITestCase):
+    def setUp(self):
+        get_throttle_store().clear()
+        self.router = PrimaryReplicaRouter()
+        self.user1 = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="user2@example.com", password="password"
+        )
+
+    def test_reads_use_replicas_only_inside_replica_reads(self):
+        self.assertEqual(self.router.db_for_read(MyUser), "default")
+        with replica_reads(self.user1):
+            self.assertEqual(self.router.db_for_read(MyUser), "replica1")
+            self.assertEqual(self.router.db_for_write(MyUser), "default")
+            with primary_reads():
+                self.assertEqual(self.router.db_for_read(MyUser), "default")
+            self.assertEqual(self.router.db_for_read(MyUser), "replica1")
+        self.assertEqual(self.router.db_for_read(MyUser), "default")
+
+    def test_cached_searches_are_read_from_the_primary(self):
+        # No replica1 database exists here, so only reads sent to the primary succeed
+        user_index.reset()
+        search_cache.clear()
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.get(reverse("search"), {"search": "user2"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"][0]["email"], "user2@example.com")
+
+    def test_writes_pin_the_user_to_the_primary(self):
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.post(
+            reverse("friend-request"), {"to_user": self.user2.id}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(is_pinned_to_primary(self.user1.pk))
+        with replica_reads(self.user1):
+            self.assertEqual(self.router.db_for_read(MyUser), "default")
+
+    def test_pins_are_seen_by_every_worker(self):
+        pin_to_primary(self.user1.pk)
+        # Another worker shares nothing but the shared cache
+        for alias in settings.CACHES:
+            if alias != settings.SHARED_CACHE_ALIAS:
+                caches[alias].clear()
+        self.assertTrue(is_pinned_to_primary(self.user1.pk))
+        self.assertFalse(is_pinned_to_primary(self.user2.pk))
+        with async_to_sync(areplica_reads)(self.user1):
+            self.assertEqual(self.router.db_for_read(MyUser), "default")
+        with async_to_sync(areplica_reads)(self.user2):
+            self.assertEqual(self.router.db_for_read(MyUser), "replica1")
+
+
+##############################################################################################################
+
+
+class TestBenchmarkCommand(APITestCase):
+    def setUp(self):
+        get_throttle_store().clear()
+        friend_cache.cache.clear()
+        user_index.reset()
+        search_cache.clear()
+
+    def test_benchmark_reports_every_route(self):
+        output = StringIO()
+        call_command(
+            "benchmark",
+            users=30,
+            requests=2,
+            concurrency=1,
+            stdout=output,
+            stderr=StringIO(),
+        )
+        report = json.loads(output.getvalue())
+
+        self.assertEqual(report["config"]["seeded_users"], 30)
+        self.assertEqual(
+            set(report["endpoints"]), {pattern.name for pattern in urlpatterns}
+        )
+        for name, endpoint in report["endpoints"].items():
+            self.assertNotIn("skipped", endpoint, name)
+            if endpoint["requests"]:
+                self.assertIn("p99", endpoint["latency_ms"])
+                self.assertGreaterEqual(endpoint["queries"]["total"], 0)
+
+
+##############################################################################################################
+
+
+class TestImportUsers(APITestCase):
+    def setUp(self):
+        user_index.reset()
+        search_cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        MyUser.objects.create_user(email="taken@example.com", password="secret")
+
+    def write_csv(self, rows):
+        path = os.path.join(self.directory.name, "users.csv")
+        with open(path, "w") as f:
+            f.write("email,password,name,Gender,phonenumber\n")
+            f.writelines(f"{row}\n" for row in rows)
+        return path
+
+    def read_report(self, path):
+        with open(f"{path}.report.jsonl") as f:
+            return [json.loads(line) for line in f]
+
+    def test_import_hashes_normalizes_and_reports(self):
+        path = self.write_csv(
+            [
+                "Ann@Example.com,pw-ann,Ann,Female,123",
+                "ann@example.COM,pw-other,Ann again,,",
+                "TAKEN@example.com,pw,Taken,,",
+                "not-an-email,pw,Bad,,",
+                "bob@example.com,pw-bob,Bob,Robot,12x",
+                "carl@example.com,,Carl,Male,",
+            ]
+        )
+        output = StringIO()
+        call_command("import_users", path, chunk_size=2, workers=2, stdout=output)
+
+        self.assertIn("Imported 2 users from 6 records", output.getvalue())
+        ann = MyUser.objects.get(email="ann@example.com")
+        self.assertEqual(ann.username, "ann@example.com")
+        self.assertEqual(
+            (ann.name, ann.Gender, ann.phonenumber), ("Ann", "Female", 123)
+        )
+        self.assertTrue(ann.check_password("pw-ann"))
+        self.assertFalse(
+            MyUser.objects.get(email="carl@example.com").has_usable_password()
+        )
+
+        report = self.read_report(path)
+        self.assertEqual(
+            [(entry["record"], entry["reason"]) for entry in report],
+            [(2, "duplicate"), (3, "duplicate"), (4, "invalid"), (5, "invalid")],
+        )
+        self.assertEqual(set(report[3]["errors"]), {"Gender", "phonenumber"})
+        self.assertFalse(os.path.exists(f"{path}.checkpoint"))
+
+    def test_import_resumes_from_checkpoint(self):
+        path = self.write_csv(["one@example.com,pw,One,,", "two@example.com,pw,Two,,"])
+        with open(f"{path}.checkpoint", "w") as f:
+            json.dump({"records": 1, "created": 1, "duplicates": 0, "rejected": 0}, f)
+
+        output = StringIO()
+        call_command("import_users", path, workers=0, stdout=output, stderr=StringIO())
+
+        self.assertIn("Imported 2 users from 2 records", output.getvalue())
+        self.assertFalse(MyUser.objects.filter(email="one@example.com").exists())
+        self.assertTrue(MyUser.objects.filter(email="two@example.com").exists())
+
+
+##############################################################################################################
+
+
+class TestRequestProfiling(APITestCase):
+    def setUp(self):
+        user_index.reset()
+        search_cache.clear()
+        token_registry.clear()
+        self.user1 = MyUser.objects.create_user(
+            email="alice@example.com", password="password", name="Alice"
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="bob@example.com", password="password", name="Bob"
+        )
+        Friendship.objects.create(from_user=self.user2, to_user=self.user1)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {issue_token(self.user1)}")
+
+    def test_server_timing_and_log_record(self):
+        with self.assertLogs("myapp.profiling", "INFO") as logs:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("pending-requests"))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile = logs.records[0].profile
+        self.assertEqual(profile["queries"], len(queries))
+        self.assertGreater(profile["serializer_ms"], 0)
+        self.assertGreaterEqual(profile["total_ms"], profile["view_ms"])
+        self.assertIn(f'desc="{len(queries)} queries"', response["Server-Timing"])
+        for metric in ("db;dur=", "view;dur=", "serializer;dur=", "total;dur="):
+            self.assertIn(metric, response["Server-Timing"])
+
+    def test_async_views_are_profiled(self):
+        response = self.client.get(reverse("async-pending-requests"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("db;dur=", response["Server-Timing"])
+
+    @override_settings(SERVER_TIMING_HEADER=False)
+    def test_server_timing_header_can_be_disabled(self):
+        response = self.client.get(reverse("pending-requests"))
+        self.assertNotIn("Server-Timing", response)
+
+    def test_repeated_query_shapes_are_flagged(self):
+        with override_settings(N_PLUS_ONE_THRESHOLD=0):
+            with self.assertLogs("myapp.profiling", "WARNING") as logs:
+                self.client.get(reverse("pending-requests"))
+        self.assertTrue(
+            any("Possible N+1 query" in record.getMessage() for record in logs.records)
+        )
+
+        profile = RequestProfile()
+        for ids in ("(%s)", "(%s, %s)", "(%s, %s, %s)"):
+            profile.record_query(f"SELECT * FROM t WHERE id IN {ids}", 0.001)
+        profile.record_query("SELECT 1", 0.001)
+        self.assertEqual(
+            profile.repeated_queries(2), {"SELECT * FROM t WHERE id IN (...)": 3}
+        )
+        self.assertEqual(profile.repeated_queries(3), {})
+
+
+##############################################################################################################
+
+
+class TestMetrics(APITestCase):
+    def setUp(self):
+        get_throttle_store().clear()
+        metrics.clear()
+        user_index.reset()
+        search_cache.clear()
+        self.user1 = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="user2@example.com", password="password"
+        )
+        self.client.force_authenticate(user=self.user1)
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse("search"), {"search": "user"})
+        for _ in range(4):
+            self.client.post(reverse("friend-request"), {"to_user": self.user2.id})
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        lines = response.content.decode().splitlines()
+        for line in [
+            "# TYPE myapp_request_duration_seconds histogram",
+            'myapp_requests_total{method="GET",status="200",view="search"} 1',
+            'myapp_requests_total{method="POST",status="429",view="friend-request"} 1',
+            'myapp_throttled_requests_total{scope="friend_request"} 1',
+            'myapp_request_duration_seconds_bucket{view="search",le="+Inf"} 1',
+            'myapp_request_duration_seconds_count{view="friend-request"} 4',
+        ]:
+            self.assertIn(line, lines)
+        self.assertTrue(
+            any(
+                line.startswith('myapp_db_queries_total{view="search"}')
+                for line in lines
+            )
+        )
+
+    def test_metrics_are_summed_over_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, "metrics.sqlite3")
+            # Each registry writes under its own process id, like separate workers
+            workers = [MetricsRegistry(location, flush_interval=0) for _ in range(2)]
+            for amount, worker in enumerate(workers, start=1):
+                worker.counter("jobs_total", "Jobs.").inc(amount, queue="a")
+                worker.histogram("job_seconds", "Job time.", buckets=(1, 2)).observe(
+                    1.5
+                )
+
+            lines = workers[0].render().splitlines()
+        self.assertIn('jobs_total{queue="a"} 3', lines)
+        self.assertIn('job_seconds_bucket{le="1"} 0', lines)
+        self.assertIn('job_seconds_bucket{le="2"} 2', lines)
+        self.assertIn("job_seconds_sum 3", lines)
+        self.assertIn("job_seconds_count 2", lines)
+
+    def test_exited_processes_are_folded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            location = os.path.join(directory, "metrics.sqlite3")
+            workers = [MetricsRegistry(location, flush_interval=0) for _ in range(3)]
+            for worker in workers:
+                worker.counter("jobs_total", "Jobs.").inc(2)
+            workers[1].retire()
+            # A worker killed before it could retire, whose process id is free
+            connection = workers[2]._connect()
+            connection.execute(
+                "UPDATE metric_sample SET process = '999999999-dead' WHERE process = ?",
+                (workers[2]._process_id,),
+            )
+
+            self.assertIn("jobs_total 6", workers[0].render().splitlines())
+            processes = [
+                process
+                for (process,) in connection.execute(
+                    "SELECT process FROM metric_sample ORDER BY process"
+                )
+            ]
+        self.assertEqual(processes, sorted([workers[0]._process_id, "exited"]))
+
+    def test_metrics_are_local_without_a_token(self):
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        with override_settings(METRICS_ALLOWED_IPS=["10.0.0.1"]):
+            response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(METRICS_TOKEN="scrape-secret")
+    def test_metrics_token(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer scrape-secret"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+##############################################################################################################
+
+
+class TestFriendSuggestions(APITestCase):
+    def setUp(self):
+        friend_graph.reset()
+        friend_cache.cache.clear()
+        self.users = [
+            MyUser.objects.create_user(
+                email=f"user{i}@example.com", password="password", name=f"User {i}"
+            )
+            for i in range(6)
+        ]
+        me, a, b, c, d, e = self.users
+        # c shares two friends with me, d one; e has a pending request from me
+        for from_user, to_user in [(me, a), (me, b), (a, c), (b, c), (b, d), (a, e)]:
+            Friendship.objects.create(
+                from_user=from_user, to_user=to_user, accepted=True
+            )
+        Friendship.objects.create(from_user=me, to_user=e)
+        self.client.force_authenticate(user=me)
+
+    def test_suggestions_rank_by_mutual_friends(self):
+        response = self.client.get(reverse("suggestions"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(row["id"], row["mutual_friends"]) for row in response.data["results"]],
+            [(self.users[3].id, 2), (self.users[4].id, 1)],
+        )
+
+    def test_graph_follows_friendship_changes(self):
+        me, a, b, c, d, e = self.users
+        friend_graph.ensure_built()
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.create(from_user=me, to_user=c, accepted=True)
+            Friendship.objects.filter(from_user=b, to_user=d).delete()
+            Friendship.objects.create(from_user=d, to_user=a, accepted=True)
+
+        self.assertEqual(list(friend_graph.neighbors(me.id)), [a.id, b.id, c.id])
+        self.assertEqual(list(friend_graph.suggest(me.id)), [(d.id, 1), (e.id, 1)])
+
+        # Merging the overlays into the arrays keeps the same graph
+        friend_graph.compact()
+        self.assertEqual(list(friend_graph.neighbors(me.id)), [a.id, b.id, c.id])
+        self.assertEqual(friend_graph.degree(a.id), 4)
+        self.assertEqual(list(friend_graph.suggest(me.id)), [(d.id, 1), (e.id, 1)])
+
+    def test_graph_follows_changes_made_by_other_processes(self):
+        me, a, b, c, d, e = self.users
+        friend_graph.ensure_built()
+        # Another process applies the changes to its own graph only
+        with patch.object(friend_graph, "_update"):
+            with self.captureOnCommitCallbacks(execute=True):
+                Friendship.objects.create(from_user=me, to_user=c, accepted=True)
+                Friendship.objects.filter(from_user=b, to_user=d).delete()
+                Friendship.objects.create(from_user=d, to_user=a, accepted=True)
+
+        self.assertEqual(list(friend_graph.suggest(me.id)), [(d.id, 1), (e.id, 1)])
+        self.assertEqual(list(friend_graph.neighbors(me.id)), [a.id, b.id, c.id])
+
+    def test_requests_in_either_direction_are_skipped(self):
+        me, a, b, c, d, e = self.users
+        Friendship.objects.create(from_user=c, to_user=me)
+        response = self.client.get(reverse("suggestions"))
+        self.assertEqual(
+            [row["id"] for row in response.data["results"]], [self.users[4].id]
+        )
+
+    def test_scan_limit_bounds_the_work(self):
+        me, a, b, c, d, e = self.users
+        # Friends are visited from the smallest degree up, so only a's friends fit
+        self.assertEqual(
+            list(friend_graph.suggest(me.id, scan_limit=3)), [(c.id, 1), (e.id, 1)]
+        )
+
+
+##############################################################################################################
+
+
+class TestRelationshipLookup(APITestCase):
+    def setUp(self):
+        user_index.reset()
+        search_cache.clear()
+        friend_cache.cache.clear()
+        self.users = [
+            MyUser.objects.create_user(
+                email=f"user{i}@example.com", password="password", name=f"Friend {i}"
+            )
+            for i in range(6)
+        ]
+        me, a, b, c, d, e = self.users
+        for from_user, to_user in [(me, a), (me, b), (c, a), (c, b), (d, a)]:
+            Friendship.objects.create(
+                from_user=from_user, to_user=to_user, accepted=True
+            )
+        Friendship.objects.create(from_user=me, to_user=c)
+        Friendship.objects.create(from_user=d, to_user=me)
+        self.client.force_authenticate(user=me)
+
+    def test_relationship_lookup(self):
+        me, a, b, c, d, e = self.users
+        ids = [c.id, a.id, d.id, e.id, me.id, c.id]
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                reverse("relationships"), {"ids": ",".join(map(str, ids))}
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["results"],
+            [
+                {"id": c.id, "status": "request_sent", "mutual_friends": 2},
+                {"id": a.id, "status": "friends", "mutual_friends": 0},
+                {"id": d.id, "status": "request_received", "mutual_friends": 1},
+                {"id": e.id, "status": "none", "mutual_friends": 0},
+                {"id": me.id, "status": "self", "mutual_friends": 0},
+            ],
+        )
+
+        # Friend lists now come from the friend cache
+        with self.assertNumQueries(1):
+            self.client.get(reverse("relationships"), {"ids": f"{c.id},{a.id}"})
+
+    def test_relationship_lookup_validates_ids(self):
+        response = self.client.get(reverse("relationships"), {"ids": "1,x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse("relationships"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_expands_relationship(self):
+        me, a, b, c, d, e = self.users
+        response = self.client.get(
+            reverse("search"), {"search": "friend", "expand": "relationship"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        relationships = {
+            row["id"]: row["relationship"] for row in response.data["results"]
+        }
+        self.assertEqual(
+            relationships[c.id], {"status": "request_sent", "mutual_friends": 2}
+        )
+        self.assertEqual(
+            relationships[b.id], {"status": "friends", "mutual_friends": 0}
+        )
+
+        response = self.client.get(reverse("search"), {"search": "friend"})
+        self.assertNotIn("relationship", response.data["results"][0])
+
+    def test_intersection_size(self):
+        self.assertEqual(intersection_size([1, 3, 5, 7], [3, 4, 5, 8]), 2)
+        self.assertEqual(intersection_size([], [1, 2]), 0)
+        self.assertEqual(intersection_size([5, 999], list(range(1000))), 2)
+
+
+##############################################################################################################
+
+
+class TestConditionalLists(APITestCase):
+    def setUp(self):
+        friend_cache.cache.clear()
+        get_throttle_store().clear()
+        self.user1 = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="user2@example.com", password="password"
+        )
+        self.user3 = MyUser.objects.create_user(
+            email="user3@example.com", password="password"
+        )
+        self.client.force_authenticate(user=self.user2)
+
+    def test_unchanged_lists_are_not_modified(self):
+        for name in ("friends", "pending-requests"):
+            response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            etag = response["ETag"]
+
+            # The version is read from the shared cache, the Friendship table is not
+            with self.assertNumQueries(1):
+                response = self.client.get(reverse(name), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response["ETag"], etag)
+
+            # Another page of the same list has its own tag
+            response = self.client.get(reverse(name), {"page_size": 1})
+            self.assertNotEqual(response["ETag"], etag)
+
+    def test_other_workers_see_the_new_tag(self):
+        response = self.client.get(reverse("pending-requests"))
+        etag = response["ETag"]
+
+        self.client.force_authenticate(user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("friend-request"), {"to_user": self.user2.id})
+
+        # Another worker shares none of the process-local caches of the one that wrote
+        for alias in settings.CACHES:
+            if alias != settings.SHARED_CACHE_ALIAS:
+                caches[alias].clear()
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.get(reverse("pending-requests"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 1)
+
+    def test_friend_list_reloads_when_another_worker_changed_it(self):
+        self.client.force_authenticate(user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("friend-request"), {"to_user": self.user2.id})
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.get(reverse("friends"))
+        self.assertEqual(response.data["results"], [])
+        etag = response["ETag"]
+
+        # The accepting worker is another process: this one's friend cache is not updated
+        request = Friendship.objects.get(from_user=self.user1)
+        with patch.object(friend_cache, "add_friendship"), patch.object(
+            friend_cache, "retag"
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse("accept-friend-request", args=[request.id]))
+        response = self.client.get(reverse("friends"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"], [{"to_user": self.user1.id}])
+
+    def test_send_accept_and_reject_change_the_tag(self):
+        def pending_etag():
+            return self.client.get(reverse("pending-requests"))["ETag"]
+
+        etag = pending_etag()
+        self.client.force_authenticate(user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("friend-request"), {"to_user": self.user2.id})
+        self.client.force_authenticate(user=self.user2)
+        self.assertNotEqual(pending_etag(), etag)
+
+        etag = pending_etag()
+        request = Friendship.objects.get(from_user=self.user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("accept-friend-request", args=[request.id]))
+        self.assertNotEqual(pending_etag(), etag)
+
+        etag = pending_etag()
+        self.client.force_authenticate(user=self.user3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("friend-request-batch"), {"to_users": [self.user2.id]}
+            )
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.get(reverse("pending-requests"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        etag = pending_etag()
+        self.client.force_authenticate(user=self.user3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse("reject-request", args=[self.user2.id]))
+        self.client.force_authenticate(user=self.user2)
+        self.assertNotEqual(pending_etag(), etag)
+
+
+##############################################################################################################
+
+
+class TestSearchResultCache(APITestCase):
+    def setUp(self):
+        get_throttle_store().clear()
+        user_index.reset()
+        search_cache.clear()
+        self.user = MyUser.objects.create_user(
+            email="alice@example.com", password="password", name="Alice"
+        )
+        MyUser.objects.create_user(
+            email="alicia@example.com", password="password", name="Alicia"
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def test_repeated_search_skips_sql(self):
+        response = self.client.get(reverse("search"), {"search": "ALI"})
+        self.assertEqual(len(response.data["results"]), 2)
+
+        # Same terms, normalized: served from the cache, the directory version was read
+        # less than SEARCH_CACHE_CHECK_INTERVAL seconds ago
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse("search"), {"search": "ali"})
+        self.assertEqual(cached.data, response.data)
+
+        # Another page is cached separately: the index version and change feed, then the page
+        with self.assertNumQueries(3):
+            self.client.get(reverse("search"), {"search": "ali", "page_size": 1})
+
+    def test_directory_changes_invalidate_results(self):
+        self.client.get(reverse("search"), {"search": "ali"})
+
+        # Saves that do not change the shown fields keep the cached results
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.last_login = timezone.now()
+            self.user.save(update_fields=["last_login"])
+        with self.assertNumQueries(0):
+            self.client.get(reverse("search"), {"search": "ali"})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.name = "Alice Cooper"
+            self.user.save()
+        response = self.client.get(reverse("search"), {"search": "ali"})
+        self.assertIn("Alice Cooper", [row["name"] for row in response.data["results"]])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            MyUser.objects.get(email="alicia@example.com").delete()
+        response = self.client.get(reverse("search"), {"search": "ali"})
+        self.assertEqual(len(response.data["results"]), 1)
+
+    def test_cache_is_size_bounded(self):
+        cache = SearchResultCache(max_size=2)
+        for key in ("a", "b", "a", "c"):
+            cache.set(key, {"results": [key]}, [])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), {"results": ["a"]})
+        self.assertEqual(cache.get("c"), {"results": ["c"]})
+
+    def test_entries_expire(self):
+        cache = SearchResultCache(ttl=-1)
+        cache.set("a", {"results": []}, [])
+        self.assertIsNone(cache.get("a"))
+
+    def test_counter_changes_drop_the_results_showing_the_user(self):
+        self.client.get(reverse("search"), {"search": "ali"})
+        MyUser.objects.create_user(email="bob@example.com", password="password")
+        self.client.get(reverse("search"), {"search": "bob"})
+        version = directory_version()
+        other = MyUser.objects.get(email="alicia@example.com")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("friend-request"), {"to_user": other.id})
+
+        self.assertEqual(directory_version(), version)
+        with self.assertNumQueries(0):
+            self.client.get(reverse("search"), {"search": "bob"})
+        response = self.client.get(reverse("search"), {"search": "ali"})
+        counts = {
+            row["email"]: row["pending_count"] for row in response.data["results"]
+        }
+        self.assertEqual(counts, {"alice@example.com": 0, "alicia@example.com": 1})
+
+    def test_counter_changes_from_other_workers_apply_after_the_check_interval(self):
+        self.client.get(reverse("search"), {"search": "ali"})
+        other = MyUser.objects.get(email="alicia@example.com")
+        # Another worker changes the counters of a user shown
+        MyUser.objects.filter(pk=other.id).update(pending_count=5)
+        with patch.object(search_cache, "forget_users"):
+            publish_counter_changes([other.id])
+        with self.assertNumQueries(0):
+            self.client.get(reverse("search"), {"search": "ali"})
+
+        later = time.monotonic() + settings.SEARCH_CACHE_CHECK_INTERVAL
+        with patch("myapp.search.time.monotonic", return_value=later):
+            response = self.client.get(reverse("search"), {"search": "ali"})
+        counts = {
+            row["email"]: row["pending_count"] for row in response.data["results"]
+        }
+        self.assertEqual(counts, {"alice@example.com": 0, "alicia@example.com": 5})
+
+
+##############################################################################################################
+
+
+class TestRowSerializers(APITestCase):
+    def setUp(self):
+        self.user1 = MyUser.objects.create_user(
+            email="user1@example.com",
+            password="password",
+            name="User 1",
+            Gender="Female",
+            phonenumber=123,
+        )
+        self.user2 = MyUser.objects.create_user(
+            email="user2@example.com", password="password"
+        )
+        Friendship.objects.create(from_user=self.user2, to_user=self.user1)
+
+    def test_rows_match_model_serializers(self):
+        users = MyUser.objects.order_by("id")
+        self.assertEqual(
+            UserRowSerializer.serialize(UserRowSerializer.values(users)),
+            [dict(row) for row in UserCreateSerializer(users, many=True).data],
+        )
+        pending = Friendship.objects.order_by("id")
+        self.assertEqual(
+            PendingRequestRowSerializer.serialize(
+                PendingRequestRowSerializer.values(pending)
+            ),
+            [dict(row) for row in FriendshipSerializer1(pending, many=True).data],
+        )
+
+    def test_extra_columns_are_fetched_but_not_serialized(self):
+        rows = UserRowSerializer.values(MyUser.objects.order_by("id"), ["-id"])
+        self.assertEqual(rows[0].id, self.user1.id)
+        self.assertNotIn("id", UserRowSerializer.serialize(rows)[0])
+
+    def test_benchmark_command(self):
+        output = StringIO()
+        call_command("benchmark_serializers", rows=5, repeat=1, stdout=output)
+        self.assertIn("speedup", output.getvalue())
+        self.assertFalse(MyUser.objects.filter(email__startswith="bench-").exists())
+
+
+##############################################################################################################
+
+
+class TestStructuredLogging(APITestCase):
+    def setUp(self):
+        metrics.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "app.log")
+        self.user1 = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+
+    def make_handler(self, **kwargs):
+        handler = QueueFileHandler(self.filename, **kwargs)
+        logger = logging.getLogger("myapp.views")
+        logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        self.addCleanup(logger.removeHandler, handler)
+        return handler
+
+    def read_lines(self, filename=None):
+        with open(filename or self.filename, encoding="utf-8") as file:
+            return [json.loads(line) for line in file]
+
+    def test_records_carry_request_and_user_ids(self):
+        handler = self.make_handler()
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.post(
+            reverse("friend-request"), {"to_user": 0}, HTTP_X_REQUEST_ID="abc-123"
+        )
+        self.assertEqual(response["X-Request-ID"], "abc-123")
+
+        handler.flush()
+        [entry] = self.read_lines()
+        self.assertEqual(entry["level"], "ERROR")
+        self.assertEqual(entry["logger"], "myapp.views")
+        self.assertEqual(
+            entry["message"], "Friend request failed: Invalid 'to_user' ID 0"
+        )
+        self.assertEqual(entry["request_id"], "abc-123")
+        self.assertEqual(entry["user_id"], self.user1.id)
+
+    def test_request_id_is_generated(self):
+        response = self.client.get(reverse("search"), HTTP_X_REQUEST_ID="bad id\n")
+        self.assertRegex(response["X-Request-ID"], r"^[0-9a-f]{32}$")
+
+    def test_extra_fields_and_tracebacks(self):
+        handler = self.make_handler()
+        logger = logging.getLogger("myapp.views")
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.error("Failed %s", "job", exc_info=True, extra={"job": {"id": 7}})
+
+        handler.flush()
+        [entry] = self.read_lines()
+        self.assertEqual(entry["message"], "Failed job")
+        self.assertEqual(entry["job"], {"id": 7})
+        self.assertIsNone(entry["request_id"])
+        self.assertIn("ValueError: boom", entry["exc_info"])
+
+    def test_full_queue_drops_records_without_blocking(self):
+        handler = self.make_handler(queue_size=1)
+        release = threading.Event()
+        write_batch = handler.writer.emit_batch
+        publishers = set()
+        increment = log_records_dropped_total.inc
+        with patch.object(
+            handler.writer,
+            "emit_batch",
+            side_effect=lambda records: (release.wait(), write_batch(records)),
+        ), patch.object(
+            log_records_dropped_total,
+            "inc",
+            side_effect=lambda *args, **labels: (
+                publishers.add(threading.current_thread().name),
+                increment(*args, **labels),
+            ),
+        ):
+            logger = logging.getLogger("myapp.views")
+            for i in range(10):
+                logger.error("Record %s", i)
+            # The writer is stuck on at most one record and the queue holds one more
+            self.assertGreaterEqual(handler.dropped, 8)
+            release.set()
+            handler.flush()
+
+        # The logging thread only counted the drops; the writer published them
+        self.assertEqual(publishers, {"log-writer"})
+        self.assertEqual(len(self.read_lines()) + handler.dropped, 10)
+        self.assertIn(
+            f'myapp_log_records_dropped_total{{logger="myapp.views"}} {handler.dropped}',
+            metrics.render(),
+        )
+
+    def test_file_is_rotated_by_size(self):
+        handler = self.make_handler(max_bytes=1000, backup_count=2)
+        logger = logging.getLogger("myapp.views")
+        for i in range(50):
+            logger.error("Record %s", i)
+
+        handler.flush()
+        self.assertTrue(os.path.exists(f"{self.filename}.1"))
+        self.assertTrue(os.path.exists(f"{self.filename}.2"))
+        self.assertFalse(os.path.exists(f"{self.filename}.3"))
+        self.assertLessEqual(os.path.getsize(self.filename), 1000)
+        self.assertEqual(self.read_lines()[-1]["message"], "Record 49")
+
+
+##############################################################################################################
+
+
+class TestBulkFriendRequests(APITestCase):
+    def setUp(self):
+        friend_graph.reset()
+        friend_cache.cache.clear()
+        self.users = [
+            MyUser.objects.create_user(
+                email=f"user{i}@example.com", password="password"
+            )
+            for i in range(5)
+        ]
+        self.me = self.users[0]
+        self.requests = [
+            Friendship.objects.create(from_user=sender, to_user=self.me)
+            for sender in self.users[1:]
+        ]
+        # A request received by someone else, which the bulk endpoints must not touch
+        self.other = Friendship.objects.create(
+            from_user=self.users[1], to_user=self.users[2]
+        )
+        self.client.force_authenticate(user=self.me)
+
+    def test_bulk_accept_ids(self):
+        friend_graph.ensure_built()
+        friend_cache.get_friend_ids(self.users[1].id)
+        ids = [self.requests[0].id, self.requests[1].id, self.other.id]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("accept-friend-requests"), {"ids": ids}, format="json"
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["ids"], ids[:2])
+        self.assertEqual(
+            set(Friendship.objects.filter(accepted=True).values_list("id", flat=True)),
+            set(ids[:2]),
+        )
+        # The friend cache and the suggestion graph follow the single UPDATE
+        friends = [self.users[1].id, self.users[2].id]
+        self.assertEqual(list(friend_cache.get_friend_ids(self.me.id)), friends)
+        self.assertEqual(
+            list(friend_cache.get_friend_ids(self.users[1].id)), [self.me.id]
+        )
+        self.assertEqual(list(friend_graph.neighbors(self.me.id)), friends)
+
+    def test_bulk_reject_all_before(self):
+        Friendship.objects.filter(id__in=[r.id for r in self.requests[:3]]).update(
+            created_at=timezone.now() - timedelta(days=2)
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("reject-requests"),
+                {"all": True, "created_before": timezone.now() - timedelta(days=1)},
+                format="json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The filters of the request select the rows and delete them, each in one statement
+        deletes = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith('DELETE FROM "myapp_friendship"')
+        ]
+        self.assertEqual(len(deletes), 1)
+        self.assertIn("created_at", deletes[0])
+        self.assertEqual(response.data["ids"], [r.id for r in self.requests[:3]])
+        self.assertEqual(
+            set(Friendship.objects.values_list("id", flat=True)),
+            {self.requests[3].id, self.other.id},
+        )
+
+    def test_ids_or_all_is_required(self):
+        for data in [{}, {"all": True, "ids": [self.requests[0].id]}, {"ids": []}]:
+            response = self.client.post(
+                reverse("accept-friend-requests"), data, format="json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Friendship.objects.filter(accepted=True).exists())
+
+    def test_expire_stale_requests_in_batches(self):
+        stale = [self.requests[0].id, self.requests[1].id, self.other.id]
+        Friendship.objects.filter(id__in=stale).update(
+            created_at=timezone.now() - timedelta(days=100)
+        )
+        # Accepted friendships never expire
+        Friendship.objects.filter(id=self.requests[1].id).update(accepted=True)
+
+        output = StringIO()
+        call_command("expire_friend_requests", batch_size=1, stdout=output)
+
+        self.assertIn("Expired 2 pending friend request(s).", output.getvalue())
+        self.assertEqual(
+            set(Friendship.objects.values_list("id", flat=True)),
+            {r.id for r in self.requests[1:]},
+        )
+        with self.assertRaises(CommandError):
+            call_command("expire_friend_requests", batch_size=0)
+
+    def test_delete_pending_keeps_accepted_requests(self):
+        Friendship.objects.filter(id=self.requests[0].id).update(accepted=True)
+        ids = [r.id for r in self.requests]
+        with self.assertNumQueries(1):
+            deleted = Friendship.objects.filter(id__in=ids).delete_pending()
+        self.assertEqual(deleted, 3)
+        self.assertEqual(
+            set(Friendship.objects.values_list("id", flat=True)),
+            {self.requests[0].id, self.other.id},
+        )
+
+
+##############################################################################################################
+
+
+@override_settings(SESSION_ENGINE="myapp.sessions")
+class TestSessions(APITestCase):
+    def setUp(self):
+        write_buffer.clear()
+        # Leave the flushes to the tests, not to the timer thread
+        patcher = patch.object(write_buffer, "interval", 3600)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        caches["sessions"].clear()
+        self.user = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+
+    def login(self):
+        response = self.client.post(
+            reverse("login"), {"email": "user1@example.com", "password": "password"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.cookies[settings.SESSION_COOKIE_NAME].value
+
+    def assertNoSessionQueries(self, queries):
+        for query in queries:
+            self.assertNotIn("django_session", query["sql"])
+
+    def test_write_behind_sessions_skip_the_database(self):
+        with CaptureQueriesContext(connection) as queries:
+            session_key = self.login()
+            response = self.client.get(reverse("friends"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNoSessionQueries(queries)
+        self.assertFalse(Session.objects.exists())
+
+        # The database gets the session on the next flush
+        write_buffer.flush()
+        self.assertTrue(Session.objects.filter(session_key=session_key).exists())
+
+        # After a cache restart, the session is read from the database
+        caches["sessions"].clear()
+        self.assertEqual(
+            self.client.get(reverse("friends")).status_code, status.HTTP_200_OK
+        )
+
+    def test_pending_writes_are_read_on_cache_miss(self):
+        self.login()
+        caches["sessions"].clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("friends"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNoSessionQueries(queries)
+
+    def test_logout_deletes_the_session(self):
+        session_key = self.login()
+        write_buffer.flush()
+        self.client.post(reverse("logout"))
+        write_buffer.flush()
+        self.assertFalse(Session.objects.filter(session_key=session_key).exists())
+        self.assertEqual(
+            self.client.get(reverse("friends")).status_code,
+            status.HTTP_401_UNAUTHORIZED,
+        )
+
+    @override_settings(SESSION_ENGINE="django.contrib.sessions.backends.signed_cookies")
+    def test_signed_cookie_sessions(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.login()
+            response = self.client.get(reverse("friends"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNoSessionQueries(queries)
+
+    def test_purge_expired_sessions_in_batches(self):
+        now = timezone.now()
+        Session.objects.bulk_create(
+            Session(
+                session_key=f"session{i}",
+                session_data="",
+                expire_date=now + timedelta(days=1 if i < 2 else -1),
+            )
+            for i in range(7)
+        )
+        output = StringIO()
+        call_command("purge_sessions", batch_size=2, stdout=output)
+        self.assertIn("Purged 5 expired session(s).", output.getvalue())
+        self.assertEqual(
+            sorted(Session.objects.values_list("session_key", flat=True)),
+            ["session0", "session1"],
+        )
+        with self.assertRaises(CommandError):
+            call_command("purge_sessions", batch_size=0)
+
+    def test_write_behind_sessions_need_a_shared_cache(self):
+        shared = {
+            **settings.CACHES,
+            "sessions": {
+                "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                "LOCATION": "myapp_shared_cache",
+            },
+        }
+        with override_settings(CACHES=shared):
+            self.assertEqual(check_session_cache(None), [])
+        [error] = check_session_cache(None)
+        self.assertEqual(error.id, "myapp.E002")
+        with override_settings(SESSION_ENGINE="django.contrib.sessions.backends.db"):
+            self.assertEqual(check_session_cache(None), [])
+
+    def test_timer_flushes_pending_writes(self):
+        self.login()
+        with patch("myapp.sessions.time.sleep", side_effect=SystemExit), patch(
+            "myapp.sessions.connections.close_all"
+        ) as close_all:
+            write_buffer._last_flush -= write_buffer.interval
+            with self.assertRaises(SystemExit):
+                write_buffer._run()
+        self.assertEqual(Session.objects.count(), 1)
+        close_all.assert_called_once()
+
+
+##############################################################################################################
+
+
+class TestCounters(APITestCase):
+    def setUp(self):
+        get_throttle_store().clear()
+        user_index.reset()
+        search_cache.clear()
+        self.users = [
+            MyUser.objects.create_user(
+                email=f"user{i}@example.com", password="password"
+            )
+            for i in range(4)
+        ]
+        self.me = self.users[0]
+
+    def counts(self, user):
+        user.refresh_from_db()
+        return user.friend_count, user.pending_count
+
+    def test_counters_follow_requests(self):
+        me, a, b, c = self.users
+        for sender in (a, b, c):
+            self.client.force_authenticate(user=sender)
+            self.client.post(reverse("friend-request"), {"to_user": me.id})
+        self.assertEqual(self.counts(me), (0, 3))
+
+        self.client.force_authenticate(user=me)
+        request_a = Friendship.objects.get(from_user=a)
+        self.client.post(reverse("accept-friend-request", args=[request_a.id]))
+        self.assertEqual(self.counts(me), (1, 2))
+        self.assertEqual(self.counts(a), (1, 0))
+
+        request_b = Friendship.objects.get(from_user=b)
+        self.client.post(
+            reverse("accept-friend-requests"), {"ids": [request_b.id]}, format="json"
+        )
+        self.assertEqual(self.counts(me), (2, 1))
+        self.assertEqual(self.counts(b), (1, 0))
+
+        self.client.post(reverse("reject-requests"), {"all": True}, format="json")
+        self.assertEqual(self.counts(me), (2, 0))
+
+        # Removing an accepted friendship lowers the friend count of both users
+        self.client.force_authenticate(user=a)
+        self.client.delete(reverse("reject-request", args=[me.id]))
+        self.assertEqual(self.counts(me), (1, 0))
+        self.assertEqual(self.counts(a), (0, 0))
+
+    def test_batch_requests_and_expiry(self):
+        me, a, b, c = self.users
+        self.client.force_authenticate(user=me)
+        self.client.post(
+            reverse("friend-request-batch"), {"to_users": [a.id, b.id]}, format="json"
+        )
+        self.assertEqual(self.counts(a), (0, 1))
+
+        Friendship.objects.update(created_at=timezone.now() - timedelta(days=100))
+        call_command("expire_friend_requests", stdout=StringIO())
+        self.assertEqual(self.counts(a), (0, 0))
+        self.assertEqual(self.counts(b), (0, 0))
+
+    def test_counts_in_user_responses(self):
+        me, a, b, c = self.users
+        MyUser.objects.filter(pk=a.pk).update(friend_count=5, pending_count=2)
+        self.client.force_authenticate(user=me)
+        response = self.client.get(reverse("search"), {"search": "user1@example.com"})
+        self.assertEqual(response.data["results"][0]["friend_count"], 5)
+        self.assertEqual(response.data["results"][0]["pending_count"], 2)
+
+    def test_deleting_a_user_updates_the_counters_of_others(self):
+        me, a, b, c = self.users
+        Friendship.objects.create(from_user=me, to_user=a, accepted=True)
+        Friendship.objects.create(from_user=b, to_user=me, accepted=True)
+        Friendship.objects.create(from_user=me, to_user=c)
+        call_command("reconcile_counters", stdout=StringIO())
+
+        me.delete()
+        self.assertEqual(self.counts(a), (0, 0))
+        self.assertEqual(self.counts(b), (0, 0))
+        self.assertEqual(self.counts(c), (0, 0))
+        output = StringIO()
+        call_command("reconcile_counters", dry_run=True, stdout=output)
+        self.assertIn("found 0 drifted.", output.getvalue())
+
+    def test_reconcile_counters(self):
+        me, a, b, c = self.users
+        # Rows created around the services leave the counters behind
+        Friendship.objects.create(from_user=a, to_user=me, accepted=True)
+        Friendship.objects.create(from_user=b, to_user=me)
+        MyUser.objects.filter(pk=c.pk).update(friend_count=3)
+
+        output = StringIO()
+        call_command("reconcile_counters", chunk_size=2, dry_run=True, stdout=output)
+        self.assertIn("Checked 4 user(s), found 3 drifted.", output.getvalue())
+        self.assertEqual(self.counts(me), (0, 0))
+
+        output = StringIO()
+        call_command("reconcile_counters", chunk_size=2, stdout=output)
+        self.assertIn(
+            f"User {me.id}: friend_count 0 -> 1, pending_count 0 -> 1",
+            output.getvalue(),
+        )
+        self.assertIn("fixed 3 drifted.", output.getvalue())
+        self.assertEqual(self.counts(me), (1, 1))
+        self.assertEqual(self.counts(a), (1, 0))
+        self.assertEqual(self.counts(c), (0, 0))
+
+        output = StringIO()
+        call_command("reconcile_counters", stdout=output)
+        self.assertIn("fixed 0 drifted.", output.getvalue())
+
+
+##############################################################################################################
+
+
+class TestEventPush(APITestCase):
+    def setUp(self):
+        get_throttle_store().clear()
+        get_event_hub().clear()
+        self.sender = MyUser.objects.create_user(
+            email="user1@example.com", password="password"
+        )
+        self.receiver = MyUser.objects.create_user(
+            email="user2@example.com", password="password"
+        )
+
+    def poll(self, user, **params):
+        # The async views authenticate plain Django requests, so use a token
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {issue_token(user)}")
+        response = self.client.get(reverse("events-poll"), {"timeout": 0, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    async def test_hub_wakes_up_subscribers_from_other_threads(self):
+        hub = InProcessEventHub()
+        subscription = hub.subscribe("user:1")
+        thread = threading.Thread(
+            target=hub.publish, args=("user:1", "friend_request", {"id": 7})
+        )
+        thread.start()
+        events = await subscription.get(timeout=5)
+        thread.join()
+        self.assertEqual([event["data"] for event in events], [{"id": 7}])
+        self.assertEqual(await subscription.get(timeout=0), [])
+
+        subscription.close()
+        self.assertEqual(hub.subscriber_count(), 0)
+
+    def test_poll_returns_new_and_accepted_requests(self):
+        baseline = self.poll(self.receiver)
+        self.assertEqual(baseline["events"], [])
+
+        self.client.force_authenticate(user=self.sender)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("friend-request"), {"to_user": self.receiver.id})
+        friend_request = Friendship.objects.get()
+
+        result = self.poll(self.receiver, since=baseline["last_id"])
+        self.assertEqual(
+            [(event["type"], event["data"]) for event in result["events"]],
+            [
+                (
+                    "friend_request",
+                    {"id": friend_request.id, "from_user": self.sender.id},
+                )
+            ],
+        )
+        self.assertEqual(result["last_id"], result["events"][0]["id"])
+        self.assertEqual(
+            self.poll(self.receiver, since=result["last_id"])["events"], []
+        )
+
+        self.client.force_authenticate(user=self.receiver)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("accept-friend-request", args=[friend_request.id]))
+        [event] = self.poll(self.sender, since=0)["events"]
+        self.assertEqual(event["type"], "friend_request_accepted")
+        self.assertEqual(
+            event["data"], {"id": friend_request.id, "by_user": self.receiver.id}
+        )
+
+    def test_invalid_since(self):
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {issue_token(self.receiver)}"
+        )
+        response = self.client.get(reverse("events-poll"), {"since": "x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_stream_sends_server_sent_events(self):
+        event = get_event_hub().publish(
+            f"user:{self.receiver.id}", "friend_request", {"id": 1}
+        )
+        response = await self.async_client.get(
+            reverse("events"),
+            headers={
+                "Authorization": f"Bearer {issue_token(self.receiver)}",
+                "Last-Event-ID": "0",
+            },
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b"retry: 3000\n\n")
+        self.assertEqual(
+            await anext(chunks),
+            f'id: {event["id"]}\nevent: friend_request\ndata: {{"id": 1}}\n\n'.encode(),
+        )
+
+        # The server cancels the response when the client disconnects
+        waiting = asyncio.ensure_future(anext(chunks))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(get_event_hub().subscriber_count(), 0)
+
+
+##############################################################################################################
+
+
+class TestChangeLog(APITestCase):
+    def setUp(self):
+        get_throttle_store().clear()
+        user_index.reset()
+        search_cache.clear()
+        self.users = [
+            MyUser.objects.create_user(
+                email=f"user{i}@example.com", password="password"
+            )
+            for i in range(4)
+        ]
+        self.me = self.users[0]
+
+    def changes(self, user, since=None, **params):
+        self.client.force_authenticate(user=user)
+        if since is not None:
+            params["since"] = since
+        return self.client.get(reverse("changes"), params)
+
+    def test_sync_follows_requests(self):
+        me, a, b, c = self.users
+        cursor = self.changes(me).data["next"]
+
+        for sender in (a, b):
+            self.client.force_authenticate(user=sender)
+            self.client.post(reverse("friend-request"), {"to_user": me.id})
+        self.client.force_authenticate(user=me)
+        self.client.post(
+            reverse("friend-request-batch"), {"to_users": [c.id]}, format="json"
+        )
+        request_a = Friendship.objects.get(from_user=a)
+        self.client.post(reverse("accept-friend-request", args=[request_a.id]))
+        self.client.post(reverse("reject-requests"), {"all": True}, format="json")
+        self.client.force_authenticate(user=a)
+        self.client.delete(reverse("reject-request", args=[me.id]))
+
+        response = self.changes(me, cursor)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(change["peer"], change["op"]) for change in response.data["changes"]],
+            [
+                (a.id, "received"),
+                (b.id, "received"),
+                (c.id, "sent"),
+                (a.id, "accepted"),
+                (b.id, "deleted"),
+                (a.id, "deleted"),
+            ],
+        )
+        self.assertEqual(response.data["changes"][0]["request"], request_a.id)
+        self.assertFalse(response.data["has_more"])
+
+        # The sender sees the same changes from its side
+        response = self.changes(a, cursor)
+        self.assertEqual(
+            [change["op"] for change in response.data["changes"]],
+            ["sent", "accepted", "deleted"],
+        )
+
+        # Nothing changed since the last call
+        next_seq = response.data["next"]
+        with self.assertNumQueries(1):
+            response = self.changes(a, next_seq)
+        self.assertEqual(
+            response.data, {"changes": [], "next": next_seq, "has_more": False}
+        )
+
+    @override_settings(CHANGE_LOG_PAGE_SIZE=2)
+    def test_changes_are_paginated(self):
+        me, a, b, c = self.users
+        self.client.force_authenticate(user=me)
+        self.client.post(
+            reverse("friend-request-batch"),
+            {"to_users": [a.id, b.id, c.id]},
+            format="json",
+        )
+
+        with self.assertNumQueries(3):
+            response = self.changes(me, 0)
+        self.assertEqual(len(response.data["changes"]), 2)
+        self.assertTrue(response.data["has_more"])
+
+        response = self.changes(me, response.data["next"])
+        self.assertEqual(
+            [change["peer"] for change in response.data["changes"]], [c.id]
+        )
+        self.assertFalse(response.data["has_more"])
+
+    def test_expired_and_deleted_users_are_logged(self):
+        me, a, b, c = self.users
+        self.client.force_authenticate(user=me)
+        self.client.post(
+            reverse("friend-request-batch"), {"to_users": [a.id, b.id]}, format="json"
+        )
+        request_b = Friendship.objects.get(to_user=b)
+        Friendship.objects.filter(to_user=a).update(
+            created_at=timezone.now() - timedelta(days=100)
+        )
+        call_command("expire_friend_requests", stdout=StringIO())
+        b_id = b.id
+        b.delete()
+
+        changes = self.changes(me, 0).data["changes"]
+        self.assertEqual(
+            [(change["peer"], change["op"]) for change in changes[2:]],
+            [(a.id, "deleted"), (b_id, "deleted")],
+        )
+        self.assertEqual(changes[-1]["request"], request_b.id)
+        self.assertFalse(FriendshipChange.objects.filter(user=b_id).exists())
+
+    def test_compaction(self):
+        me, a, b, c = self.users
+        for sender in (a, b, c):
+            self.client.force_authenticate(user=sender)
+            self.client.post(reverse("friend-request"), {"to_user": me.id})
+        FriendshipChange.objects.update(changed_at=timezone.now() - timedelta(days=60))
+
+        output = StringIO()
+        call_command("compact_change_log", batch_size=2, stdout=output)
+        self.assertIn("Deleted 5 change log entries.", output.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("compact_change_log", batch_size=0)
+
+        # The newest entry is kept, so clients behind it are told to download their lists
+        response = self.changes(me, 0)
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        last = FriendshipChange.objects.get()
+        self.assertEqual(response.data["next"], last.seq)
+        response = self.changes(me, last.seq - 1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(change["peer"], change["op"]) for change in response.data["changes"]],
+            [(c.id, "received")],
+        )
+
+    @override_settings(CHANGE_LOG_SETTLE_SECONDS=60)
+    def test_recent_entries_settle_first(self):
+        me, a, b, c = self.users
+        self.client.force_authenticate(user=a)
+        self.client.post(reverse("friend-request"), {"to_user": me.id})
+        self.assertEqual(self.changes(me, 0).data["changes"], [])
+
+        FriendshipChange.objects.update(
+            changed_at=timezone.now() - timedelta(minutes=2)
+        )
+        self.assertEqual(len(self.changes(me, 0).data["changes"]), 1)
+
+    def test_invalid_since(self):
+        response = self.changes(self.me, -1)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
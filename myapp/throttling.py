@@ -0,0 +1,189 @@
+# throttling.py
+
+import os
+import sqlite3
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from rest_framework.throttling import UserRateThrottle
+
+from .metrics import throttled_requests_total
+
+
+def sliding_window_count(previous_hits, current_hits, now, window, duration):
+    """
+    Estimate the hits of the last ``duration`` seconds from two fixed windows: the
+    current one, plus the part of the previous one still inside the sliding window.
+    """
+    elapsed = now - window * duration
+    return previous_hits * (duration - elapsed) / duration + current_hits
+
+
+# Define a throttle store keeping sliding-window counters in a SQLite file
+class SQLiteThrottleStore:
+    """
+    Shares counters between all the worker processes of a host through a SQLite file.
+    Each check reads at most two rows and writes one inside a single IMMEDIATE
+    transaction, so increment-and-check is atomic across processes.
+    """
+
+    def __init__(self, location, timeout=5):
+        self.location = str(location)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.location, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS throttle_window ("
+                "key TEXT NOT NULL, window INTEGER NOT NULL, hits INTEGER NOT NULL, "
+                "PRIMARY KEY (key, window)) WITHOUT ROWID"
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def hit(self, key, now, duration, limit, cost=1):
+        """
+        Record ``cost`` hits for the key if they fit within ``limit`` over the last
+        ``duration`` seconds. Return whether they were recorded.
+        """
+        window = int(now // duration)
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            hits = dict(
+                connection.execute(
+                    "SELECT window, hits FROM throttle_window WHERE key = ? AND window >= ?",
+                    (key, window - 1),
+                )
+            )
+            used = sliding_window_count(
+                hits.get(window - 1, 0), hits.get(window, 0), now, window, duration
+            )
+            allowed = used + cost <= limit
+            if allowed:
+                connection.execute(
+                    "INSERT INTO throttle_window (key, window, hits) VALUES (?, ?, ?) "
+                    "ON CONFLICT (key, window) DO UPDATE SET hits = hits + excluded.hits",
+                    (key, window, cost),
+                )
+                connection.execute(
+                    "DELETE FROM throttle_window WHERE key = ? AND window < ?",
+                    (key, window - 1),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return allowed
+
+    def clear(self):
+        self._connection().execute("DELETE FROM throttle_window")
+
+
+# Lua script run atomically by Redis: KEYS are the current and previous window counters
+REDIS_HIT_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+local used = previous * tonumber(ARGV[1]) + current
+if used + tonumber(ARGV[2]) > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('INCRBY', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+# Define a throttle store keeping sliding-window counters in Redis
+class RedisThrottleStore:
+    """
+    Shares counters between hosts through any server speaking the Redis protocol.
+    Each check is a single script call, executed atomically by the server.
+    """
+
+    def __init__(self, location, **options):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured(
+                "RedisThrottleStore requires the 'redis' package to be installed."
+            )
+        self.client = redis.Redis.from_url(location, **options)
+        self.script = self.client.register_script(REDIS_HIT_SCRIPT)
+
+    def hit(self, key, now, duration, limit, cost=1):
+        window = int(now // duration)
+        previous_weight = sliding_window_count(1, 0, now, window, duration)
+        return bool(
+            self.script(
+                keys=[f"throttle:{key}:{window}", f"throttle:{key}:{window - 1}"],
+                args=[previous_weight, cost, limit, 2 * duration],
+            )
+        )
+
+    def clear(self):
+        for key in self.client.scan_iter("throttle:*"):
+            self.client.delete(key)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_throttle_store():
+    # Return the store configured by the THROTTLE_STORE setting, created on first use
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = dict(settings.THROTTLE_STORE)
+                backend = import_string(config.pop("BACKEND"))
+                location = config.pop("LOCATION")
+                _store = backend(location, **config.pop("OPTIONS", {}))
+    return _store
+
+
+# Define a user rate throttle whose counters are shared by all worker processes
+class SharedRateThrottle(UserRateThrottle):
+    """
+    Replaces the per-process history list of SimpleRateThrottle with a sliding-window
+    counter in the THROTTLE_STORE, checked and incremented in O(1).
+    """
+
+    # Define a method returning how many hits the request counts for
+    def get_cost(self, request):
+        return 1
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        if get_throttle_store().hit(
+            self.key, self.now, self.duration, self.num_requests, self.get_cost(request)
+        ):
+            return True
+        return self.throttle_failure()
+
+    def throttle_failure(self):
+        throttled_requests_total.inc(scope=self.scope)
+        return super().throttle_failure()
+
+    def wait(self):
+        # Approximate the wait by the time left in the current fixed window
+        return self.duration - self.now % self.duration
@@ -1,17 +1,44 @@
 from django.urls import path
 from .views import *
+from .async_views import (
+    AsyncFriendListView,
+    AsyncPendingFriendRequestListView,
+    AsyncUserSearchView,
+    EventPollView,
+    EventStreamView,
+)
 
 urlpatterns = [
     path("signup/", SignupView.as_view(), name="signup"),
     path("login/", LoginView.as_view(), name="login"),
+    path("logout/", LogoutView.as_view(), name="logout"),
     path("search/", UserSearchAPIView.as_view(), name="search"),
     path("friend-request/", FriendRequestAPIView.as_view(), name="friend-request"),
+    path(
+        "friend-request/batch/",
+        FriendRequestBatchAPIView.as_view(),
+        name="friend-request-batch",
+    ),
     path("friends/", FriendListAPIView.as_view(), name="friends"),
+    path("relationships/", RelationshipLookupAPIView.as_view(), name="relationships"),
+    path("suggestions/", FriendSuggestionAPIView.as_view(), name="suggestions"),
     path(
         "pending-requests/",
         PendingFriendRequestListAPIView.as_view(),
         name="pending-requests",
     ),
+    path("changes/", FriendshipChangeListAPIView.as_view(), name="changes"),
+    # Native async versions of the read-heavy endpoints, for ASGI deployments
+    path("async/search/", AsyncUserSearchView.as_view(), name="async-search"),
+    path("async/friends/", AsyncFriendListView.as_view(), name="async-friends"),
+    path(
+        "async/pending-requests/",
+        AsyncPendingFriendRequestListView.as_view(),
+        name="async-pending-requests",
+    ),
+    # Push of new and accepted friend requests, for ASGI deployments
+    path("events/", EventStreamView.as_view(), name="events"),
+    path("events/poll/", EventPollView.as_view(), name="events-poll"),
     path(
         "reject-request/<int:pk>/",
         RejectFriendRequestAPIView.as_view(),
@@ -22,4 +49,15 @@ urlpatterns = [
         AcceptFriendRequestView.as_view(),
         name="accept-friend-request",
     ),
+    path(
+        "accept-friend-requests/",
+        BulkAcceptFriendRequestsAPIView.as_view(),
+        name="accept-friend-requests",
+    ),
+    path(
+        "reject-requests/",
+        BulkRejectFriendRequestsAPIView.as_view(),
+        name="reject-requests",
+    ),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
 ]
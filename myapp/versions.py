@@ -0,0 +1,105 @@
+# versions.py
+
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+
+def shared_cache():
+    # The cache every worker process reads and writes, named by SHARED_CACHE_ALIAS
+    return caches[getattr(settings, "SHARED_CACHE_ALIAS", "shared")]
+
+
+def get_version(key):
+    """
+    Return the version stored under a key of the shared cache, creating it if needed.
+
+    A version missing from the cache, e.g. after an eviction, restarts from the current
+    time in nanoseconds: above any version handed out before, so it never goes back.
+    """
+    cache = shared_cache()
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def get_versions(*keys):
+    # Return the versions of several keys, read with one cache call when they all exist
+    found = shared_cache().get_many(keys)
+    return tuple(
+        found[key] if found.get(key) is not None else get_version(key) for key in keys
+    )
+
+
+async def aget_versions(*keys):
+    found = await shared_cache().aget_many(keys)
+    if all(found.get(key) is not None for key in keys):
+        return tuple(found[key] for key in keys)
+    return await sync_to_async(get_versions)(*keys)
+
+
+def bump_version(key):
+    """
+    Set a new version rather than incrementing it, which not every backend does
+    atomically: of two concurrent bumps the last one wins, and both change the version.
+    Return (previous version or None, new version).
+    """
+    cache = shared_cache()
+    previous = cache.get(key)
+    version = max(time.time_ns(), (previous or 0) + 1)
+    cache.set(key, version, timeout=None)
+    return previous, version
+
+
+# A change feed is a sequence of entries in the shared cache: "<key>:<n>" holds the items
+# published n-th, and "<key>" the last n, which a reader uses to detect lost entries
+
+
+def publish_changes(key, items):
+    """
+    Append a list of items, e.g. the ids of changed users, to the change feed under a key
+    of the shared cache. Each entry is kept for CHANGE_FEED_TTL seconds.
+    """
+    cache = shared_cache()
+    timeout = getattr(settings, "CHANGE_FEED_TTL", 3600)
+    position = (cache.get(key) or 0) + 1
+    # add() fails on a slot taken by a concurrent writer, which then moves to the next one
+    while not cache.add(f"{key}:{position}", list(items), timeout=timeout):
+        position += 1
+    # Of two concurrent writers the last one wins, so readers may start over needlessly
+    cache.set(key, position, timeout=None)
+
+
+def read_changes(key, position, batch_size=20):
+    """
+    Return (items published after ``position``, new position), with one cache call per
+    ``batch_size`` entries. Return (None, last position) instead when some entries were
+    lost, e.g. expired unread: the reader then starts over from the database. A new
+    reader starts from the position returned by feed_position().
+    """
+    cache = shared_cache()
+    items = []
+    while True:
+        keys = [f"{key}:{position + offset}" for offset in range(1, batch_size + 1)]
+        found = cache.get_many([key, *keys])
+        for entry_key in keys:
+            if entry_key not in found:
+                break
+            items.extend(found[entry_key])
+            position += 1
+        else:
+            continue
+        last = found.get(key) or 0
+        if last != position:
+            # An entry is missing although a later one was published, or the feed restarted
+            return None, last
+        return items, position
+
+
+def feed_position(key):
+    # Return the position of the last entry of a change feed, 0 if none was published
+    return shared_cache().get(key) or 0
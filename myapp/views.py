@@ -1,18 +1,35 @@
-from django.contrib.auth import authenticate, login
+from django.contrib.auth import authenticate, login, logout
 from rest_framework import status, views
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
-from .models import Friendship
+from .models import Friendship, FriendshipChange
 from .serializers import *
-from django.db.models import Q
+from django.db import transaction
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 from rest_framework.views import APIView
 from rest_framework import generics
-from rest_framework.throttling import UserRateThrottle
-from rest_framework import filters
-from myapp.services import FriendRequestService
+from myapp.throttling import SharedRateThrottle
+from myapp.services import FriendRequestService, notify_accepted
+from myapp.search import NgramSearchFilter, search_cache, user_index
+from myapp.row_serializers import PendingRequestRowSerializer, UserRowSerializer
+from myapp.pagination import (
+    FriendshipKeysetPagination,
+    SortedIdPagination,
+    UserKeysetPagination,
+)
+from myapp.changes import change_log_horizon, change_log_start, log_changes
+from myapp.counters import adjust_counts
+from myapp.friend_cache import friend_cache
+from myapp.graph import friend_graph
+from myapp.relationships import RelationshipETagMixin, get_relationships
+from myapp.authentication import issue_token, token_registry
+from myapp.routers import ReplicaReadMixin, primary_reads
+from myapp.metrics import HasMetricsToken, PrometheusRenderer, metrics
+from contextlib import nullcontext
+from itertools import islice
 import logging
 
 logger = logging.getLogger(__name__)
@@ -63,10 +80,17 @@ class LoginView(views.APIView):
             # Authenticate the user using the provided email and password
             user = authenticate(request, username=email, password=password)
 
-            # If authentication is successful, log in the user and return a success response
+            # If authentication is successful, log in the user and return a success response with a signed token
             if user:
                 login(request, user)
-                return Response("successfully-login", status=status.HTTP_200_OK)
+                return Response(
+                    {
+                        "message": "successfully-login",
+                        "token": issue_token(user),
+                        "expires_in": settings.TOKEN_MAX_AGE,
+                    },
+                    status=status.HTTP_200_OK,
+                )
 
             # If authentication fails, return an error response indicating invalid credentials
             return Response(
@@ -77,8 +101,24 @@ class LoginView(views.APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+# Define a class for handling logout requests
+class LogoutView(views.APIView):
+    """
+    Revoke the signed token used for this request, if any, and end the session
+    """
+
+    # Define a method to handle POST requests
+    def post(self, request):
+        # request.auth holds the token payload when the request was authenticated with a signed token
+        if isinstance(request.auth, dict) and "j" in request.auth:
+            token_registry.revoke(request.auth["j"], request.auth["exp"])
+
+        logout(request)
+        return Response({"message": "successfully-logout"}, status=status.HTTP_200_OK)
+
+
 # Define a class for handling user search requests
-class UserSearchAPIView(generics.ListAPIView):
+class UserSearchAPIView(ReplicaReadMixin, generics.ListAPIView):
     """
     Specify the queryset to retrieve all User objects
     """
@@ -88,15 +128,57 @@ class UserSearchAPIView(generics.ListAPIView):
     # Specify the serializer class to use for serializing/deserializing User objects
     serializer_class = UserCreateSerializer
 
-    # Specify the filter backend to use for filtering the queryset
-    filter_backends = [filters.SearchFilter]
+    # Paginate the results by user id (or search rank) with opaque cursors
+    pagination_class = UserKeysetPagination
 
-    # Define the fields to search for using the specified search filter
+    # Specify the filter backend to use for filtering the queryset, backed by the n-gram search index
+    filter_backends = [NgramSearchFilter]
+
+    # Define the fields to search for when a term is too short for the search index
     search_fields = ["=email", "name__icontains"]
 
+    # Define a method to list a page of matching users, with ?expand=relationship adding
+    # the relationship of the authenticated user with each of them
+    def list(self, request, *args, **kwargs):
+        expand = "relationship" in request.query_params.get("expand", "").split(",")
+
+        # Serve repeated searches from the search cache, without a query; relationships
+        # depend on the requesting user, so expanded searches are not cached
+        cache_key = None
+        if not expand:
+            terms = NgramSearchFilter().get_search_terms(request)
+            cache_key = search_cache.make_key(request, terms)
+            cached = search_cache.get(cache_key)
+            if cached is not None:
+                return Response(cached)
+
+        # Read and serialize plain rows, without building model instances; results to be
+        # cached are read from the primary, as a lagging replica would cache old rows under
+        # the current version
+        with primary_reads() if cache_key is not None else nullcontext():
+            # Load the users created, edited or deleted through other processes
+            user_index.refresh()
+            queryset = self.filter_queryset(self.get_queryset())
+            ordering = self.paginator.get_ordering(request, queryset, self)
+            page = self.paginate_queryset(UserRowSerializer.values(queryset, ordering))
+        data = UserRowSerializer.serialize(page)
+
+        if expand:
+            relationships = get_relationships(
+                request.user.id, [user.id for user in page]
+            )
+            for row, user in zip(data, page):
+                row["id"] = user.id
+                row["relationship"] = relationships[user.id]
+        response = self.get_paginated_response(data)
+
+        if cache_key is not None:
+            search_cache.set(cache_key, response.data, [user.id for user in page])
+        return response
+
 
 # Define a custom throttle class for friend requests
-class FriendRequestThrottle(UserRateThrottle):
+class FriendRequestThrottle(SharedRateThrottle):
     """
     Specify the scope for the throttle, which is 'friend_request'
     """
@@ -128,7 +210,7 @@ class FriendRequestAPIView(APIView):
             to_user = User.objects.get(pk=to_user_id)
         except User.DoesNotExist:
             # If the user does not exist, log the error and return a bad request response
-            logger.error(f"Friend request failed: Invalid 'to_user' ID {to_user_id}")
+            logger.error("Friend request failed: Invalid 'to_user' ID %s", to_user_id)
             return Response(
                 {"error": "Invalid to_user id."}, status=status.HTTP_400_BAD_REQUEST
             )
@@ -141,53 +223,257 @@ class FriendRequestAPIView(APIView):
         # Log the success or failure of sending the friend request
         if response_status == status.HTTP_201_CREATED:
             logger.info(
-                f"Friend request sent successfully from user {request.user.id} to user {to_user_id}"
+                "Friend request sent successfully from user %s to user %s",
+                request.user.id,
+                to_user_id,
             )
         else:
             logger.error(
-                f"Failed to send friend request from user {request.user.id} to user {to_user_id}: {response_data.get('error')}"
+                "Failed to send friend request from user %s to user %s: %s",
+                request.user.id,
+                to_user_id,
+                response_data.get("error"),
             )
 
         # Return the response data and status received from the friend request service
         return Response(response_data, status=response_status)
 
 
+# Define a custom throttle class for batched friend requests
+class FriendRequestBatchThrottle(SharedRateThrottle):
+    """
+    Counts every target of a batch against the 'friend_request_batch' rate, instead of the whole batch as one request
+    """
+
+    scope = "friend_request_batch"
+
+    # Define a method to compute the weight of a request from the number of targets in the batch
+    def get_cost(self, request):
+        if hasattr(request.data, "getlist"):
+            to_users = request.data.getlist("to_users")
+        else:
+            to_users = request.data.get("to_users")
+        # A list too long for the serializer is rejected without work, like any invalid request
+        max_length = getattr(settings, "FRIEND_REQUEST_BATCH_SIZE", 100)
+        if not isinstance(to_users, list) or len(to_users) > max_length:
+            return 1
+        return max(len(to_users), 1)
+
+
+# Define a class for handling batched friend request API requests
+class FriendRequestBatchAPIView(APIView):
+    """
+    Specify the throttle classes to be applied to this view, weighting each batch by its number of targets
+    """
+
+    throttle_classes = [FriendRequestBatchThrottle]
+
+    # Define a method to handle POST requests for sending friend requests to a list of users
+    def post(self, request):
+        # Validate the list of target user ids
+        serializer = FriendRequestBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # Send all the friend requests using the batched service method
+        response_data, response_status = FriendRequestService.send_friend_requests(
+            request.user, serializer.validated_data["to_users"]
+        )
+        if response_status != status.HTTP_200_OK:
+            logger.error(
+                "Failed to send friend requests from user %s: %s",
+                request.user.id,
+                response_data.get("error"),
+            )
+
+        # Return a result for every target user
+        return Response(response_data, status=response_status)
+
+
 # Define a class for handling friend list API requests
-class FriendListAPIView(generics.ListAPIView):
+class FriendListAPIView(RelationshipETagMixin, generics.ListAPIView):
     """
     Specify the serializer class to use for serializing/deserializing Friendship objects
     """
 
     serializer_class = FriendshipSerializer
 
-    # Define a method to customize the queryset for retrieving friendships
-    def get_queryset(self):
-        # Construct a queryset to retrieve friendships where the authenticated user is either the sender or the receiver,
-        # and the friendship has been accepted (accepted=True)
-        return Friendship.objects.filter(
-            Q(
-                from_user=self.request.user, accepted=True
-            )  # Friendship where the authenticated user is the sender
-            | Q(
-                to_user=self.request.user, accepted=True
-            )  # Friendship where the authenticated user is the receiver
+    # Paginate the cached friend ids by id with opaque cursors
+    pagination_class = SortedIdPagination
+
+    # Define a method to list the friends of the authenticated user from the friend cache
+    def list(self, request, *args, **kwargs):
+        # Retrieve the sorted ids of the users who accepted, or whose request was accepted by, the authenticated user;
+        # an entry cached at another relationship version than the ETag is reloaded
+        friend_ids = friend_cache.get_friend_ids(
+            request.user.id, version=self.relationship_version
         )
 
+        # Return a page of friend ids, without reading the Friendship table when the cache is warm
+        page = self.paginate_queryset(friend_ids)
+        return self.get_paginated_response([{"to_user": pk} for pk in page])
+
+
+# Define a class for handling relationship lookup API requests
+class RelationshipLookupAPIView(APIView):
+    """
+    Return the relationship of the authenticated user with each of the users given as
+    ?ids=1,2,3: friends, request_sent, request_received, none or self, along with the
+    number of mutual friends. The number of queries does not depend on the number of ids.
+    """
+
+    # Define a method to handle GET requests
+    def get(self, request):
+        ids = [
+            value
+            for param in request.query_params.getlist("ids")
+            for value in param.split(",")
+            if value
+        ]
+        serializer = RelationshipLookupSerializer(data={"ids": ids})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        user_ids = serializer.validated_data["ids"]
+        relationships = get_relationships(request.user.id, user_ids)
+        results = [
+            {"id": user_id, **relationships[user_id]}
+            for user_id in dict.fromkeys(user_ids)
+        ]
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+
+# Define a class for handling friend suggestion API requests
+class FriendSuggestionAPIView(ReplicaReadMixin, APIView):
+    """
+    List the users the authenticated user may know: the friends of their friends, most
+    mutual friends first, without the users they already have a request with.
+    """
+
+    # Define a method to handle GET requests
+    def get(self, request):
+        limit = getattr(settings, "SUGGESTIONS_MAX_RESULTS", 20)
+        candidates = friend_graph.suggest(
+            request.user.id,
+            scan_limit=getattr(settings, "SUGGESTIONS_SCAN_LIMIT", 100000),
+        )
+
+        # Skip candidates with a pending request in either direction, a page of candidates at a time
+        suggestions = []
+        while len(suggestions) < limit:
+            page = dict(islice(candidates, 2 * limit))
+            if not page:
+                break
+            pending = Friendship.objects.between_many(
+                request.user.id, page
+            ).values_list("from_user", "to_user")
+            for from_id, to_id in pending:
+                page.pop(to_id if from_id == request.user.id else from_id, None)
+
+            users = User.objects.in_bulk(list(page))
+            for user_id, mutual_friends in page.items():
+                if user_id in users:
+                    users[user_id].mutual_friends = mutual_friends
+                    suggestions.append(users[user_id])
+        suggestions = suggestions[:limit]
+
+        serializer = FriendSuggestionSerializer(suggestions, many=True)
+        return Response({"results": serializer.data}, status=status.HTTP_200_OK)
+
 
 # Define a class for handling pending friend request list API requests
-class PendingFriendRequestListAPIView(generics.ListAPIView):
+class PendingFriendRequestListAPIView(
+    RelationshipETagMixin, ReplicaReadMixin, generics.ListAPIView
+):
     """
     Specify the serializer class to use for serializing/deserializing Friendship objects
     """
 
     serializer_class = FriendshipSerializer1
 
+    # Paginate the results by creation time with opaque cursors
+    pagination_class = FriendshipKeysetPagination
+
     # Define a method to customize the queryset for retrieving pending friend requests
     def get_queryset(self):
         # Construct a queryset to retrieve pending friend requests where the authenticated user is the receiver
         # and the friendship has not been accepted (accepted=False)
         return Friendship.objects.filter(to_user=self.request.user, accepted=False)
 
+    # Define a method to list a page of pending requests from plain rows, without building model instances
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        ordering = self.paginator.get_ordering(request, queryset, self)
+        page = self.paginate_queryset(
+            PendingRequestRowSerializer.values(queryset, ordering)
+        )
+        return self.get_paginated_response(PendingRequestRowSerializer.serialize(page))
+
+
+# Define a class for handling friendship change log API requests
+class FriendshipChangeListAPIView(ReplicaReadMixin, APIView):
+    """
+    Return the changes to the friends and friend requests of the authenticated user made
+    after ?since=<seq>, in sequence order, with the "next" sequence number to pass as
+    since on the following call, so a client keeping a copy of its lists syncs in
+    O(changes) instead of O(friends). Without since, only "next" is returned.
+
+    When the changes after since were compacted away, the response is 410 Gone: the
+    client downloads its lists again, and then asks for the changes after "next".
+    """
+
+    # Define a method to handle GET requests
+    def get(self, request):
+        serializer = ChangeLogQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        since = serializer.validated_data.get("since")
+        horizon = change_log_horizon()
+        if since is None or since >= horizon:
+            return Response(
+                {
+                    "changes": [],
+                    "next": horizon if since is None else since,
+                    "has_more": False,
+                },
+                status=status.HTTP_200_OK,
+            )
+
+        # The log is trimmed from its oldest end, so the changes after since are all
+        # there as long as since is not older than the first entry left
+        start = change_log_start()
+        if start is not None and since < start - 1:
+            return Response(
+                {
+                    "detail": "The changes since this sequence number were compacted.",
+                    "next": horizon,
+                },
+                status=status.HTTP_410_GONE,
+            )
+
+        page_size = getattr(settings, "CHANGE_LOG_PAGE_SIZE", 1000)
+        rows = list(
+            FriendshipChange.objects.filter(
+                user=request.user, seq__gt=since, seq__lte=horizon
+            )
+            .order_by("seq")
+            .values_list("seq", "peer", "op", "request")[: page_size + 1]
+        )
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        return Response(
+            {
+                "changes": [
+                    {"seq": seq, "peer": peer, "op": op, "request": request_id}
+                    for seq, peer, op, request_id in rows
+                ],
+                "next": rows[-1][0] if has_more else horizon,
+                "has_more": has_more,
+            },
+            status=status.HTTP_200_OK,
+        )
+
 
 # Define a class for handling friend request rejection API requests
 class RejectFriendRequestAPIView(generics.DestroyAPIView):
@@ -202,13 +488,28 @@ class RejectFriendRequestAPIView(generics.DestroyAPIView):
 
     # Define a method to handle DELETE requests for rejecting friend requests
     def delete(self, request, *args, **kwargs):
-        # Retrieve the friendship object to be rejected using the from_user and to_user fields
-        friendship = get_object_or_404(
-            Friendship, from_user=request.user, to_user=self.kwargs["pk"]
-        )
+        with transaction.atomic():
+            # Retrieve the friendship object to be rejected using the from_user and to_user fields
+            friendship = get_object_or_404(
+                Friendship.objects.select_for_update(),
+                from_user=request.user,
+                to_user=self.kwargs["pk"],
+            )
 
-        # Delete the friendship object
-        friendship.delete()
+            # Log the change before delete() clears the id of the friendship
+            log_changes(
+                FriendshipChange.DELETED,
+                [(friendship.from_user_id, friendship.to_user_id, friendship.id)],
+            )
+
+            # Delete the friendship object, and update the counters of both users with it
+            friendship.delete()
+            if friendship.accepted:
+                adjust_counts(
+                    friends={friendship.from_user_id: -1, friendship.to_user_id: -1}
+                )
+            else:
+                adjust_counts(pending={friendship.to_user_id: -1})
 
         # Return a success response indicating that the friend request has been rejected
         return Response(status=status.HTTP_204_NO_CONTENT)
@@ -222,38 +523,63 @@ class AcceptFriendRequestView(APIView):
 
     def post(self, request, request_id):
         try:
-            # Retrieve the friend request object to be accepted
-            friend_request = get_object_or_404(
-                Friendship, id=request_id, to_user=request.user, accepted=False
-            )
-
-            # Initialize a serializer with the friend request object and update the 'accepted' field to True
-            serializer = FriendRequestAcceptSerializer(
-                friend_request, data={"accepted": True}
-            )
-
-            # Check if the serializer data is valid
-            if serializer.is_valid():
-                # Save the serializer data (update the friend request object with the accepted status)
-                serializer.save()
-
-                # Log the successful acceptance of the friend request
-                logger.info(f"Friend request {request_id} accepted by {request.user}.")
+            # Accept the request and update the counters of both users in one transaction
+            with transaction.atomic():
+                # Retrieve the friend request object to be accepted
+                friend_request = get_object_or_404(
+                    Friendship.objects.select_for_update(),
+                    id=request_id,
+                    to_user=request.user,
+                    accepted=False,
+                )
 
-                # Return a success response with the serialized data of the updated friend request
-                return Response(serializer.data, status=status.HTTP_200_OK)
-            else:
-                # Log a warning if the serializer data is invalid
-                logger.warning(
-                    f"Failed to accept friend request {request_id}: Invalid serializer data."
+                # Initialize a serializer with the friend request object and update the 'accepted' field to True
+                serializer = FriendRequestAcceptSerializer(
+                    friend_request, data={"accepted": True}
                 )
 
-                # Return a response with errors if the serializer data is invalid
-                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+                # Check if the serializer data is valid
+                if serializer.is_valid():
+                    # Save the serializer data (update the friend request object with the accepted status)
+                    serializer.save()
+                    adjust_counts(
+                        friends={friend_request.from_user_id: 1, request.user.id: 1},
+                        pending={request.user.id: -1},
+                    )
+                    log_changes(
+                        FriendshipChange.ACCEPTED,
+                        [(friend_request.from_user_id, request.user.id, request_id)],
+                    )
+                    transaction.on_commit(
+                        lambda: notify_accepted(
+                            friend_request.id,
+                            friend_request.from_user_id,
+                            request.user.id,
+                        )
+                    )
+
+                    # Log the successful acceptance of the friend request
+                    logger.info(
+                        "Friend request %s accepted by %s.", request_id, request.user
+                    )
+
+                    # Return a success response with the serialized data of the updated friend request
+                    return Response(serializer.data, status=status.HTTP_200_OK)
+                else:
+                    # Log a warning if the serializer data is invalid
+                    logger.warning(
+                        "Failed to accept friend request %s: Invalid serializer data.",
+                        request_id,
+                    )
+
+                    # Return a response with errors if the serializer data is invalid
+                    return Response(
+                        serializer.errors, status=status.HTTP_400_BAD_REQUEST
+                    )
         except Exception as e:
             # Log an error if an unexpected exception occurs
             logger.error(
-                f"Error accepting friend request {request_id}: {e}", exc_info=True
+                "Error accepting friend request %s: %s", request_id, e, exc_info=True
             )
 
             # Return a response indicating an internal server error if an exception occurs
@@ -261,3 +587,63 @@ class AcceptFriendRequestView(APIView):
                 {"detail": "An unexpected error occurred."},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
+
+
+# Define a class for accepting many pending friend requests at once
+class BulkAcceptFriendRequestsAPIView(APIView):
+    """
+    Accept the pending requests received by the authenticated user, given either as a list of
+    request ids or as all=true, optionally limited to the ones created before created_before
+    """
+
+    # Define a method to handle POST requests for accepting friend requests in bulk
+    def post(self, request):
+        serializer = FriendRequestBulkSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # Accept all the matching requests with a single UPDATE
+        response_data, response_status = FriendRequestService.accept_friend_requests(
+            request.user,
+            ids=serializer.validated_data.get("ids"),
+            created_before=serializer.validated_data.get("created_before"),
+        )
+        return Response(response_data, status=response_status)
+
+
+# Define a class for rejecting many pending friend requests at once
+class BulkRejectFriendRequestsAPIView(APIView):
+    """
+    Delete the pending requests received by the authenticated user, given either as a list of
+    request ids or as all=true, optionally limited to the ones created before created_before
+    """
+
+    # Define a method to handle POST requests for rejecting friend requests in bulk
+    def post(self, request):
+        serializer = FriendRequestBulkSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # Delete all the matching requests with a single DELETE
+        response_data, response_status = FriendRequestService.reject_friend_requests(
+            request.user,
+            ids=serializer.validated_data.get("ids"),
+            created_before=serializer.validated_data.get("created_before"),
+        )
+        return Response(response_data, status=response_status)
+
+
+# Define a class exposing the metrics of all worker processes to Prometheus
+class MetricsView(APIView):
+    """
+    Restricted to "Authorization: Bearer <METRICS_TOKEN>" when the METRICS_TOKEN setting
+    is set, and otherwise to the client addresses listed in METRICS_ALLOWED_IPS.
+    """
+
+    authentication_classes = []
+    permission_classes = [HasMetricsToken]
+    renderer_classes = [PrometheusRenderer]
+
+    # Define a method to handle GET requests
+    def get(self, request):
+        return Response(metrics.render())